@@ -0,0 +1,50 @@
+"""
+Benchmarks the time taken to import Alan, as paid by every CLI tool and every worker process.
+
+Each statement is timed in a fresh Python process (so nothing is already imported), and
+reported as the median over repeats.  The statements are cumulative, e.g. the time for
+`alan.Problem` includes `import alan`.
+
+Usage:
+    python benchmarks/benchmark_import.py
+    python benchmarks/benchmark_import.py --repeats 20 --output imports.json
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+statements = {
+    'import torch': "import torch",
+    'import alan': "import alan",
+    'alan.Normal': "import alan; alan.Normal",
+    'alan.Problem': "import alan; alan.Problem",
+    'from alan import *': "from alan import *",
+}
+
+def time_statement(statement:str):
+    """
+    Time (in seconds) to run statement in a fresh process, measured inside the process.
+    """
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return float(output.strip().split('\n')[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output',  default=None)
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in statements.items():
+        results[name] = statistics.median(time_statement(statement) for _ in range(args.repeats))
+        print(f"{name:<20} {1000*results[name]:8.1f} ms")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
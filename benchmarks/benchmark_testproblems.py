@@ -0,0 +1,249 @@
+"""
+Benchmarks over the TestProblem catalogue in `tests/`.
+
+For each problem, times `problem.sample`, `elbo_vi` and `elbo_rws` (forward + backward),
+`marginals`, `moments` and `importance_sample` across a sweep of K and plate sizes, and records
+peak memory.  Plate sizes are scaled by tiling the data, inputs and parameters along every plate.
+
+Each configuration runs in a fresh process, so peak memory (max RSS on CPU, or peak allocated
+memory on GPU) isn't contaminated by previous configurations.
+
+Usage:
+    python benchmarks/benchmark_testproblems.py --output baseline.json
+    python benchmarks/benchmark_testproblems.py --output new.json --baseline baseline.json
+
+When a baseline is given, any configuration that is slower (or uses more memory) than the
+baseline by more than `--tolerance` is reported, and the script exits with a non-zero status.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import resource
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch as t
+
+tests_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests')
+
+tp_names = [
+    "model1",
+    "bernoulli_no_plate",
+    "linear_gaussian",
+    "linear_gaussian_two_params",
+    "linear_gaussian_two_params_corr_Q",
+    "linear_gaussian_two_params_corr_Q_reversed",
+    "linear_gaussian_two_params_dangling",
+    "linear_gaussian_sibling_plates",
+    "linear_gaussian_latents",
+    "linear_gaussian_latents_dangling",
+    "linear_gaussian_latents_batch",
+    "linear_multivariate_gaussian",
+    "linear_multivariate_gaussian_batch",
+    "linear_multivariate_gaussian_param",
+    "bernoulli_enumerate",
+]
+
+methods = ["sample", "elbo_vi", "elbo_rws", "marginals", "moments", "importance_sample"]
+
+
+def tile(x, scale:int):
+    """
+    Tiles a named tensor scale times along each named (i.e. plate) dimension.
+    """
+    names = x.names
+    if 0 == x.ndim:
+        return x
+    reps = [scale if name is not None else 1 for name in names]
+    return x.rename(None).repeat(*reps).refine_names(*names)
+
+def scale_problem(problem, scale:int):
+    """
+    Returns a new Problem with all plates scale times bigger.
+    """
+    from alan import BoundPlate, Problem
+    from alan.Plate import flatten_tree
+    from alan.utils import dim2named_dict
+
+    if scale == 1:
+        return problem
+
+    all_platesizes = {name: scale*dim.size for (name, dim) in problem.all_platedims.items()}
+    data = {k: tile(v, scale) for (k, v) in dim2named_dict(flatten_tree(problem.data)).items()}
+
+    def scale_bound_plate(bp):
+        return BoundPlate(
+            bp.plate,
+            inputs={k: tile(v, scale) for (k, v) in bp.inputs().items()},
+            params={k: tile(v.detach(), scale) for (k, v) in bp.params().items()},
+        )
+
+    return Problem(scale_bound_plate(problem.P), scale_bound_plate(problem.Q), all_platesizes, data)
+
+def method_fn(tp, problem, K:int, method:str):
+    """
+    Returns a function with no arguments that runs method.  Everything other than the thing we're
+    timing (e.g. drawing the sample for `elbo_vi`) is done up-front.
+    """
+    if method == "sample":
+        return lambda: problem.sample(K=K, reparam=False)
+    elif method == "elbo_vi":
+        sample = problem.sample(K=K, reparam=True)
+        return lambda: backward(sample.elbo_vi())
+    elif method == "elbo_rws":
+        sample = problem.sample(K=K, reparam=False)
+        return lambda: backward(sample.elbo_rws())
+    elif method == "marginals":
+        sample = problem.sample(K=K, reparam=False)
+        return lambda: sample.marginals()
+    elif method == "moments":
+        sample = problem.sample(K=K, reparam=False)
+        return lambda: sample.moments(tp.moments)
+    elif method == "importance_sample":
+        sample = problem.sample(K=K, reparam=False)
+        return lambda: sample.importance_sample(num_samples=100)
+    else:
+        raise Exception(f"Unknown method {method}")
+
+def backward(elbo):
+    #Problems without any parameters don't have gradients.
+    if elbo.requires_grad:
+        #The sample is reused across repeats, so we have to retain the graph for sampling.
+        elbo.backward(retain_graph=True)
+
+def max_rss():
+    #ru_maxrss is in kilobytes on Linux (but bytes on macOS).
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(tp_name:str, scale:int, K:int, method:str, repeats:int, device:str):
+    """
+    Runs in a fresh worker process.
+    """
+    sys.path.insert(0, tests_dir)
+    import importlib
+    warnings.filterwarnings('ignore', message='Named tensors')
+
+    t.manual_seed(0)
+    tp = importlib.import_module(tp_name).tp
+    problem = scale_problem(tp.problem, scale).to(device=device)
+    #Warm up on a small version of the problem, so that one-off allocations (e.g. thread pools)
+    #don't count towards peak memory.
+    method_fn(tp, tp.problem.to(device=device), 1, method)()
+
+    f = method_fn(tp, problem, K, method)
+
+    #The first call measures peak memory (and acts as a warm-up).
+    if device == 'cuda':
+        t.cuda.synchronize()
+        t.cuda.reset_peak_memory_stats()
+        baseline_memory = t.cuda.memory_allocated()
+        f()
+        t.cuda.synchronize()
+        peak_memory = t.cuda.max_memory_allocated() - baseline_memory
+    else:
+        baseline_memory = max_rss()
+        f()
+        peak_memory = max_rss() - baseline_memory
+
+    times = []
+    for _ in range(repeats):
+        if device == 'cuda':
+            t.cuda.synchronize()
+        start = time.perf_counter()
+        f()
+        if device == 'cuda':
+            t.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+
+    return {
+        'problem': tp_name,
+        'scale': scale,
+        'K': K,
+        'method': method,
+        'time': statistics.median(times),
+        'min_time': min(times),
+        'peak_memory': peak_memory,
+    }
+
+def key(result:dict):
+    return (result['problem'], result['scale'], result['K'], result['method'])
+
+def compare(results:list, baseline:list, tolerance:float):
+    """
+    Prints the ratio of time/memory relative to the baseline for each configuration, and returns a
+    list of the configurations that regressed by more than tolerance.
+    """
+    baseline = {key(result): result for result in baseline}
+
+    regressions = []
+    print(f"{'problem':<45}{'scale':>6}{'K':>6}  {'method':<20}{'time ratio':>12}{'memory ratio':>14}")
+    for result in results:
+        base = baseline.get(key(result))
+        if base is None:
+            continue
+
+        time_ratio = result['time'] / base['time']
+        #Small memory measurements are dominated by noise, so we only compare beyond 1MB.
+        memory_ratio = max(result['peak_memory'], 2**20) / max(base['peak_memory'], 2**20)
+
+        regressed = (1 + tolerance < time_ratio) or (1 + tolerance < memory_ratio)
+        if regressed:
+            regressions.append(result)
+
+        problem, scale, K, method = key(result)
+        flag = "  <- regression" if regressed else ""
+        print(f"{problem:<45}{scale:>6}{K:>6}  {method:<20}{time_ratio:>12.2f}{memory_ratio:>14.2f}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--problems', nargs='+', default=tp_names)
+    parser.add_argument('--methods',  nargs='+', default=methods, choices=methods)
+    parser.add_argument('--Ks',       nargs='+', type=int, default=[3, 10, 30])
+    parser.add_argument('--scales',   nargs='+', type=int, default=[1, 4], help="factors by which to scale every plate")
+    parser.add_argument('--repeats',  type=int, default=5)
+    parser.add_argument('--device',   default='cpu')
+    parser.add_argument('--workers',  type=int, default=1, help="more than one worker speeds things up, but makes timings noisier")
+    parser.add_argument('--output',   default='benchmark.json')
+    parser.add_argument('--baseline', default=None, help="JSON file from a previous run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="relative slow-down/memory increase that counts as a regression")
+    args = parser.parse_args()
+
+    configs = [(tp_name, scale, K, method) for tp_name in args.problems for scale in args.scales for K in args.Ks for method in args.methods]
+
+    #A fresh process for every configuration, so that peak memory is measured independently.
+    with ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            max_tasks_per_child=1,
+        ) as executor:
+        futures = [executor.submit(run_benchmark, *config, args.repeats, args.device) for config in configs]
+
+        results = []
+        for config, future in zip(configs, futures):
+            result = future.result()
+            results.append(result)
+            print(f"{config}: {1E3*result['time']:.2f}ms, {result['peak_memory']/2**20:.1f}MB", flush=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'torch_version': t.__version__,
+            'device': args.device,
+            'results': results,
+        }, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if 0 < len(regressions):
+            print(f"{len(regressions)} configurations regressed by more than {100*args.tolerance:.0f}%")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
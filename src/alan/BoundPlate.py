@@ -104,39 +104,49 @@ class BoundPlate(nn.Module):
             original_data,
             extended_data)
     
-    def check_deps(self, all_platedims:dict[str, Dim]):
+    def check_deps(self, all_platedims:dict[str, Dim], replicate_dims:list[Dim]=()):
         """
         This is run as we enter Problem, and checks that we can sample from P and Q, and hence
         that P and Q make sense.  For instance, checks that dependency structure is valid and
         sizes of tensors are consistent.  Note that this isn't obvious for P, as we never actually
         sample from P, we just evaluate log-probabilities under P.
         """
-        self._sample(1, False, PermutationSampler, all_platedims)
+        self._sample(1, False, PermutationSampler, all_platedims, replicate_dims)
 
-    def _sample(self, K: int, reparam:bool, sampling_type:SamplingType, all_platedims:dict[str, Dim]):
+    def _sample(self, K, reparam:bool, sampling_type:SamplingType, all_platedims:dict[str, Dim], replicate_dims:list[Dim]=(), qmc:bool=False, antithetic:bool=False):
         """
         Internal sampling method.
+        K is an int, a dict or a function (see `Plate.groupvarname2Kdim`).
+        replicate_dims are extra top-level dims, on which we draw independent samples (used for
+        batching independent runs).
+        qmc uses quasi-Monte Carlo base noise along the K-dimensions (see `TorchDimDist.qmc_noise`).
+        antithetic uses antithetic pairs of particles along the K-dimensions (see `TorchDimDist.base_noise`).
         Returns: 
             globalK_sample: sample with different K-dimension for each variable.
             logPQ: log-prob.
         """
-        assert isinstance(K, int)
         assert isinstance(reparam, bool)
         assert issubclass(sampling_type, SamplingType)
         #assert isinstance(next(iter(all_platedims.values())), Dim)
 
         groupvarname2Kdim = self.plate.groupvarname2Kdim(K)
+        if isinstance(K, dict):
+            unknown = set(K.keys()).difference(groupvarname2Kdim.keys())
+            if 0 != len(unknown):
+                raise Exception(f"K is given for {sorted(unknown)}, which aren't latent variables or groups in Q")
 
         sample = self.plate.sample(
             name=None,
             scope={},
             inputs_params=self.inputs_params(all_platedims),
-            active_platedims=[],
+            active_platedims=[*replicate_dims],
             all_platedims=all_platedims,
             groupvarname2Kdim=groupvarname2Kdim,
             sampling_type=sampling_type,
             reparam=reparam,
             device=self.device,
+            qmc=qmc,
+            antithetic=antithetic,
         )
 
         return sample, groupvarname2Kdim
@@ -4,6 +4,7 @@ from typing import Optional
 from .dist import Dist
 from .utils import *
 from .SamplingType import SamplingType
+from .Profiler import profiled
 
 class Group(): 
     def __init__(self, **kwargs):
@@ -11,6 +12,8 @@ class Group():
         for varname, dist in kwargs.items():
             if not isinstance(dist, Dist):
                 raise Exception("{varname} in a Group should be a Dist, but is actually {type(dist)}")
+            if dist.enumerate:
+                raise Exception(f"{varname} in a Group can't be enumerated, as all variables in a Group share a K-dimension")
 
         if len(kwargs) < 2:
             raise Exception("Groups only make sense if they have two or more random variables, but this group only has {len(kwargs)} random variables")
@@ -20,8 +23,10 @@ class Group():
         self.all_args = set_all_arg_list.difference(kwargs.keys()) #remove dependencies on other variables in the group.
 
     def filter_scope(self, scope: dict[str, Tensor]):
-        return {k: v for (k,v) in scope.items() if k in self.all_args}
+        #Only looks up the arguments, rather than iterating through the whole scope.
+        return {k: scope[k] for k in self.all_args if k in scope}
 
+    @profiled('sample', 'Group')
     def sample(
             self,
             name:Optional[str],
@@ -33,6 +38,8 @@ class Group():
             sampling_type:SamplingType,
             reparam:bool,
             device:t.device,
+            qmc:bool,
+            antithetic:bool,
             ):
 
         result = {}       #This is the sample returned.
@@ -46,7 +53,7 @@ class Group():
 
         for name, dist in self.prog.items():
             tdd = dist.tdd(scope, device=device)
-            sample = tdd.sample(reparam, sample_dims, dist.sample_shape)
+            sample = tdd.sample(reparam, sample_dims, dist.sample_shape, noise_dim=Kdim, qmc=qmc, antithetic=antithetic)
 
             scope[name]  = sample
             result[name] = sample
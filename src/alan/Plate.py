@@ -1,5 +1,6 @@
 import torch as t
 from typing import Optional
+from collections import ChainMap
 
 from functorch.dim import Dim
 
@@ -7,7 +8,10 @@ from .utils import *
 from .SamplingType import SamplingType
 from .dist import Dist
 from .Group import Group
+from .Timeseries import Timeseries
 from .Data import Data
+from .Profiler import profiled
+from .batching import sample_batches, sample_batch
 
 
 
@@ -27,6 +31,7 @@ class Plate():
             raise Exception(f"Plate has duplicate names {dup_names}.")
 
 
+    @profiled('sample', 'Plate')
     def sample(
             self,
             name:Optional[str],
@@ -38,6 +43,8 @@ class Plate():
             sampling_type:SamplingType,
             reparam:bool,
             device:t.device,
+            qmc:bool,
+            antithetic:bool,
         ):
 
         if name is not None:
@@ -45,9 +52,33 @@ class Plate():
 
         scope = update_scope_inputs_params(scope, inputs_params)
         sample = {}
+
+        #Siblings of the same family are sampled together, at the first variable in the batch.
+        batched_samples = {}
+        name2batch = {name: names for names in sample_batches(self.prog) for name in names}
         
         for childname, dgpt in self.prog.items():
-            if not isinstance(dgpt, Data):
+            if (childname in name2batch) and (childname not in batched_samples):
+                names = name2batch[childname]
+                result = sample_batch(
+                    names=names,
+                    dists=[self.prog[name] for name in names],
+                    scope=scope,
+                    active_platedims=active_platedims,
+                    groupvarname2Kdim=groupvarname2Kdim,
+                    reparam=reparam,
+                    device=device,
+                    qmc=qmc,
+                    antithetic=antithetic,
+                )
+                #If the parameters aren't compatible, we sample the variables one at a time.
+                batched_samples.update(result if result is not None else {name: None for name in names})
+
+            if batched_samples.get(childname) is not None:
+                childsample = batched_samples[childname]
+                sample[childname] = childsample
+                scope = update_scope_sample(scope, childname, dgpt, childsample)
+            elif not isinstance(dgpt, Data):
                 childsample = dgpt.sample(
                     name=childname,
                     scope=scope, 
@@ -58,6 +89,8 @@ class Plate():
                     sampling_type=sampling_type,
                     reparam=reparam,
                     device=device,
+                    qmc=qmc,
+                    antithetic=antithetic,
                 )
 
                 sample[childname] = childsample
@@ -138,18 +171,29 @@ class Plate():
 
         return original_lls, extended_lls
     
-    def groupvarname2Kdim(self, K):
+    def groupvarname2Kdim(self, K, active_platenames:tuple[str]=()):
         """
         Finds all the Groups/Dists in the program, and creates a 
         K-dimension for each.
+
+        K is an int (the same K for every Group/Dist), a dict mapping groupvarname to K, or a
+        function, K(groupvarname, active_platenames), e.g. to use many particles for top-level
+        variables and fewer for variables deep in plates (see `resolve_K`).
         """
         result = {}
         for childname, childP in self.prog.items():
-            if isinstance(childP, (Dist, Group)):
-                result[childname] = Dim(f"K_{childname}", K)
+            if isinstance(childP, Dist) and childP.enumerate:
+                #Size of the K-dimension is the size of the support, so doesn't need a K.
+                result[childname] = Dim(f"K_{childname}", childP.Kdim_size(None))
+            elif isinstance(childP, (Dist, Timeseries)):
+                result[childname] = Dim(f"K_{childname}", childP.Kdim_size(resolve_K(K, childname, active_platenames)))
+            elif isinstance(childP, Group):
+                result[childname] = Dim(f"K_{childname}", resolve_K(K, childname, active_platenames))
             elif isinstance(childP, Plate):
                 assert isinstance(childP, Plate)
-                result = {**result, **childP.groupvarname2Kdim(K)}
+                result = {**result, **childP.groupvarname2Kdim(K, (*active_platenames, childname))}
+        #K-dims come after the plate dims in the canonical layout (see `canonical_dims`).
+        register_dims(list(result.values()))
         return result
 
     def all_prog_names(self):
@@ -163,7 +207,7 @@ class Plate():
             if isinstance(v, (Plate, Group)):
                 result = [*result, *v.all_prog_names()]
             else:
-                assert isinstance(v, (Dist, Data))
+                assert isinstance(v, (Dist, Timeseries, Data))
         return result
 
 #    def groupvarname2varnames(self):
@@ -188,7 +232,7 @@ class Plate():
         """
         result = {}
         for k, v in self.prog.items():
-            if isinstance(v, Dist):
+            if isinstance(v, (Dist, Timeseries)):
                 result[k] = k
             elif isinstance(v, Group):
                 for gk, gv in v.prog.items():
@@ -239,7 +283,7 @@ class Plate():
         """
         result = {}
         for name, dgpt in self.prog.items():
-            if isinstance(dgpt, (Dist, Group)):
+            if isinstance(dgpt, (Dist, Group, Timeseries)):
                 result[name] = active_platedimnames
             elif isinstance(dgpt, Plate):
                 active_platedimnames = [*active_platedimnames, name]
@@ -268,11 +312,25 @@ class Plate():
 
 #Functions to update the scope
 
-def update_scope_sample(scope: dict[str, Tensor], name:str, dgpt, sample):
+#The scope is a ChainMap, with one level for each plate (and group), so entering a plate is O(1), and
+#adding a sample just writes to the innermost level, rather than copying the whole scope (which made
+#traversing wide programs O(n^2) in the number of variables).  Leaving a plate just means going back
+#to the parent's scope, which never sees the child's level.
+
+def push_scope(scope: dict[str, Tensor]):
+    """
+    Returns a new level of scope, which can be updated in-place without changing scope.
+    """
+    return scope.new_child() if isinstance(scope, ChainMap) else ChainMap({}, scope)
+
+def update_scope_sample(scope: ChainMap, name:str, dgpt, sample):
     return update_scope_samples(scope, {name:dgpt}, {name: sample})
 
-def update_scope_samples(scope: dict[str, Tensor], Q_prog:dict, samples:dict):
-    scope = {**scope}
+def update_scope_samples(scope: ChainMap, Q_prog:dict, samples:dict):
+    """
+    Adds the samples to the innermost level of scope (in-place), so scope must come from `push_scope`.
+    """
+    assert isinstance(scope, ChainMap)
 
     for childname, childQ in Q_prog.items():
         if isinstance(childQ, Data):
@@ -280,7 +338,7 @@ def update_scope_samples(scope: dict[str, Tensor], Q_prog:dict, samples:dict):
         else:
             sample = samples[childname]
 
-            if isinstance(childQ, Dist):
+            if isinstance(childQ, (Dist, Timeseries)):
                 assert isinstance(sample, Tensor)
                 scope[childname] = sample
             elif isinstance(childQ, Group):
@@ -293,7 +351,10 @@ def update_scope_samples(scope: dict[str, Tensor], Q_prog:dict, samples:dict):
     return scope
 
 def update_scope_inputs_params(scope:dict[str, Tensor], inputs_params:dict):
-    scope = {**scope}
+    """
+    Pushes a new level of scope, with the inputs/params for the plate.
+    """
+    scope = push_scope(scope)
     for n, v in inputs_params.items():
         if isinstance(v, Tensor):
             scope[n] = v
@@ -405,4 +466,20 @@ def flatten_tree(tree):
             result = {**result, **flatten_tree(v)}
     return result
 
+def resolve_K(K, groupvarname:str, active_platenames:tuple[str]):
+    """
+    Number of particles for groupvarname, where K is an int, a dict mapping groupvarname to K, or a
+    function, K(groupvarname, active_platenames).
+    """
+    if isinstance(K, dict):
+        if groupvarname not in K:
+            raise Exception(f"K is a dict, but doesn't give a K for {groupvarname}")
+        result = K[groupvarname]
+    elif callable(K):
+        result = K(groupvarname, active_platenames)
+    else:
+        result = K
 
+    if not (isinstance(result, int) and 0 < result):
+        raise Exception(f"K for {groupvarname} should be a positive int, but is actually {result}")
+    return result
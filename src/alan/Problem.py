@@ -1,22 +1,31 @@
 import torch as t
 import torch.nn as nn
-from typing import Union
+from typing import Optional, Union
 
 from .Plate import Plate, tensordict2tree, flatten_tree
 from .BoundPlate import BoundPlate, named2torchdim_flat2tree
 from .SamplingType import SamplingType
 from .utils import *
-from .checking import check_PQ_plate, check_inputs_params, mismatch_names
+from .checking import check_PQ_plate, check_inputs_params, check_enumerated, mismatch_names
 from .logpq import logPQ_plate
 from .SamplingType import PermutationSampler
 
 from .Sample import Sample
+from .Split import Split, checkpoint
+from .estimate import estimate
 
 PBP = Union[Plate, BoundPlate]
 
 
 class Problem(nn.Module):
-    def __init__(self, P:BoundPlate, Q:BoundPlate, all_platesizes: dict[str, int], data: dict[str, t.Tensor]):
+    def __init__(self, P:BoundPlate, Q:BoundPlate, all_platesizes: dict[str, int], data: dict[str, t.Tensor], replicates:Optional[int]=None):
+        """
+        replicates: optional number of independent runs to evaluate in one batched pass.
+        Any inputs/parameters with a named `replicate` dimension take different values for
+        each run (e.g. `t.zeros(replicates, names=('replicate',))` for a scalar parameter),
+        while everything else is shared across runs.  `sample.elbo_*` then returns a tensor
+        with one ELBO for each run.
+        """
         super().__init__()
 
         if (not isinstance(P, BoundPlate)) or (not isinstance(Q, BoundPlate)):
@@ -28,15 +37,28 @@ class Problem(nn.Module):
         self.P = P
         self.Q = Q
         self.all_platedims = {name: Dim(name, size) for name, size in all_platesizes.items()}
+
+        if 'replicate' in all_platesizes:
+            raise Exception("'replicate' is reserved in Alan; to batch independent runs, use e.g. `Problem(..., replicates=10)`")
+
+        self.replicate_dims = []
+        if replicates is not None:
+            assert isinstance(replicates, int)
+            replicate_dim = Dim('replicate', replicates)
+            self.replicate_dims = [replicate_dim]
+            self.all_platedims['replicate'] = replicate_dim
+        #Plate dims come first in the canonical layout (see `canonical_dims`).
+        register_dims(list(self.all_platedims.values()))
         self.data = tensordict2tree(P.plate, named2dim_dict(data, self.all_platedims))
 
         #Check names in P matches those in Q+data, and there are no duplicates.
         #Check the structure of P matches that of Q.
         check_PQ_plate(None, P.plate, Q.plate, self.data)
         check_inputs_params(P, Q)
+        check_enumerated(Q.plate)
 
-        P.check_deps(self.all_platedims)
-        Q.check_deps(self.all_platedims)
+        P.check_deps(self.all_platedims, self.replicate_dims)
+        Q.check_deps(self.all_platedims, self.replicate_dims)
 
     @property
     def device(self):
@@ -46,15 +68,30 @@ class Problem(nn.Module):
         if not (self.device == self.P.device and self.device == self.Q.device):
             raise Exception("Device issue: Problem, P and/or Q aren't all on the same device.  The easiest way to make sure everything works is to call e.g. problem.to('cuda'), rather than e.g. P.to('cuda').")
 
-    def sample(self, K: int, reparam:bool=True, sampling_type:SamplingType=PermutationSampler):
+    def sample(self, K, reparam:bool=True, sampling_type:SamplingType=PermutationSampler, qmc:bool=False, antithetic:bool=False):
         """
+        K is the number of particles for each latent variable/group.  Can be an int (the same K for
+        everything), a dict mapping groupvarname to K, or a function, K(groupvarname, active_platenames).
+        e.g. `K=lambda name, platenames: 3 if platenames else 30` uses many particles for the top-level
+        variables, and few for the variables in plates, which makes the largest factor much smaller.
+
+        qmc=True draws the base noise for Normal, LogNormal and StudentT latents from a scrambled
+        Sobol sequence along the K-dimension, rather than i.i.d.  The particles are spread out more
+        evenly, which typically reduces the variance of the ELBO and its gradients (so a smaller K
+        gives the same accuracy), while keeping the estimators unbiased.
+
+        antithetic=True draws these latents in antithetic pairs: the second half of each
+        K-dimension uses the mirrored base noise from the first half.  Again, this reduces variance
+        without any extra log-prob evaluations, and keeps the estimators unbiased.  Can be combined
+        with qmc.
+
         Returns: 
             globalK_sample: sample with different K-dimension for each variable.
             logPQ: log-prob.
         """
         self.check_device()
 
-        sample, groupvarname2Kdim = self.Q._sample(K, reparam, sampling_type, self.all_platedims)
+        sample, groupvarname2Kdim = self.Q._sample(K, reparam, sampling_type, self.all_platedims, self.replicate_dims, qmc, antithetic)
 
         return Sample(
             problem=self,
@@ -64,6 +101,15 @@ class Problem(nn.Module):
             reparam=reparam,
         )
 
+    def estimate(self, K, split:Optional[Split]=checkpoint, sampling_type:SamplingType=PermutationSampler):
+        """
+        Dry-run estimate of peak memory, the largest factor in each contraction and total FLOPs for
+        computing the ELBO, without allocating any tensors.  Useful for choosing K and split.
+        K can be an int, a dict or a function, as in `sample`.
+        See `alan.estimate.estimate` for details.
+        """
+        return estimate(self, K, split, sampling_type)
+
     def inputs_params(self):
         flat_named = {
             **self.P.inputs_params_flat_named(), 
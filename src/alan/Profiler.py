@@ -0,0 +1,211 @@
+import json
+import math
+import time
+import threading
+import functools
+from typing import Optional
+from contextlib import contextmanager
+
+import torch as t
+
+from .utils import *
+
+#Profilers that are currently recording (there's usually at most one).  Profiling is
+#opt-in, so when this is empty, the hooks below just call the underlying function.
+active_profilers = []
+lock = threading.Lock()
+#Stack of currently running events for each thread, used to compute self time.
+thread_local = threading.local()
+
+
+class Event():
+    def __init__(self, phase:str, kind:str, name:str, start:float, thread:int, depth:int):
+        self.phase = phase
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.thread = thread
+        self.depth = depth
+        self.duration = 0.
+        self.child_duration = 0.
+        self.flops = 0
+        self.bytes = 0
+
+    @property
+    def self_duration(self):
+        return self.duration - self.child_duration
+
+
+class Profiler():
+    """
+    Records wall time, a rough FLOP estimate and the bytes of the tensors produced at
+    each Dist, Group and Plate node (when sampling and when computing log-probs), and at
+    each contraction step in `reduce_Ks`/`sample_Ks`.
+
+    Construct using `with alan.profile() as prof:`.
+
+    FLOPs are a rough estimate: one per element produced for sampling/log-probs, and
+    for contraction steps, the size of the intermediate (before summing out Ks) times
+    the number of operations (adds, subtracting the max, exp and sum) at each element.
+
+    Times for nodes are inclusive (i.e. a Plate includes its children), while self time
+    excludes any nested events.  On GPU, use `profile(synchronize=True)` to get accurate
+    times, at the cost of synchronizing after every node.
+    """
+    def __init__(self, synchronize:bool=False):
+        self.synchronize = synchronize
+        self.events = []
+        self.start = time.perf_counter()
+
+    def table(self, sort_by:str="self_time", limit:Optional[int]=None):
+        """
+        Returns a string with a table summarising time/FLOPs/memory for each node,
+        aggregated over all calls, sorted by sort_by (one of the column names), with the
+        most expensive first.
+        """
+        rows = {}
+        for event in self.events:
+            key = (event.phase, event.kind, event.name)
+            if key not in rows:
+                rows[key] = {'calls': 0, 'time': 0., 'self_time': 0., 'flops': 0, 'bytes': 0}
+            row = rows[key]
+            row['calls']     += 1
+            row['time']      += event.duration
+            row['self_time'] += event.self_duration
+            row['flops']     += event.flops
+            row['bytes']     += event.bytes
+
+        if sort_by not in ['calls', 'time', 'self_time', 'flops', 'bytes']:
+            raise Exception(f"Can't sort profiling table by {sort_by}")
+        keys = sorted(rows.keys(), key=lambda key: rows[key][sort_by], reverse=True)
+        if limit is not None:
+            keys = keys[:limit]
+
+        header = f"{'phase':<10}{'kind':<12}{'name':<24}{'calls':>7}{'time (ms)':>12}{'self (ms)':>12}{'MFLOPs':>12}{'MB':>12}"
+        lines = [header, '-'*len(header)]
+        for key in keys:
+            phase, kind, name = key
+            row = rows[key]
+            lines.append(
+                f"{phase:<10}{kind:<12}{name:<24}{row['calls']:>7}"
+                f"{1E3*row['time']:>12.3f}{1E3*row['self_time']:>12.3f}"
+                f"{row['flops']/1E6:>12.3f}{row['bytes']/2**20:>12.3f}"
+            )
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """
+        Returns the events in Chrome trace format (as a dict), viewable in chrome://tracing
+        or https://ui.perfetto.dev.
+        """
+        trace_events = [{
+            'name': f'{event.kind} {event.name}',
+            'cat': event.phase,
+            'ph': 'X',
+            'ts': 1E6*(event.start - self.start),
+            'dur': 1E6*event.duration,
+            'pid': 0,
+            'tid': event.thread,
+            'args': {'flops': event.flops, 'bytes': event.bytes},
+        } for event in self.events]
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, filename:str):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+@contextmanager
+def profile(synchronize:bool=False):
+    """
+    Context manager that profiles everything inside it, e.g.
+    ```
+    with alan.profile() as prof:
+        sample = problem.sample(K=10)
+        sample.elbo_vi().backward()
+    print(prof.table())
+    prof.export_chrome_trace('trace.json')
+    ```
+    """
+    profiler = Profiler(synchronize=synchronize)
+    with lock:
+        active_profilers.append(profiler)
+    try:
+        yield profiler
+    finally:
+        with lock:
+            active_profilers.remove(profiler)
+
+
+def profiled(phase:str, kind:str, name=None, flops=None):
+    """
+    Decorator that records an Event in any active profilers each time the function is called.
+    `name` and `flops` are optional functions of (result, *args, **kwargs) giving the name of the
+    node and an estimate of the FLOPs.  By default, the name is the `name` kwarg, and the FLOP
+    estimate is the number of elements produced.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            if 0 == len(active_profilers):
+                return f(*args, **kwargs)
+
+            synchronize = any(profiler.synchronize for profiler in active_profilers)
+
+            stack = getattr(thread_local, 'stack', None)
+            if stack is None:
+                stack = thread_local.stack = []
+
+            if synchronize:
+                t.cuda.synchronize()
+            event = Event(phase, kind, None, time.perf_counter(), threading.get_ident(), len(stack))
+            stack.append(event)
+            try:
+                result = f(*args, **kwargs)
+                if synchronize:
+                    t.cuda.synchronize()
+            finally:
+                event.duration = time.perf_counter() - event.start
+                stack.pop()
+                if 0 < len(stack):
+                    stack[-1].child_duration += event.duration
+
+            if name is not None:
+                event.name = name(result, *args, **kwargs)
+            else:
+                #The top-level plate is signalled by name=None.
+                event.name = kwargs.get('name') or 'root'
+            event.bytes = tree_bytes(result)
+            event.flops = flops(result, *args, **kwargs) if flops is not None else tree_numel(result)
+
+            with lock:
+                for profiler in active_profilers:
+                    profiler.events.append(event)
+
+            return result
+        return inner
+    return decorator
+
+
+def tree_tensors(x):
+    """
+    Returns a list of all the tensors in a nested structure of dicts/lists/tuples.
+    """
+    if isinstance(x, Tensor):
+        return [x]
+    elif isinstance(x, dict):
+        return [tensor for v in x.values() for tensor in tree_tensors(v)]
+    elif isinstance(x, (list, tuple)):
+        return [tensor for v in x for tensor in tree_tensors(v)]
+    else:
+        return []
+
+def numel(x:Tensor):
+    #Includes torchdim dimensions.
+    return x.numel() * math.prod(dim.size for dim in generic_dims(x))
+
+def tree_numel(x):
+    return sum(numel(tensor) for tensor in tree_tensors(x))
+
+def tree_bytes(x):
+    return sum(numel(tensor) * tensor.element_size() for tensor in tree_tensors(x))
@@ -0,0 +1,120 @@
+import math
+from typing import Optional
+
+from .utils import *
+
+
+class Prune():
+    """
+    Prunes particles before each contraction step in `collect_lps`, and keeps track of an upper
+    bound on the bias this introduces.
+
+    For each Kdim summed at a step, each particle gets an upper bound on its total contribution
+    to the sum (at every element of the output), from the "product of sums" bound,
+    ```
+    sum_{others} prod_f exp(f(k, others)) <= prod_f sum_{dims of f other than k} exp(f(k, ...)),
+    ```
+    which only needs the individual factors, not the joint intermediate.  Particles are ranked
+    by the largest (over the output) fraction of the total bound they carry; we keep the `top_k`
+    particles, and/or the particles carrying at least `threshold` of the total bound.
+
+    Removing particles only removes (non-negative) terms from the sum, so the pruned ELBO is a
+    lower bound on the full ELBO.  At each step, the removed mass R is at most the sum of the bounds
+    for the pruned particles, so the log of the output is underestimated by at most `log(1 + R/Z)`,
+    where Z is the pruned output.  Later steps either logsumexp over Kdims or sum over plates, so
+    the error in the ELBO is at most the sum over steps of that bound, maximized over Kdims and
+    summed over plates.
+
+    The steps are recorded in `self.steps` each time a step is computed.  As steps are recomputed
+    in the backward pass when checkpointing, take the report (using `report`) straight after the
+    forward pass.
+    """
+    def __init__(self, Kdims, top_k:Optional[int]=None, threshold:Optional[float]=None):
+        if (top_k is None) and (threshold is None):
+            raise Exception("Pruning requires top_k and/or threshold")
+        if (top_k is not None) and (top_k < 1):
+            raise Exception(f"top_k must be at least 1, but got {top_k}")
+        if (threshold is not None) and not (0 <= threshold < 1):
+            raise Exception(f"threshold must be in [0, 1), but got {threshold}")
+
+        self.Kdims = set(Kdims)
+        self.top_k = top_k
+        self.threshold = threshold
+        self.steps = []
+
+    def prune(self, lps_to_reduce, _Ks_to_sum):
+        """
+        Returns the pruned lps, the (new) Kdims to sum over, and a dict describing the step (to be
+        passed to `record` along with the result of the step).
+        """
+        lps = list(lps_to_reduce)
+        Ks = list(_Ks_to_sum)
+        log_removed = []
+        kept = {}
+
+        for i, K in enumerate(_Ks_to_sum):
+            with t.no_grad():
+                logU = log_upper_bound([lp.detach() for lp in lps], K, Ks)
+                #Fraction of the total bound carried by each particle, at each output element.
+                #0/0 (e.g. where the factors are all -inf) is ignored.
+                weights = (logU - logsumexp_dims(logU, (K,))).nan_to_num(nan=-math.inf)
+                other_dims = tuple(dim for dim in generic_dims(weights) if dim is not K)
+                score = max_dims(weights, other_dims).order(K)
+
+                num_kept = K.size
+                if self.top_k is not None:
+                    num_kept = min(num_kept, self.top_k)
+                if (self.threshold is not None) and (0 < self.threshold):
+                    num_kept = min(num_kept, max(1, int((math.log(self.threshold) <= score).sum())))
+
+            kept[str(K)] = num_kept
+            if num_kept == K.size:
+                continue
+
+            order = score.argsort(descending=True)
+            idxs = order[:num_kept].sort().values
+            with t.no_grad():
+                log_removed.append(logU.order(K)[order[num_kept:]].logsumexp(0))
+
+            prunedK = Dim(f'{K}_pruned', num_kept)
+            lps = [lp.order(K)[idxs][prunedK] if K in set(generic_dims(lp)) else lp for lp in lps]
+            Ks[i] = prunedK
+
+        step = {'Ks': tuple(str(K) for K in _Ks_to_sum), 'kept': kept, 'log_removed': log_removed}
+        return tuple(lps), tuple(Ks), step
+
+    def record(self, step:dict, result):
+        """
+        Records a step, computing the bound on the bias from the output of the step.
+        """
+        log_removed = step.pop('log_removed')
+        bias_bound = 0.
+        if 0 < len(log_removed):
+            with t.no_grad():
+                log_R = log_removed[0]
+                for lr in log_removed[1:]:
+                    log_R = t.logaddexp(log_R, lr)
+                bias = (log_R - result.detach()).exp().log1p()
+
+                Kdims = tuple(dim for dim in generic_dims(bias) if dim in self.Kdims)
+                other_dims = tuple(dim for dim in generic_dims(bias) if dim not in self.Kdims)
+                bias_bound = sum_dims(max_dims(bias, Kdims), other_dims).item()
+        self.steps.append({**step, 'bias_bound': bias_bound})
+
+    def report(self):
+        return {
+            'bias_bound': sum(step['bias_bound'] for step in self.steps),
+            'steps': [{**step} for step in self.steps],
+        }
+
+
+def log_upper_bound(lps, K:Dim, Ks_to_sum):
+    """
+    Log of the upper bound on the contribution of each particle of K, retaining all the dims
+    that aren't summed over.
+    """
+    result = 0.
+    for lp in lps:
+        other_Ks = tuple(dim for dim in Ks_to_sum if dim is not K)
+        result = result + logsumexp_dims(lp, other_Ks, ignore_extra_dims=True)
+    return result
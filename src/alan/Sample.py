@@ -17,6 +17,10 @@ from .Marginals import Marginals
 from .ImportanceSample import ImportanceSample
 from .Split import Split, no_checkpoint, checkpoint
 from .moments import RawMoment, torchdim_moments_mixin, named_moments_mixin
+from .estimate import explain_reduction
+from .Prune import Prune
+from .conjugate import rao_blackwellise_plate
+from .kl import analytic_kl_plate
 
 
 class Sample():
@@ -50,49 +54,122 @@ class Sample():
     def all_platedims(self):
         return self.problem.all_platedims
 
-    def _elbo(self, extra_log_factors, split):
+    def _elbo(self, extra_log_factors, split, executor=None, reduce_dtype=None, prune=None, rao_blackwellise=False, analytic_kl=False):
         if extra_log_factors is None:
             extra_log_factors = empty_tree(self.P.plate)
         assert isinstance(extra_log_factors, dict)
 
+        P, Q = self.P.plate, self.Q.plate
+        if rao_blackwellise:
+            P, Q = rao_blackwellise_plate(P, Q)
+        if analytic_kl:
+            P = analytic_kl_plate(P, Q)
+
         lp = logPQ_plate(
             name=None,
-            P=self.P.plate, 
-            Q=self.Q.plate, 
+            P=P, 
+            Q=Q, 
             sample=self.sample,
             inputs_params=self.problem.inputs_params(),
             data=self.problem.data,
             extra_log_factors=extra_log_factors,
             scope={}, 
-            active_platedims=[],
+            active_platedims=[*self.problem.replicate_dims],
             all_platedims=self.all_platedims,
             groupvarname2Kdim=self.groupvarname2Kdim,
             sampling_type=self.sampling_type,
-            split=split)
+            split=split,
+            executor=executor,
+            reduce_dtype=reduce_dtype,
+            prune=prune)
+
+        #With replicates, returns a plain tensor with one ELBO for each run.
+        return generic_order(lp, self.problem.replicate_dims)
 
-        return lp
+    def _check_not_replicated(self, method):
+        if 0 < len(self.problem.replicate_dims):
+            raise Exception(f"{method} isn't supported for problems with replicates; use the ELBO methods, or a separate Problem for each run")
 
-    def elbo_vi(self, split=checkpoint):
+    def elbo_vi(self, split=checkpoint, executor=None, reduce_dtype=None, rao_blackwellise=False, analytic_kl=False):
+        """
+        executor is an optional `concurrent.futures.Executor` (e.g. a ThreadPoolExecutor), used
+        to evaluate sibling plates concurrently.
+
+        reduce_dtype is an optional low-precision dtype (t.bfloat16 or t.float16) used to store
+        the large intermediate tensors when summing over Ks, roughly halving their memory.
+        Sums are still accumulated in float32, and the error in the ELBO is typically below
+        `t.finfo(reduce_dtype).eps * abs(elbo)` (float16 is usually more accurate than bfloat16).
+
+        rao_blackwellise=True integrates out analytically any latent z with `z ~ Normal(...)` in P,
+        whose only dependent is data `x ~ Normal('z', scale)` in the same plate (see `conjugate.py`).
+        This removes z's K-dimension from the sum, and usually reduces the variance of the ELBO.
+        Q for z then gets no gradients.
+
+        analytic_kl=True replaces `log P(z_k) - log Q(z_k)` for each particle by `-KL(Q||P)`, computed
+        in closed form (using `torch.distributions.kl_divergence`), for any latent where P and Q are
+        from the same family and don't depend on other latents (see `kl.py`).  This lowers the
+        variance of the gradients for the parameters of Q.  At K=1, this is the usual ELBO with an
+        analytic KL term, but for larger K it isn't guaranteed to be a lower bound on the model
+        evidence, so it's best used for fitting Q, rather than comparing models.
+        """
         if not self.reparam==True:
             raise Exception("To compute the ELBO with the right gradients for VI you must construct a reparameterised sample using `problem.sample(K, reparam=True)`")
-        return self._elbo(extra_log_factors=None, split=split)
+        return self._elbo(extra_log_factors=None, split=split, executor=executor, reduce_dtype=reduce_dtype, rao_blackwellise=rao_blackwellise, analytic_kl=analytic_kl)
 
-    def elbo_rws(self, split=checkpoint):
+    def elbo_rws(self, split=checkpoint, executor=None, reduce_dtype=None, rao_blackwellise=False):
         if not self.reparam==False:
             raise Exception("To compute the ELBO with the right gradients for RWS you must construct a non-reparameterised sample using `problem.sample(K, reparam=False)`")
-        return self._elbo(extra_log_factors=None, split=split)
+        return self._elbo(extra_log_factors=None, split=split, executor=executor, reduce_dtype=reduce_dtype, rao_blackwellise=rao_blackwellise)
 
-    def elbo_nograd(self, split=checkpoint):
+    def elbo_nograd(self, split=checkpoint, executor=None, reduce_dtype=None, rao_blackwellise=False):
         if not self.reparam==False:
             raise Exception("elbo_nograd has no gradients, so you should construct a non-reparameterised sample using `problem.sample(K, reparam=False)`")
         with t.no_grad():
-            result = self._elbo(extra_log_factors=None, split=split)
+            result = self._elbo(extra_log_factors=None, split=split, executor=executor, reduce_dtype=reduce_dtype, rao_blackwellise=rao_blackwellise)
         return result
     
+    def elbo_pruned(self, top_k:Optional[int]=None, threshold:Optional[float]=None, split=checkpoint, executor=None):
+        """
+        ELBO where, before each contraction step when summing over Ks, we drop the particles
+        that carry a negligible part of the sum: we keep the top_k particles for each Kdim,
+        and/or those carrying at least a fraction threshold of the (upper bound on the) total.
+        This makes large K affordable when most particles have negligible weight.
+
+        The pruned ELBO is a lower bound on the full ELBO (`elbo_vi`/`elbo_rws`), and is
+        differentiable, with gradients for VI or RWS, depending on `reparam`.
+
+        Returns the pruned ELBO, along with a report (a dict) with:
+          `bias_bound`: upper bound on the full ELBO minus the pruned ELBO.
+          `elbo_upper`: pruned ELBO plus `bias_bound`, an upper bound on the full ELBO.
+          `steps`: for each contraction step, the Kdims summed, the number of particles kept for each
+            Kdim, and the bound on the bias introduced at that step.
+        """
+        self._check_not_replicated('elbo_pruned')
+        prune = Prune(self.groupvarname2Kdim.values(), top_k=top_k, threshold=threshold)
+        elbo = self._elbo(extra_log_factors=None, split=split, executor=executor, prune=prune)
+
+        #Report straight away, as checkpointed steps are recorded again in the backward pass.
+        report = prune.report()
+        report['elbo_upper'] = elbo.item() + report['bias_bound']
+        return elbo, report
+
+    def explain_reduction(self, threshold:int=10**8, split=checkpoint):
+        """
+        Prints, for each plate, the factors fed to `collect_lps`, the `opt_einsum` path, the Kdims summed at
+        each step and the intermediate at each step, flagging any step whose intermediate has more than
+        threshold elements.  Works from the dims alone, so it doesn't allocate any log-probabilities.
+
+        Returns a list of the flagged steps.
+        """
+        report, flagged = explain_reduction(self.problem, self.groupvarname2Kdim, split, threshold)
+        print(report)
+        return flagged
+
     def _importance_sample_idxs(self, num_samples:int, split):
         """
         User-facing method that returns reweighted samples.
         """
+        self._check_not_replicated("importance_sample")
 
         #extra_log_factors doesn't make sense for posterior sampling, but is required for
         #one of the internal methods.
@@ -141,6 +218,7 @@ class Sample():
         """
         Internal method that returns a flat dict mapping frozenset describing the K-dimensions in the marginal to a Tensor.
         """
+        self._check_not_replicated("marginals")
 
         for joint in joints:
             if not isinstance(joint, tuple):
@@ -224,6 +302,7 @@ class Sample():
         Must use split=NoCheckpoint, as there seems to be a subtle issue in the interaction between
         checkpointing and TorchDims (not sure why it doesn't emerge elsewhere...)
         """
+        self._check_not_replicated("moments")
         assert isinstance(moms, list)
 
         for (varnames, m) in moms:
@@ -1,3 +1,6 @@
+import math
+import functools
+
 from .utils import *
 from .TorchDimDist import TorchDimDist
 
@@ -62,7 +65,10 @@ class SamplingType:
     In particular:
 
     Permutation (permute the parent particles).
+    Cyclic/Affine (permute the parent particles, using a random cyclic shift or affine map mod K).
     Categorical (sample the parents from a uniform Categorical).
+    Stratified/Systematic (resample the parents using stratified/systematic resampling).
+    Independent (condition particle k on particle k of each parent).
 
     Thus, these classes modify sampling and computing for the approximate posterior.
     In particular, these classes implement:
@@ -79,6 +85,9 @@ class SamplingType:
     need a log prob with just var_Kdim.  So this method e.g. averages over combinations
     of parent particles (as appropriate) and returns a lp with just a var_Kdim, and no parent
     K-dimensions.
+
+    logQ_scope: This modifies the scope used to compute the raw lp for the approximate posterior.
+    By default, the scope is left alone, so the raw lp has all the parent K-dimensions.
     """
     
     @classmethod
@@ -98,7 +107,7 @@ class SamplingType:
 
             if var_Kdim is not None:
                 dims = set(generic_dims(tensor0))
-                perm = cls.perm(dims=dims, Kdim=var_Kdim)
+                perm = resize_perm(cls.perm(dims=dims, Kdim=var_Kdim), var_Kdim, Kdim)
 
                 for varname, tensor in varname2tensor.items():
                     #Permutation should have K as the first positional dimension, not as a torchdim!
@@ -110,6 +119,10 @@ class SamplingType:
         check_resample_dims(new_scope, active_platedims, Kdim)
         return new_scope
 
+    @classmethod
+    def logQ_scope(cls, scope: dict[str, Tensor], active_platedims: list[Dim], Kdim: Dim):
+        return scope
+
     @staticmethod
     def reduce_logQ(lp: Tensor, active_platedims: list[Dim], Kdim: Dim):
         """
@@ -141,6 +154,87 @@ class PermutationSampler(SamplingType):
         tdd = TorchDimDist(td.uniform.Uniform, low=0, high=1)
         return tdd.sample(False, sample_dims=[*dims], sample_shape=[]).argsort(Kdim).order(Kdim)
     
+class CyclicSampler(SamplingType):
+    """
+    A mixture proposal, where we permute the particles on all the parents using a random cyclic
+    shift, k -> (k + b) mod K, with b uniform for each plate element.  The shift is drawn from a
+    single random integer, so generating the permutation is O(K) (rather than the O(K log K)
+    argsort in PermutationSampler).  Each particle's parent is still uniform, so the estimator is
+    unbiased, but the permutations are less diverse than in PermutationSampler.
+    """
+    @staticmethod
+    def perm(dims:set[Dim], Kdim:Dim):
+        assert isinstance(dims, set)
+        assert isinstance(Kdim, Dim)
+        b = uniform_int(Kdim.size, dims, Kdim)
+        return (t.arange(Kdim.size) + b) % Kdim.size
+
+class AffineSampler(SamplingType):
+    """
+    A mixture proposal, where we permute the particles on all the parents using a random affine
+    map, k -> (a k + b) mod K, with a uniform over the integers coprime to K (so the map is a
+    permutation), and b uniform, for each plate element.  Like CyclicSampler, generating the
+    permutation is O(K), but the permutations are more diverse.
+    """
+    @staticmethod
+    def perm(dims:set[Dim], Kdim:Dim):
+        assert isinstance(dims, set)
+        assert isinstance(Kdim, Dim)
+        units = coprimes(Kdim.size)
+        a = units[uniform_int(len(units), dims, Kdim)]
+        b = uniform_int(Kdim.size, dims, Kdim)
+        return (a * t.arange(Kdim.size) + b) % Kdim.size
+
+def uniform_int(high:int, dims:set[Dim], Kdim:Dim):
+    """
+    Uniform integers in [0, high), with all the dims in dims except Kdim.
+    """
+    tdd = TorchDimDist(td.categorical.Categorical, probs=t.ones(high)/high)
+    platedims = [dim for dim in dims if dim is not Kdim]
+    return tdd.sample(False, sample_dims=platedims, sample_shape=[])
+
+@functools.cache
+def coprimes(K:int):
+    return t.tensor([a for a in range(K) if math.gcd(a, K) == 1])
+
+class IndependentSampler(SamplingType):
+    """
+    A proposal where particle k of each latent variable is conditioned on particle k of each parent
+    (i.e. there's no permuting or resampling of the parent particles).  As this is the distribution
+    the particles are actually sampled from, the log-prob for the approximate posterior is evaluated
+    with the parent particles aligned in the same way, so it never has any parent K-dimensions, and
+    there's no averaging over them.  The cheapest sampling type, but usually higher-variance than
+    the mixture proposals.
+    """
+    @classmethod
+    def resample_scope(cls, scope: dict[str, Tensor], active_platedims: list[Dim], Kdim: Dim):
+        new_scope = {}
+        for var_Kdim, varname2tensor in Kdim2varname2tensors(scope, active_platedims).items():
+            for varname, tensor in varname2tensor.items():
+                if var_Kdim is None:
+                    new_scope[varname] = tensor
+                elif var_Kdim.size == Kdim.size:
+                    #Just renames var_Kdim to Kdim; no copying.
+                    new_scope[varname] = tensor.order(var_Kdim)[Kdim]
+                else:
+                    #With a different K for the parent, particle k is conditioned on parent particle k mod K_parent.
+                    new_scope[varname] = tensor.order(var_Kdim)[t.arange(Kdim.size) % var_Kdim.size][Kdim]
+
+        check_resample_dims(new_scope, active_platedims, Kdim)
+        return new_scope
+
+    @classmethod
+    def logQ_scope(cls, scope: dict[str, Tensor], active_platedims: list[Dim], Kdim: Dim):
+        return cls.resample_scope(scope, active_platedims, Kdim)
+
+    @staticmethod
+    def reduce_logQ(lp: Tensor, active_platedims: list[Dim], Kdim: Dim):
+        assert set(generic_dims(lp)).issubset([Kdim, *active_platedims])
+        return lp
+
+#Name used in earlier versions (and the examples).
+IndependentSample = IndependentSampler
+
 class CategoricalSampler(SamplingType):
     """
     A mixture proposal, where we resample the particles on the parents using a uniform Categorical.
@@ -150,6 +244,57 @@ class CategoricalSampler(SamplingType):
         assert isinstance(dims, set)
         assert isinstance(Kdim, Dim)
         tdd = TorchDimDist(td.categorical.Categorical, probs=t.ones(Kdim.size)/Kdim.size)
-        platedims = list(dims)
-        platedims.remove(Kdim)
+        #Compare Dims with `is`, as `==` on Dims gives a tensor.
+        platedims = [dim for dim in dims if dim is not Kdim]
         return tdd.sample(False, sample_dims=platedims, sample_shape=[Kdim.size])
+
+class StratifiedSampler(SamplingType):
+    """
+    A mixture proposal, where we resample the particles on the parents using stratified resampling.
+    The parents all have equal weight, so we put them on a circle of circumference K, rotated by a
+    uniform offset c in [0, K), and draw the parent for particle k uniformly from the stratum
+    [k + c, k + c + 1).  Each parent is drawn 0, 1 or 2 times (rather than Binomial(K, 1/K) times as
+    in CategoricalSampler), while the parent for each particle is still uniform, so the estimator
+    is unbiased.
+    """
+    @staticmethod
+    def perm(dims:set[Dim], Kdim:Dim):
+        assert isinstance(dims, set)
+        assert isinstance(Kdim, Dim)
+        c = uniform_offset(dims, Kdim)
+        u = uniform(dims, Kdim, sample_shape=[Kdim.size])
+        return (t.arange(Kdim.size) + c + u).floor().long() % Kdim.size
+
+class SystematicSampler(CyclicSampler):
+    """
+    Systematic resampling of the parents.  As in StratifiedSampler, the parents are on a circle with
+    a uniform offset, but systematic resampling uses the same point within every stratum.  As the
+    parents all have equal weight, each parent is drawn exactly once, and the result is exactly a
+    uniformly random cyclic shift of the parents, so this is just CyclicSampler under another name.
+    """
+    pass
+
+def uniform(dims:set[Dim], Kdim:Dim, sample_shape:list[int]):
+    """
+    Uniform samples in [0, 1), with all the dims in dims except Kdim.
+    """
+    tdd = TorchDimDist(td.uniform.Uniform, low=0, high=1)
+    platedims = [dim for dim in dims if dim is not Kdim]
+    return tdd.sample(False, sample_dims=platedims, sample_shape=sample_shape)
+
+def uniform_offset(dims:set[Dim], Kdim:Dim):
+    """
+    Uniform offset in [0, K) around the circle of parents.
+    """
+    return Kdim.size * uniform(dims, Kdim, sample_shape=[])
+
+def resize_perm(perm: Tensor, var_Kdim: Dim, Kdim: Dim):
+    """
+    perm gives the parent particle (from var_Kdim) for each of the var_Kdim.size new particles.  If the
+    new variable has a different K (i.e. Kdim.size != var_Kdim.size), particle k uses perm[k mod K_parent],
+    so each particle's parent is still uniform over the parent particles (which is all the mixture in
+    reduce_logQ needs).
+    """
+    if var_Kdim.size == Kdim.size:
+        return perm
+    return perm[t.arange(Kdim.size) % var_Kdim.size]
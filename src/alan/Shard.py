@@ -0,0 +1,106 @@
+import torch as t
+import torch.distributed as dist
+
+from .utils import *
+from .Split import Split, SplitDims
+
+
+class Shard(Split):
+    """
+    Data-parallel computation of the ELBO across processes using `torch.distributed`.
+
+    Each rank owns a contiguous shard of the plate `platename`, and only computes the
+    log-probabilities for its own shard.  The reduced factor for the plate (which has
+    K-dimensions for the global latents, but no plate dimension) is summed across ranks
+    using an all-reduce, so every rank ends up with the same, full ELBO.
+
+    Used in place of a split, e.g. `sample.elbo_vi(split=Shard('plate_ID'))`.
+
+    For this to make sense:
+    * the process group must already be initialized (e.g. with the gloo backend on CPU),
+    * every rank must draw the same sample, which is achieved by calling `sync_seed()`
+      once on every rank before sampling (every rank samples the full Q, and only the
+      evaluation of the log-probabilities is sharded),
+    * after calling `.backward()`, gradients must be averaged across ranks using
+      `all_reduce_grads(problem)`.
+
+    The gradient of the shard's contribution is scaled by world_size, so that after averaging
+    gradients across ranks we get the exact gradient of the full ELBO.
+    """
+    def __init__(self, platename:str, rank=None, world_size=None):
+        assert isinstance(platename, str)
+
+        self.platename = platename
+        self.rank       = dist.get_rank()       if rank       is None else rank
+        self.world_size = dist.get_world_size() if world_size is None else world_size
+
+        assert 0 <= self.rank < self.world_size
+
+    def splitdims(self, all_platedims):
+        return ShardDims(self, all_platedims)
+
+    def split_args(self, name, sample, inputs_params, extra_log_factors, data, all_platedims):
+        result = super().split_args(name, sample, inputs_params, extra_log_factors, data, all_platedims)
+        if self.platename == name:
+            result = [result[self.rank]]
+        return result
+
+    def combine_lps(self, name, lps):
+        lp = sum(lps)
+
+        if self.platename == name:
+            dims = generic_dims(lp)
+            total = generic_order(lp.detach(), dims).contiguous()
+            dist.all_reduce(total, op=dist.ReduceOp.SUM)
+            total = generic_getitem(total, dims)
+
+            #Value is the total across all shards, while gradients only flow
+            #through (world_size times) the local shard.
+            lp = total + self.world_size * (lp - lp.detach())
+
+        return lp
+
+
+class ShardDims(SplitDims):
+    def __init__(self, shard: Shard, all_platedims:dict[str, Dim]):
+        self.split = shard
+
+        self.orig_dim = all_platedims[shard.platename]
+        orig_size = self.orig_dim.size
+        world_size = shard.world_size
+
+        if orig_size < world_size:
+            raise Exception(f"Can't shard plate {shard.platename} of size {orig_size} across {world_size} ranks")
+
+        #Contiguous shards, with the first orig_size % world_size shards one bigger than the rest.
+        self.split_sizes = [orig_size//world_size + (1 if i < orig_size%world_size else 0) for i in range(world_size)]
+        self.split_dims = [Dim(f'{shard.platename}_shard_{i}', self.split_sizes[i]) for i in range(world_size)]
+        self.split_all_platedimss = [{**all_platedims, shard.platename: dim} for dim in self.split_dims]
+
+
+def sync_seed(seed=None):
+    """
+    Seeds the random number generator with the same seed on every rank (the seed is chosen
+    on rank 0, and broadcast to the other ranks).  As every rank samples the full Q in
+    exactly the same way, this keeps the samples in sync across ranks for all future samples.
+    """
+    if seed is None:
+        seed = int(t.randint(2**62, ()))
+    seed = t.tensor(seed, dtype=t.int64)
+    dist.broadcast(seed, src=0)
+    seed = seed.item()
+    t.manual_seed(seed)
+    return seed
+
+def all_reduce_grads(module):
+    """
+    Averages the gradients of all parameters in module (e.g. a Problem) across ranks.
+    Parameters without a gradient are treated as having a zero gradient, so that every
+    rank takes part in the same collectives.
+    """
+    world_size = dist.get_world_size()
+    for param in module.parameters():
+        if param.grad is None:
+            param.grad = t.zeros_like(param)
+        dist.all_reduce(param.grad, op=dist.ReduceOp.SUM)
+        param.grad.div_(world_size)
@@ -0,0 +1,156 @@
+import torch as t
+
+from typing import Optional
+from .dist import Dist
+from .utils import *
+from .SamplingType import SamplingType
+from .Profiler import profiled
+
+class Timeseries():
+    """
+    A Markov chain over the time steps in the enclosing plate, e.g.
+
+    ```
+    P = Plate(
+        x_init = Normal(0, 1),
+        T = Plate(
+            x = Timeseries('x_init', Normal(lambda x: 0.9*x, 0.3)),
+            y = Normal('x', 1.),
+        ),
+    )
+    ```
+
+    The transition refers to the previous time step using the name of the Timeseries variable itself
+    (here `x`), and `init` is the name of the variable (or input/parameter) used as the "previous"
+    value for the first time step.
+
+    The plate dimension for the enclosing plate is the time dimension.  Elements of a plate are usually
+    exchangeable, so the only other things allowed in that plate are data and child plates (not other
+    latent variables).
+
+    We sample sequentially, with K particles at each time step.  Rather than having a separate K-dimension
+    for each time step (which `reduce_Ks` would need to sum over jointly), the K-dimension is shared across
+    time steps, and we sum over the particles at each time step sequentially (see `reduce_timeseries`),
+    which is O(T K^2).
+    """
+    def __init__(self, init:str, transition:Dist):
+        if not isinstance(init, str):
+            raise Exception(f"init for a Timeseries should be the name of a variable, input or parameter, but is actually {type(init)}")
+        if not isinstance(transition, Dist):
+            raise Exception(f"transition for a Timeseries should be a Dist, but is actually {type(transition)}")
+        if transition.enumerate:
+            raise Exception("The transition for a Timeseries can't be enumerated")
+
+        self.init = init
+        self.transition = transition
+        self.enumerate = False
+        self.all_args = list(set([init, *transition.all_args]))
+
+    def Kdim_size(self, K:int):
+        return K
+
+    def filter_scope(self, scope: dict[str, Tensor]):
+        #Only looks up the arguments, rather than iterating through the whole scope.
+        return {k: scope[k] for k in self.all_args if k in scope}
+
+    def initial_scope(self, name:str, scope: dict[str, Tensor], Tdim:Dim):
+        """
+        Scope for the transition at the first time step, with `init` as the previous value of the timeseries.
+        """
+        scope = {k: index_time(v, Tdim, 0) for (k, v) in self.filter_scope(scope).items()}
+        scope[name] = scope[self.init]
+        return scope
+
+    def transition_scope(self, name:str, scope: dict[str, Tensor], sample:Tensor, Tdim:Dim, Kdim:Dim, Kprev:Dim):
+        """
+        Scope for the transition at all time steps, with the sample for the previous time step, which
+        has Kprev rather than Kdim as its K-dimension.  The previous value is rolled around, so it's
+        garbage for the first time step, which must be ignored.
+        """
+        scope = self.filter_scope(scope)
+        scope[name] = sample.order(Tdim).roll(1, 0)[Tdim].order(Kdim)[Kprev]
+        return scope
+
+    @profiled('sample', 'Timeseries')
+    def sample(
+            self,
+            name:Optional[str],
+            scope: dict[str, Tensor],
+            inputs_params: dict,
+            active_platedims:list[Dim],
+            all_platedims:dict[str, Dim],
+            groupvarname2Kdim:dict[str, Dim],
+            sampling_type:SamplingType,
+            reparam:bool,
+            device:t.device,
+            qmc:bool,
+            antithetic:bool,
+            ):
+
+        Tdim = active_platedims[-1]
+        scope = self.filter_scope(scope)
+
+        samples = []
+        prev = index_time(scope[self.init], Tdim, 0)
+        for time in range(Tdim.size):
+            time_scope = {k: index_time(v, Tdim, time) for (k, v) in scope.items()}
+            time_scope[name] = prev
+
+            #At each time step, the parents (including the previous time step) are resampled as usual.
+            prev = self.transition.sample(
+                name=name,
+                scope=time_scope,
+                inputs_params=None,
+                active_platedims=active_platedims[:-1],
+                all_platedims=all_platedims,
+                groupvarname2Kdim=groupvarname2Kdim,
+                sampling_type=sampling_type,
+                reparam=reparam,
+                device=device,
+                qmc=qmc,
+                antithetic=antithetic,
+            )
+            samples.append(prev)
+
+        return stack_time(samples, Tdim)
+
+    def sample_extended(self, *args, **kwargs):
+        raise Exception("Extending samples isn't yet implemented for Timeseries")
+
+    def predictive_ll(self, *args, **kwargs):
+        raise Exception("Predictive log-likelihoods aren't yet implemented for Timeseries")
+
+
+class TimeseriesFactor():
+    """
+    The log-probability factor for a Timeseries, returned by `logPQ_timeseries`.
+
+    f0 is the factor for the first time step (with Kdim, but no time dimension), while frest
+    has the time dimension, along with Kdim for the current time step and Kprev for the
+    previous time step (frest for the first time step is garbage, and is ignored).
+    """
+    def __init__(self, f0:Tensor, frest:Tensor, Kdim:Dim, Kprev:Dim):
+        self.f0 = f0
+        self.frest = frest
+        self.Kdim = Kdim
+        self.Kprev = Kprev
+
+    def map(self, f):
+        return TimeseriesFactor(f(self.f0), f(self.frest), self.Kdim, self.Kprev)
+
+
+def index_time(x, Tdim:Dim, time:int):
+    """
+    Picks out a single time step from x, if x has a time dimension.
+    """
+    if Tdim in set(generic_dims(x)):
+        return x.order(Tdim)[time]
+    else:
+        return x
+
+def stack_time(xs:list[Tensor], Tdim:Dim):
+    """
+    Stacks a list of tensors, one for each time step, along the time dimension.
+    """
+    dims = generic_dims(xs[0])
+    return generic_getitem(t.stack([generic_order(x, dims) for x in xs]), [Tdim, *dims])
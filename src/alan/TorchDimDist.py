@@ -1,11 +1,33 @@
+import math
+from typing import Optional
+
 import torch as t
 import torch.distributions as td
 import functorch.dim
 from functorch.dim import Dim
 
 from .utils import *
+from .kernels import log_prob_kernels, rsample_kernels, get_kernel
 Tensor = (t.Tensor, functorch.dim.Tensor)
 
+#If False, the underlying PyTorch distributions skip validating their arguments (and samples),
+#and we use the hand-written kernels in `kernels.py`, where available.
+validate_args = True
+
+def set_default_validate_args(value:bool):
+    """
+    Turns argument validation on (the default) or off for all distributions.
+
+    Constructing a `torch.distributions` object (broadcasting the arguments and checking the
+    constraints) can dominate the cost of sampling/computing log-probs at small K.  With validation
+    off, Normal, Bernoulli, Binomial, Gamma, Poisson and MultivariateNormal use hand-written
+    log_prob (and for Normal/MultivariateNormal, rsample) kernels that never construct a
+    `torch.distributions` object, and other distributions are constructed with `validate_args=False`.
+    Invalid parameters (e.g. a negative scale) then give NaNs rather than an error.
+    """
+    global validate_args
+    validate_args = value
+
 
 def colons(n: int):
     return n*[slice(None)]
@@ -36,8 +58,8 @@ class TorchDimDist():
         """
         self.dist = dist
         self.kwargs_torchdim = kwargs
-        #List of torchdims in arguments
-        self.all_arg_dims = unify_dims(self.kwargs_torchdim.values())
+        #List of torchdims in arguments, in the canonical layout (see `canonical_dims`).
+        self.all_arg_dims = canonical_dims(unify_dims(self.kwargs_torchdim.values()))
         self.set_all_arg_dims = set(self.all_arg_dims)
 
         #Extract the dimension of the events and arguments from the underlying PyTorch distribution.
@@ -50,42 +72,41 @@ class TorchDimDist():
         self.arg_batch_ndim = {arg: generic_ndim(self.kwargs_torchdim[arg]) - self.arg_event_ndim[arg] for arg in kwargs}
         self.sample_batch_ndim = max(self.arg_batch_ndim.values())
 
-        # Distribution constructed with arguments of shape:
-        # [batch_shape, all_arg_dims, event_shape]
-        # not that all_arg_dims is shared for all args, while the batch shape could be different.
+        self.validate_args = validate_args
+        if self.validate_args:
+            self.log_prob_kernel = None
+            self.rsample_kernel = None
+        else:
+            self.log_prob_kernel = get_kernel(log_prob_kernels, dist, kwargs.keys())
+            self.rsample_kernel = get_kernel(rsample_kernels, dist, kwargs.keys())
 
-        self.kwargs_tensor = {}
+    def kwargs_tensor(self, dims:list[Dim]):
+        """
+        The arguments as plain tensors, with shape:
+        [*dims, *batch_shape, *event_shape]
+        where dims is in the canonical layout, and must include all_arg_dims.  Dims (and leading batch
+        dimensions) that aren't on an argument are singletons, so all the arguments broadcast.  If the
+        argument is already in the canonical layout, this is just a view.
+        """
+        result = {}
         for name, arg_torchdim in self.kwargs_torchdim.items():
-            dims = [
-                *colons(self.arg_batch_ndim[name]), 
-                *self.all_arg_dims, 
+            if isinstance(arg_torchdim, Number):
+                #Broadcasts against anything.
+                result[name] = arg_torchdim
+                continue
+            result[name] = ultimate_order(arg_torchdim, [
+                *dims,
+                *((self.sample_batch_ndim - self.arg_batch_ndim[name])*[None]),
+                *colons(self.arg_batch_ndim[name]),
                 *colons(self.arg_event_ndim[name]),
-            ]
-            self.kwargs_tensor[name] = ultimate_order(arg_torchdim, dims)
-
-        self.dist_tensor = self.dist(**self.kwargs_tensor)
-
-        self.batch_arg_event_dims = [
-            *colons(self.sample_batch_ndim),  # batch_shape
-            *self.all_arg_dims,               # all_arg_dims
-            *colons(self.sample_event_ndim),   # event_shape
-        ]
-
-        self.batch_arg_dims = [
-            *colons(self.sample_batch_ndim),  # batch_shape
-            *self.all_arg_dims,               # all_arg_dims
-        ]
-
-    def extra_dims(self, sample_dims:list[Dim]):
-        #Check that all the dimensions in sample_dims are unique.
-        assert_unique_dim_iter(sample_dims, 'sample_dims')
-
-        #Split sample_dims into extra dimensions and dimensions in sample_dims.
-        extra_dims = list(set(sample_dims).difference(self.set_all_arg_dims))
+            ])
+        return result
 
-        return extra_dims
+    def dist_tensor(self, kwargs_tensor:dict):
+        #Without validation, only constructed if we don't have a kernel for what we're doing.
+        return self.dist(**kwargs_tensor, validate_args=None if self.validate_args else False)
 
-    def sample(self, reparam: bool, sample_dims: list[Dim], sample_shape):
+    def sample(self, reparam: bool, sample_dims: list[Dim], sample_shape, noise_dim:Optional[Dim]=None, qmc:bool=False, antithetic:bool=False):
         r"""
         Samples, making sure the resulting sample has all the dims in sample_dims, 
         and has the unnamed shape from self.sample_shape.
@@ -95,45 +116,68 @@ class TorchDimDist():
             sample_dims: _all_ TorchDim dimensions in the resulting samples (not just the extra dims)
                          should include all the dims in the input.
             sample_shape: unnamed/integer extra samples.
-
-        Returns:
-            sample (torchdim Tensor): sample with correct dimensions
+            noise_dim: optional dim in sample_dims (usually the K-dimension), along which qmc and
+                       antithetic apply.
+            qmc: for the location-scale families in `location_scale_dists`, the base noise is drawn
+                 from a scrambled Sobol sequence along noise_dim (see `qmc_noise`).
+            antithetic: for the location-scale families in `location_scale_dists`, the second half
+                        of noise_dim uses the mirrored base noise from the first half.
+            Other distributions ignore noise_dim, qmc and antithetic.
         """
+        #Check that all the dimensions in sample_dims are unique.
+        assert_unique_dim_iter(sample_dims, 'sample_dims')
         #Check that all the torchdims on the arguments are in sample_dims.
         assert set(self.set_all_arg_dims).issubset(sample_dims)
 
         if reparam and not self.dist.has_rsample:
             raise Exception(f'Trying to do reparameterised sampling of {type(self.dist)}, which is not implemented by PyTorch (likely because {type(self.dist)} is a distribution over discrete random variables).')
 
-        extra_dims = self.extra_dims(sample_dims)
-        assert set(sample_dims) == self.set_all_arg_dims.union(extra_dims)
-        extra_shape = [esd.size for esd in extra_dims]
-
-        sample_method = getattr(self.dist_tensor, "rsample" if reparam else "sample")
-
-        #[*sample_shape, *extra_shape, *batch_shape, *all_arg_shape, *event_shape]
-        sample_tensor = sample_method(sample_shape=[*sample_shape, *extra_shape])
-
+        #The sample is laid out as:
+        #[*sample_shape, *sample_dims (canonical layout), *batch_shape, *event_shape]
+        sample_dims = canonical_dims(sample_dims)
+        dims_shape = [dim.size for dim in sample_dims]
         dims = [
-            *colons(len(sample_shape)), # sample_shape
-            *extra_dims,                # extra_dims
-            *self.batch_arg_event_dims, # everythin else
+            *colons(len(sample_shape)),
+            *sample_dims,
+            *colons(self.sample_batch_ndim + self.sample_event_ndim),
         ]
+
+        #The arguments have singleton dimensions for dims that are only on the sample.  We only expand
+        #these after constructing the PyTorch distribution, so any validation is only done on the
+        #original arguments.
+        kwargs_tensor = self.kwargs_tensor(sample_dims)
+        if (noise_dim is not None) and (qmc or antithetic) and (self.dist in location_scale_dists):
+            #Position of noise_dim in the underlying tensor.
+            noise_idx = next(i for (i, dim) in enumerate(dims) if dim is noise_dim)
+            sample_tensor = location_scale_sample(expand_dist(self.dist_tensor(kwargs_tensor), dims_shape), sample_shape, noise_idx, qmc, antithetic)
+            if not reparam:
+                sample_tensor = sample_tensor.detach()
+        elif self.rsample_kernel is not None:
+            batch_shape = [*dims_shape, *(self.sample_batch_ndim*[1])]
+            sample_tensor = self.rsample_kernel(sample_shape, batch_shape, **kwargs_tensor)
+            if not reparam:
+                sample_tensor = sample_tensor.detach()
+        else:
+            dist_tensor = expand_dist(self.dist_tensor(kwargs_tensor), dims_shape)
+            sample_method = getattr(dist_tensor, "rsample" if reparam else "sample")
+            sample_tensor = sample_method(sample_shape=sample_shape)
+
         return generic_getitem(sample_tensor, dims)
 
     def log_prob(self, x):
         """
         This is subtle, because args can have lots of K-dimensions that aren't on x.
-        Therefore, we use singleton_order, which gives singleton dimensions in x_tensor
-        for dimensions that are in args, but not x.
+        Therefore, we use ultimate_order, which gives singleton dimensions in x_tensor
+        for dimensions that are in args, but not x (and vice versa).
 
         Remember that x comes in as a torchdim tensor with positional dims:
         [*sample_shape, *batch_shape, *event_shape]
+        and, if x came from `sample`, its torchdims are already in the canonical layout.
         """
         assert isinstance(x, Tensor)
 
-        sample_dims = generic_dims(x)  #Extra dims + a subset of all_arg_dims.
-        extra_dims = self.extra_dims(sample_dims)
+        #Dims on x or the args, in the canonical layout.
+        dims = canonical_dims(ordered_unique([*generic_dims(x), *self.all_arg_dims]))
 
         batch_ndim = self.sample_batch_ndim
         event_ndim = self.sample_event_ndim
@@ -141,19 +185,110 @@ class TorchDimDist():
 
         x_dims = [
             *colons(sample_ndim),
-            *extra_dims,
-            *self.batch_arg_event_dims,
+            *dims,
+            *colons(batch_ndim + event_ndim),
         ]
 
         lp_dims = [
             *colons(sample_ndim),
-            *extra_dims,
-            *self.batch_arg_dims,
+            *dims,
+            *colons(batch_ndim),
         ]
 
         x_tensor = ultimate_order(x, x_dims)
-        lp_tensor = self.dist_tensor.log_prob(x_tensor)
+        kwargs_tensor = self.kwargs_tensor(dims)
+        if self.log_prob_kernel is not None:
+            lp_tensor = self.log_prob_kernel(x_tensor, **kwargs_tensor)
+        else:
+            lp_tensor = self.dist_tensor(kwargs_tensor).log_prob(x_tensor)
         
         lp = generic_getitem(lp_tensor, lp_dims)
 
         return sum_non_dim(lp)
+
+
+def expand_dist(dist, dims_shape:list[int]):
+    """
+    Expands the leading batch dimensions of dist (corresponding to torchdims) to dims_shape.
+    """
+    return dist.expand([*dims_shape, *dist.batch_shape[len(dims_shape):]])
+
+
+#Location-scale families (with symmetric base noise) for which we can draw the base noise using
+#QMC, or in antithetic pairs.
+location_scale_dists = [td.Normal, td.LogNormal, td.StudentT]
+
+#SobolEngine supports at most this many dimensions.
+max_sobol_dim = t.quasirandom.SobolEngine.MAXDIM
+
+def qmc_noise(shape, qmc_idx:int, device):
+    """
+    Standard normal noise with the given shape, where the points along dimension qmc_idx are
+    the inverse-CDF transform of a scrambled Sobol sequence, with a separate dimension of the
+    Sobol sequence for every element of the other dimensions.  Scrambling makes each point
+    uniform, so estimators using this noise are still unbiased, but points are spread out more
+    evenly along qmc_idx than i.i.d. noise.
+    """
+    K = shape[qmc_idx]
+    other_shape = [*shape[:qmc_idx], *shape[qmc_idx+1:]]
+    D = math.prod(other_shape)
+
+    #Independent scrambles for each block of at most max_sobol_dim dimensions.  Seeded from
+    #torch's global RNG, so `t.manual_seed` makes the result reproducible.
+    blocks = []
+    for start in range(0, D, max_sobol_dim):
+        seed = t.randint(2**62, ()).item()
+        engine = t.quasirandom.SobolEngine(min(max_sobol_dim, D - start), scramble=True, seed=seed)
+        blocks.append(engine.draw(K, dtype=t.get_default_dtype()))
+    u = t.cat(blocks, -1) if 0 < len(blocks) else t.zeros(K, 0)
+
+    #Keep away from 0 and 1, where the inverse-CDF is infinite.
+    eps = t.finfo(u.dtype).eps
+    z = t.special.ndtri(u.clamp(eps, 1-eps)).to(device=device)
+    return z.reshape(K, *other_shape).movedim(0, qmc_idx)
+
+def base_noise(shape, noise_idx:int, device, qmc:bool, antithetic:bool):
+    """
+    Standard normal noise with the given shape.  If antithetic, the second half along noise_idx
+    is the mirrored noise for the first half (if the size is odd, the last particle is unpaired).
+    Each particle is still marginally standard normal, so estimators (which sum over particles)
+    are still unbiased, and reduce_logQ and reduce_Ks don't need to treat the pairs differently.
+    """
+    K = shape[noise_idx]
+    if antithetic:
+        shape = [*shape[:noise_idx], (K+1)//2, *shape[noise_idx+1:]]
+
+    z = qmc_noise(shape, noise_idx, device) if qmc else t.randn(shape, device=device)
+
+    if antithetic:
+        z = mirror(z, noise_idx, K, -1)
+    return z
+
+def mirror(x, idx:int, K:int, sign:int):
+    """
+    Takes x with (K+1)//2 elements along idx, and returns the first K//2 elements, followed by sign
+    times the first K//2 elements and (if K is odd) the unpaired last element.
+    """
+    half = x.narrow(idx, 0, K//2)
+    return t.cat([half, sign*half, x.narrow(idx, K//2, K%2)], idx)
+
+def location_scale_sample(dist, sample_shape, noise_idx:int, qmc:bool, antithetic:bool):
+    """
+    Reparameterised sample from dist (in `location_scale_dists`) using `base_noise`.
+    """
+    shape = dist._extended_shape(sample_shape)
+
+    if isinstance(dist, td.LogNormal):
+        z = base_noise(shape, noise_idx, dist.base_dist.loc.device, qmc, antithetic)
+        return (dist.base_dist.loc + dist.base_dist.scale * z).exp()
+
+    z = base_noise(shape, noise_idx, dist.loc.device, qmc, antithetic)
+    if isinstance(dist, td.StudentT):
+        #Only the Gaussian part of the noise is QMC; the chi-squared mixing variable is i.i.d.
+        #For antithetic pairs, both particles share the chi-squared variable, so they're mirrored.
+        chi2 = td.Chi2(dist.df).rsample(sample_shape)
+        if antithetic:
+            K = shape[noise_idx]
+            chi2 = mirror(chi2.narrow(noise_idx, 0, (K+1)//2), noise_idx, K, 1)
+        z = z * (dist.df / chi2).sqrt()
+    return dist.loc + dist.scale * z
@@ -1,10 +1,77 @@
-from .Plate import Plate
-from .SamplingType import CategoricalSampler, PermutationSampler
-sampling_types = [CategoricalSampler, PermutationSampler]
-from .dist import *
-from .BoundPlate import BoundPlate
-from .Problem import Problem
-from .Group import Group
-from .Data import Data
-from .moments import mean, mean2, var
-from .Split import Split, no_checkpoint, checkpoint
+import sys
+import types
+import importlib
+import importlib.util
+
+#Everything is imported lazily (PEP 562), when it's first used, so `import alan` doesn't pay for
+#importing PyTorch, functorch.dim and opt_einsum, or for creating all the distributions (e.g. in CLI
+#tools, or worker processes that don't need everything).  Maps each attribute to the submodule that
+#defines it.  Distributions (and anything else defined in `dist`) are looked up in `dist`.
+lazy_attrs = {
+    'Plate': '.Plate',
+    'CategoricalSampler': '.SamplingType',
+    'PermutationSampler': '.SamplingType',
+    'CyclicSampler': '.SamplingType',
+    'AffineSampler': '.SamplingType',
+    'StratifiedSampler': '.SamplingType',
+    'SystematicSampler': '.SamplingType',
+    'IndependentSampler': '.SamplingType',
+    'IndependentSample': '.SamplingType',
+    'set_default_validate_args': '.TorchDimDist',
+    'BoundPlate': '.BoundPlate',
+    'Problem': '.Problem',
+    'Group': '.Group',
+    'Timeseries': '.Timeseries',
+    'Data': '.Data',
+    'mean': '.moments',
+    'mean2': '.moments',
+    'var': '.moments',
+    'Split': '.Split',
+    'no_checkpoint': '.Split',
+    'checkpoint': '.Split',
+    'Shard': '.Shard',
+    'sync_seed': '.Shard',
+    'all_reduce_grads': '.Shard',
+    'profile': '.Profiler',
+    'Profiler': '.Profiler',
+}
+
+#SystematicSampler isn't included, as it's the same as CyclicSampler.
+sampling_type_names = ['CategoricalSampler', 'PermutationSampler', 'CyclicSampler', 'AffineSampler', 'StratifiedSampler']
+
+def __getattr__(name):
+    if name in lazy_attrs:
+        value = getattr(importlib.import_module(lazy_attrs[name], __name__), name)
+    elif name == 'sampling_types':
+        value = [__getattr__(sampling_type_name) for sampling_type_name in sampling_type_names]
+    elif name == '__all__':
+        #For `from alan import *`, which also exports everything in `dist`.
+        dist = importlib.import_module('.dist', __name__)
+        return [*lazy_attrs, 'sampling_types', *(k for k in vars(dist) if not k.startswith('_'))]
+    elif name.startswith('__'):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    elif importlib.util.find_spec(f'{__name__}.{name}') is not None:
+        #Submodules, e.g. `alan.utils`.
+        return importlib.import_module(f'.{name}', __name__)
+    else:
+        dist = importlib.import_module('.dist', __name__)
+        if not hasattr(dist, name):
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        value = getattr(dist, name)
+
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set([*globals(), *lazy_attrs, 'sampling_types']))
+
+
+class LazyModule(types.ModuleType):
+    def __setattr__(self, name, value):
+        #Importing a submodule (e.g. `alan.Plate`) binds it as an attribute of the package, which would
+        #shadow the class with the same name.
+        if isinstance(value, types.ModuleType) and (name in lazy_attrs):
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = LazyModule
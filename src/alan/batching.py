@@ -0,0 +1,171 @@
+import math
+
+from .utils import *
+from .dist import Dist, convert_device_dtype
+from .Group import Group
+from .TorchDimDist import TorchDimDist
+from .Profiler import profiled
+
+
+#Siblings of the same family (e.g. lots of `Normal(0, 1)` priors in the same plate) are sampled and
+#scored with a single TorchDimDist, with the parameters stacked along an extra torchdim, rather than
+#one TorchDimDist for each variable.  Batching only applies to siblings whose parameters don't depend
+#on anything else in the plate (so they can all be sampled at once, at the first variable in the batch),
+#and only goes ahead if, at runtime, all the parameters have the same shape and dims, and don't have
+#any K-dimensions (i.e. they're constants, inputs or parameters, not latents).  Otherwise, we just
+#fall back to evaluating the variables one at a time.
+
+def plate_names(prog:dict):
+    """
+    All the variable names defined directly in the plate (including variables in groups).
+    """
+    result = set(prog.keys())
+    for dgpt in prog.values():
+        if isinstance(dgpt, Group):
+            result.update(dgpt.prog.keys())
+    return result
+
+def dist_key(dist, names_in_plate:set):
+    """
+    Siblings with the same key can be batched.  Returns None if dist can't be batched at all.
+    """
+    if not isinstance(dist, Dist) or dist.enumerate or (0 < len(names_in_plate.intersection(dist.all_args))):
+        return None
+    #Dists that compute their log-probs differently (e.g. `MarginalNormal` or `AnalyticKL`).
+    if (type(dist).log_prob is not Dist.log_prob) or (type(dist).tdd is not Dist.tdd):
+        return None
+    return (type(dist), tuple(dist.sample_shape), tuple(dist.paramname2func.keys()))
+
+def batches(keys:dict):
+    """
+    Takes a dict mapping varnames to keys, and returns a list of the batches (lists of varnames with
+    the same key), ignoring varnames with a key of None, and batches of just one variable.
+    """
+    key2names = {}
+    for name, key in keys.items():
+        if key is not None:
+            key2names.setdefault(key, []).append(name)
+    return [names for names in key2names.values() if 1 < len(names)]
+
+def sample_batches(Q_prog:dict):
+    """
+    Batches of latents that can be sampled together.
+    """
+    names_in_plate = plate_names(Q_prog)
+    return batches({name: dist_key(dist, names_in_plate) for (name, dist) in Q_prog.items()})
+
+def logPQ_batches(P_prog:dict, Q_prog:dict):
+    """
+    Batches of latents where both P and Q can be scored together.
+    """
+    names_in_plate = plate_names(P_prog)
+    keys = {}
+    for name, P in P_prog.items():
+        #Checking Q first skips data (where P may not be an ordinary Dist).
+        key_Q = dist_key(Q_prog[name], names_in_plate)
+        key_P = dist_key(P, names_in_plate) if key_Q is not None else None
+        keys[name] = (key_P, key_Q) if key_P is not None else None
+    return batches(keys)
+
+def stack_params(dists:list[Dist], scope:dict[str, Tensor], active_platedims:list[Dim], device, batch_dim:Dim):
+    """
+    Returns the parameters for all the dists, stacked along batch_dim (or None if the parameters aren't
+    compatible, or have K-dimensions).
+    """
+    vals = [dist.paramname2func for dist in dists]
+    set_active_platedims = set(active_platedims)
+
+    result = {}
+    for paramname in vals[0]:
+        tensors = [convert_device_dtype(dist.dist, paramname, funcs[paramname](scope), device) for (dist, funcs) in zip(dists, vals)]
+
+        dims = generic_dims(tensors[0])
+        if not set(dims).issubset(set_active_platedims):
+            return None
+        tensors = [generic_order(tensor, dims) if set(generic_dims(tensor)) == set(dims) else None for tensor in tensors]
+        if any((tensor is None) or (tensor.shape != tensors[0].shape) or (tensor.dtype != tensors[0].dtype) for tensor in tensors):
+            return None
+
+        result[paramname] = generic_getitem(t.stack(tensors), [batch_dim, *dims])
+    return result
+
+def unstack(x:Tensor, batch_dim:Dim, Kdim:Dim, Kdims:list[Dim]):
+    """
+    Splits x along batch_dim, replacing Kdim with the corresponding Kdim in Kdims.
+    """
+    x = x.order(batch_dim, Kdim)
+    return [x[i][Kdim_i] for (i, Kdim_i) in enumerate(Kdims)]
+
+def same_size(Kdims:list[Dim]):
+    #Siblings can have different K (see `Plate.groupvarname2Kdim`), in which case they can't share a K-dimension.
+    return all(Kdim.size == Kdims[0].size for Kdim in Kdims)
+
+def batch_name(result, *args, **kwargs):
+    return ','.join(kwargs['names'])
+
+@profiled('sample', 'Batch', name=batch_name)
+def sample_batch(
+        names:list[str],
+        dists:list[Dist],
+        scope:dict[str, Tensor],
+        active_platedims:list[Dim],
+        groupvarname2Kdim:dict[str, Dim],
+        reparam:bool,
+        device:t.device,
+        qmc:bool,
+        antithetic:bool):
+    """
+    Samples all the dists at once.  Returns a dict mapping names to samples, or None if the
+    parameters can't be batched.
+    """
+    batch_dim = Dim('batch', len(dists))
+    Kdims = [groupvarname2Kdim[name] for name in names]
+    if not same_size(Kdims):
+        return None
+    Kdim = Dim('K_batch', Kdims[0].size)
+
+    kwargs = stack_params(dists, scope, active_platedims, device, batch_dim)
+    if kwargs is None:
+        return None
+
+    tdd = TorchDimDist(dists[0].dist, **kwargs)
+    sample = tdd.sample(reparam, [Kdim, batch_dim, *active_platedims], dists[0].sample_shape, noise_dim=Kdim, qmc=qmc, antithetic=antithetic)
+    return dict(zip(names, unstack(sample, batch_dim, Kdim, Kdims)))
+
+@profiled('logPQ', 'Batch', name=batch_name)
+def logPQ_batch(
+        names:list[str],
+        P:list[Dist],
+        Q:list[Dist],
+        samples:list[Tensor],
+        scope:dict[str, Tensor],
+        active_platedims:list[Dim],
+        groupvarname2Kdim:dict[str, Dim]):
+    """
+    Computes `logPQ_dist` for all the latents at once.  Returns a dict mapping names to log-probs,
+    or None if the parameters can't be batched.
+    """
+    batch_dim = Dim('batch', len(names))
+    Kdims = [groupvarname2Kdim[name] for name in names]
+    if not same_size(Kdims):
+        return None
+    Kdim = Dim('K_batch', Kdims[0].size)
+
+    other_dims = [dim for dim in generic_dims(samples[0]) if dim is not Kdims[0]]
+    if any(set(generic_dims(sample)) != set([Kdim_i, *other_dims]) for (sample, Kdim_i) in zip(samples, Kdims)):
+        return None
+
+    device = samples[0].device
+    kwargs_P = stack_params(P, scope, active_platedims, device, batch_dim)
+    kwargs_Q = stack_params(Q, scope, active_platedims, device, batch_dim)
+    if (kwargs_P is None) or (kwargs_Q is None):
+        return None
+
+    sample = t.stack([generic_order(sample, [Kdim_i, *other_dims]) for (sample, Kdim_i) in zip(samples, Kdims)])
+    sample = generic_getitem(sample, [batch_dim, Kdim, *other_dims])
+
+    #Q doesn't depend on any other latents, so there aren't any parent K-dimensions to reduce over.
+    lp = TorchDimDist(P[0].dist, **kwargs_P).log_prob(sample)
+    lq = TorchDimDist(Q[0].dist, **kwargs_Q).log_prob(sample)
+    lpq = lp - lq - math.log(Kdim.size)
+    return dict(zip(names, unstack(lpq, batch_dim, Kdim, Kdims)))
@@ -4,6 +4,7 @@ from .Plate import Plate, tree_branches, tree_values
 from .BoundPlate import BoundPlate
 
 from .Group import Group
+from .Timeseries import Timeseries
 from .dist import Dist
 from .Data import Data
 
@@ -27,6 +28,9 @@ def check_support(name:str, distP:Dist, distQ:Dist):
     assert isinstance(distP, Dist)
     assert isinstance(distQ, Dist)
 
+    if distP.enumerate:
+        raise Exception(f"{name} in P has enumerate=True, but enumeration only makes sense in Q")
+
     supportQ = distQ.dist.support 
     supportP = distP.dist.support 
     if supportQ != supportP:
@@ -74,6 +78,8 @@ def check_PQ_plate(platename: Optional[str], P: Plate, Q: Plate, data: dict):
     namesQ = Q.prog.keys()
     mismatch_pg_varnames(namesP, namesQ, area=f"plate {platename}")
 
+    check_timeseries_plate(platename, Q)
+
     #Check data names match between Q and data.
     data_names_in_Q = [k for (k, v) in Q.prog.items() if isinstance(v, Data)]
     data_names      = tree_values(data).keys()
@@ -102,6 +108,12 @@ def check_PQ_plate(platename: Optional[str], P: Plate, Q: Plate, data: dict):
             #Recurse
             check_PQ_group(name, groupP, groupQ)
 
+        elif isinstance(dgpt_P, Timeseries):
+            distQ = Q.prog[name]
+            if not isinstance(distQ, Timeseries):
+                raise Exception(f"{name} in P is a Timeseries, so {name} in Q should also be a Timeseries, but actually its a {type(distQ)}.")
+            check_support(name, dgpt_P.transition, distQ.transition)
+
         elif isinstance(dgpt_P, Plate):
             plateP = dgpt_P
             plateQ = Q.prog[name]
@@ -114,3 +126,35 @@ def check_PQ_plate(platename: Optional[str], P: Plate, Q: Plate, data: dict):
             raise Exception(f"{name} in P is Data.  But we can't have Data in P.")
         else:
             raise Exception(f"{name} is an unrecognised type (should be Plate, Group, Dist or Data (but can only be data in Q))")
+
+
+def check_timeseries_plate(platename: Optional[str], Q: Plate):
+    """
+    The plate dimension for the plate containing a Timeseries is the time dimension, so there can only be one
+    Timeseries in the plate, and no other latent variables (just data and child plates).
+    """
+    timeseries_names = [name for (name, dgpt) in Q.prog.items() if isinstance(dgpt, Timeseries)]
+    if 0 < len(timeseries_names):
+        if platename is None:
+            raise Exception(f"Timeseries {timeseries_names} must be in a plate (whose dimension is time), not at the top-level")
+        if 1 < len(timeseries_names):
+            raise Exception(f"Plate {platename} has several Timeseries, {timeseries_names}, but there can only be one Timeseries in a plate")
+        other_latents = [name for (name, dgpt) in Q.prog.items() if isinstance(dgpt, (Dist, Group))]
+        if 0 < len(other_latents):
+            raise Exception(f"Plate {platename} has a Timeseries, so it can't have any other latent variables, but it has {other_latents}")
+
+
+def check_enumerated(Q: Plate, enumerated: frozenset=frozenset()):
+    """
+    Enumerated variables have a K-dimension with the size of their support (rather than K), so
+    other variables in Q can't depend on them (though variables in P can).
+    """
+    for name, dgpt in Q.prog.items():
+        if isinstance(dgpt, (Dist, Group, Timeseries)):
+            depends_on = enumerated.intersection(dgpt.all_args)
+            if 0 < len(depends_on):
+                raise Exception(f"{name} in Q depends on {list(depends_on)}, which are enumerated.  Variables in Q can't depend on enumerated variables")
+            if isinstance(dgpt, Dist) and dgpt.enumerate:
+                enumerated = enumerated.union([name])
+        elif isinstance(dgpt, Plate):
+            check_enumerated(dgpt, enumerated)
@@ -0,0 +1,119 @@
+from .utils import *
+from .Plate import Plate
+from .Group import Group
+from .Timeseries import Timeseries
+from .dist import Dist, func_args, convert_device_dtype
+from .Data import Data
+from .TorchDimDist import TorchDimDist
+
+
+class MarginalNormal(Dist):
+    """
+    The marginal for data `x ~ Normal(z, scale_x)` once the latent `z ~ Normal(loc_z, scale_z)` has been
+    integrated out, i.e. `x ~ Normal(loc_z, sqrt(scale_z**2 + scale_x**2))`.
+
+    Only ever constructed by `rao_blackwellise_plate`, and only used to compute log-probs.
+    """
+    dist = td.Normal
+
+    def __init__(self, name_z:str, Pz:Dist, Px:Dist):
+        self.Pz = Pz
+        self.Px = Px
+        self.sample_shape = Px.sample_shape
+        self.enumerate = False
+        self.all_args = list(set(Pz.all_args).union(Px.all_args).difference([name_z]))
+
+    def tdd(self, scope: dict[str, Tensor], device):
+        loc_z   = convert_device_dtype(td.Normal, 'loc',   self.Pz.paramname2func['loc'](scope),   device)
+        scale_z = convert_device_dtype(td.Normal, 'scale', self.Pz.paramname2func['scale'](scope), device)
+        scale_x = convert_device_dtype(td.Normal, 'scale', self.Px.paramname2func['scale'](scope), device)
+        return TorchDimDist(td.Normal, loc=loc_z, scale=(scale_z**2 + scale_x**2).sqrt())
+
+    def sample(self, *args, **kwargs):
+        raise Exception("MarginalNormal is only used to compute log-probs")
+
+
+def conjugate_pairs(P:Plate, Q:Plate):
+    """
+    Finds the latents in this plate that can be integrated out analytically.  Returns a dict mapping
+    the name of the latent, z, to the name of the data, x, where:
+      z is Normal in P (and sampled in Q),
+      x is data in the same plate, with `x ~ Normal('z', scale)` in P, where scale doesn't depend on z,
+      nothing else in P or Q depends on z.
+    """
+    dependents = {}
+    for name, dgpt in all_dists(P):
+        for arg in dist_args(name, dgpt):
+            dependents.setdefault(arg, []).append(name)
+    Q_args = set(arg for (name, dgpt) in all_dists(Q) for arg in dist_args(name, dgpt))
+
+    result = {}
+    for name_z, Pz in P.prog.items():
+        Qz = Q.prog[name_z]
+        if not (is_normal(Pz) and isinstance(Qz, Dist) and not Qz.enumerate):
+            continue
+        if (name_z in Q_args) or (1 != len(dependents.get(name_z, []))):
+            continue
+
+        name_x = dependents[name_z][0]
+        Px = P.prog.get(name_x)
+        if not (is_normal(Px) and isinstance(Q.prog[name_x], Data)):
+            continue
+
+        loc_x = Px.paramname2something['loc']
+        scale_args, _ = func_args(Px.paramname2something['scale'])
+        if isinstance(loc_x, str) and (loc_x == name_z) and (name_z not in scale_args):
+            result[name_z] = name_x
+    return result
+
+def is_normal(dgpt):
+    return isinstance(dgpt, Dist) and (dgpt.dist is td.Normal) and (0 == len(dgpt.sample_shape))
+
+def all_dists(plate:Plate):
+    """
+    All the (name, Dist/Group/Timeseries) pairs in the plate, including in nested plates.
+    """
+    result = []
+    for name, dgpt in plate.prog.items():
+        if isinstance(dgpt, (Dist, Group, Timeseries)):
+            result.append((name, dgpt))
+        elif isinstance(dgpt, Plate):
+            result = [*result, *all_dists(dgpt)]
+    return result
+
+def dist_args(name:str, dgpt):
+    """
+    The arguments of a Dist/Group/Timeseries.  The transition for a Timeseries refers to the previous
+    time step using its own name, which isn't a dependency on another variable.
+    """
+    return [arg for arg in dgpt.all_args if arg != name]
+
+def rao_blackwellise_plate(P:Plate, Q:Plate):
+    """
+    Returns new P and Q, where each latent found by `conjugate_pairs` is integrated out analytically:
+    the latent is dropped from P and Q (so it has no factor and no K-dimension to sum over), and the
+    data that depended on it uses the marginal, `MarginalNormal`.
+
+    The result is only used for computing log-probs, so the sample can still contain the integrated-out
+    latents (they're just ignored).
+    """
+    pairs = conjugate_pairs(P, Q)
+    marginalised = {name_x: name_z for (name_z, name_x) in pairs.items()}
+
+    progP = {}
+    progQ = {}
+    for name, childP in P.prog.items():
+        childQ = Q.prog[name]
+        if name in pairs:
+            continue
+        elif name in marginalised:
+            name_z = marginalised[name]
+            progP[name] = MarginalNormal(name_z, P.prog[name_z], childP)
+            progQ[name] = childQ
+        elif isinstance(childP, Plate):
+            progP[name], progQ[name] = rao_blackwellise_plate(childP, childQ)
+        else:
+            progP[name] = childP
+            progQ[name] = childQ
+
+    return Plate(**progP), Plate(**progQ)
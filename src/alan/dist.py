@@ -8,6 +8,7 @@ import torch
 from .utils import *
 from .TorchDimDist import TorchDimDist
 from .SamplingType import SamplingType
+from .Profiler import profiled
 
 def func_args(something):
     """
@@ -69,14 +70,24 @@ class Dist():
 
     Critically, we extract the argument name from e.g. `lambda a: a.exp()` and use it to extract the right 
     variable from the scope.
+
+    In Q, discrete distributions with finite support (e.g. Bernoulli, Categorical, Binomial) can be
+    given `enumerate=True`.  Rather than sampling K particles, the K-dimension for the variable is
+    then the full support, with a uniform approximate posterior, so summing over the K-dimension
+    exactly marginalises the variable.  As the parameters are only used to find the support, they
+    must be fixed values, e.g. `Categorical(t.ones(5)/5, enumerate=True)`.
     """
-    def __init__(self, *args, sample_shape=t.Size([]), **kwargs):
+    def __init__(self, *args, sample_shape=t.Size([]), enumerate=False, **kwargs):
         self.sample_shape = sample_shape
+        self.enumerate = enumerate
 
         #Converts args + kwargs to a unified dictionary mapping paramname2something,
         #following distributions initialization signature.
         paramname2something = inspect.signature(self.dist).bind(*args, **kwargs).arguments
 
+        #The parameters as given, e.g. used to spot conjugate pairs in `conjugate.py`.
+        self.paramname2something = dict(paramname2something)
+
         all_args = set()
         #A dict[str, function], where the functions map from a scope to a value.
         self.paramname2func = {}
@@ -87,8 +98,32 @@ class Dist():
 
         self.all_args = list(all_args)
 
+        if enumerate:
+            self.support = self.enumerate_support()
+
+    def enumerate_support(self):
+        if not self.dist.has_enumerate_support:
+            raise Exception(f"enumerate=True requires a distribution with finite support, but {self.dist.__name__} can't enumerate its support")
+        if 0 < len(self.all_args):
+            raise Exception(f"enumerate=True requires the parameters to be fixed values (they're only used to find the support), but they depend on {self.all_args}")
+        if 0 < len(self.sample_shape):
+            raise Exception("enumerate=True doesn't support sample_shape")
+
+        paramname2val = {paramname: convert_device_dtype(self.dist, paramname, func({}), t.device('cpu')) for (paramname, func) in self.paramname2func.items()}
+        support = self.dist(**paramname2val).enumerate_support(expand=False)
+        if support.numel() != support.shape[0]:
+            raise Exception(f"enumerate=True requires scalar parameters, but the support has shape {tuple(support.shape)}")
+        return support.reshape(-1)
+
+    def Kdim_size(self, K:int):
+        """
+        Size of the K-dimension: K, or the size of the support if enumerated.
+        """
+        return self.support.shape[0] if self.enumerate else K
+
     def filter_scope(self, scope: dict[str, Tensor]):
-        return {k: v for (k,v) in scope.items() if k in self.all_args}
+        #Only looks up the arguments, rather than iterating through the whole scope.
+        return {k: scope[k] for k in self.all_args if k in scope}
 
     def tdd(self, scope: dict[str, Tensor], device):
         paramname2val = {paramname: func(scope) for (paramname, func) in self.paramname2func.items()}
@@ -96,6 +131,7 @@ class Dist():
 
         return TorchDimDist(self.dist, **paramname2val)
 
+    @profiled('sample', 'Dist')
     def sample(
             self,
             name:Optional[str],
@@ -107,15 +143,24 @@ class Dist():
             sampling_type:SamplingType,
             reparam:bool,
             device:torch.device,
+            qmc:bool,
+            antithetic:bool,
             ):
 
         Kdim = groupvarname2Kdim[name]
         sample_dims = [Kdim, *active_platedims]
 
+        if self.enumerate:
+            #The whole support along Kdim, and the same for every plate element.
+            support = self.support.to(device=device)
+            support = support.reshape(-1, *(len(active_platedims)*[1])).expand(*[dim.size for dim in sample_dims])
+            return generic_getitem(support, sample_dims)
+
         filtered_scope = self.filter_scope(scope)
         resampled_scope = sampling_type.resample_scope(filtered_scope, active_platedims, Kdim)
 
-        sample = self.tdd(resampled_scope, device=device).sample(reparam, sample_dims, self.sample_shape)
+        tdd = self.tdd(resampled_scope, device=device)
+        sample = tdd.sample(reparam, sample_dims, self.sample_shape, noise_dim=Kdim, qmc=qmc, antithetic=antithetic)
 
         return sample
     
@@ -0,0 +1,280 @@
+import math
+from typing import Optional
+
+import opt_einsum
+import torch as t
+
+from .utils import *
+from .Plate import Plate
+from .Group import Group
+from .Timeseries import Timeseries
+from .dist import Dist
+from .Data import Data
+from .Split import Split, NoSplit, NoCheckpoint, checkpoint
+from .SamplingType import SamplingType, PermutationSampler, IndependentSampler
+
+
+def estimate(problem, K, split:Optional[Split]=checkpoint, sampling_type:SamplingType=PermutationSampler):
+    """
+    Dry-run estimate of the cost of computing the ELBO (e.g. `sample.elbo_vi(split=split)`),
+    working purely from the structure of P/Q, the K and plate sizes and the `opt_einsum`
+    path, without allocating any of the log-probability tensors.  K can be an int, a dict or a
+    function, as in `Problem.sample`.
+
+    Returns a dict with:
+      `peak_memory`: predicted peak memory (bytes) for the forward pass, including the sample.
+        Without checkpointing, this includes everything autograd retains for the backward pass.
+        With checkpointing/splitting, only the working set of the most expensive plate matters.
+      `flops`: rough total FLOPs for computing the log-probs and contracting out the K-dimensions
+        (same estimate as used in `alan.profile`).
+      `contractions`: a list with a dict for each `collect_lps` contraction step, giving the plate,
+        the Kdims summed, the number of elements/bytes in the largest factor (i.e. the
+        intermediate before summing out Kdims), and the FLOPs.
+
+    For the samplers in `alan.sampling_types`, the log-prob for Q has the parent K-dimensions
+    (before they're averaged out by `reduce_logQ`), whereas for `IndependentSampler` it never does,
+    so the estimates for `IndependentSampler` are smaller.  The contractions are the same either way,
+    as the log-prob for Q is always reduced to a single K-dimension before the contraction.
+    Event dimensions (e.g. for MultivariateNormal) and the memory used by the data are ignored.
+    """
+    if split is None:
+        split = checkpoint
+
+    element_size = t.empty((), dtype=t.get_default_dtype()).element_size()
+    groupvarname2Kdim = problem.Q.plate.groupvarname2Kdim(K)
+    result, contractions, _, _ = trace_reduction(problem, groupvarname2Kdim, split, sampling_type)
+
+    if isinstance(split, NoCheckpoint):
+        #autograd retains all the intermediate tensors until the backward pass.
+        working_numel = result['total_numel']
+    else:
+        #Only the inputs to each checkpointed plate are retained, so we just need the working
+        #set for the most expensive plate.
+        working_numel = result['working_numel']
+
+    return {
+        'peak_memory': element_size * (result['sample_numel'] + working_numel),
+        'flops': result['flops'],
+        'contractions': [{**c, 'bytes': element_size*c['numel']} for c in contractions],
+    }
+
+
+def explain_reduction(problem, groupvarname2Kdim:dict[str, Dim], split:Optional[Split]=checkpoint, threshold:int=10**8):
+    """
+    Returns a human-readable report describing, for each plate, the factors passed to
+    `collect_lps`, the `opt_einsum` path, the Kdims summed at each step and the intermediate
+    at each step.  Also returns a list of the steps where the intermediate has more than
+    threshold elements.
+    """
+    if split is None:
+        split = checkpoint
+
+    _, _, plates, sizes = trace_reduction(problem, groupvarname2Kdim, split)
+
+    def fmt(dims):
+        return '(' + ', '.join(f'{dim}[{sizes[dim]}]' for dim in dims) + ')'
+
+    lines = []
+    flagged = []
+    for plate in plates:
+        lines.append(f"Plate {plate['plate']}: {len(plate['factors'])} factors")
+        for i, dims in enumerate(plate['factors']):
+            lines.append(f"  factor {i}: {fmt(dims)}")
+        lines.append(f"  path: {[step['idxs'] for step in plate['steps']]}")
+
+        for i, step in enumerate(plate['steps']):
+            step_numel = numel(step['dims'], sizes)
+            summed = ', '.join(str(K) for K in step['Ks']) if 0 < len(step['Ks']) else 'nothing'
+            line = f"  step {i}: combine {step['idxs']}, sum over {summed}; intermediate {fmt(step['dims'])} = {step_numel} elements"
+            if threshold < step_numel:
+                line = line + f"  <-- exceeds threshold of {threshold} elements"
+                flagged.append({'plate': plate['plate'], 'step': i, 'Ks': tuple(str(K) for K in step['Ks']), 'numel': step_numel})
+            lines.append(line)
+
+    return '\n'.join(lines), flagged
+
+
+def trace_reduction(problem, groupvarname2Kdim:dict[str, Dim], split:Split, sampling_type:SamplingType=PermutationSampler):
+    """
+    Symbolically traces the reduction over the whole problem.  Returns the totals for the
+    top-level plate, a list of contractions, a list describing the reduction in each plate,
+    and the sizes of all the dims.
+    """
+    all_platedims = problem.all_platedims
+
+    #Sizes of the dims in the largest split of the plate (for memory), and the full sizes (for FLOPs).
+    sizes = {dim: dim.size for dim in [*groupvarname2Kdim.values(), *all_platedims.values()]}
+    full_sizes = dict(sizes)
+    if not isinstance(split, NoSplit):
+        splitdims = split.splitdims(all_platedims)
+        sizes[all_platedims[split.platename]] = max(splitdims.split_sizes)
+
+    contractions = []
+    plates = []
+    result = estimate_plate(
+        name=None,
+        P=problem.P.plate,
+        Q=problem.Q.plate,
+        scope={},
+        active_platedims=[*problem.replicate_dims],
+        all_platedims=all_platedims,
+        groupvarname2Kdim=groupvarname2Kdim,
+        sizes=sizes,
+        full_sizes=full_sizes,
+        contractions=contractions,
+        plates=plates,
+        sampling_type=sampling_type,
+    )
+    return result, contractions, plates, sizes
+
+
+def numel(dims, sizes:dict):
+    return math.prod(sizes[dim] for dim in dims)
+
+def estimate_plate(
+        name:Optional[str],
+        P:Plate,
+        Q:Plate,
+        scope:dict,
+        active_platedims:list[Dim],
+        all_platedims:dict[str, Dim],
+        groupvarname2Kdim:dict[str, Dim],
+        sizes:dict,
+        full_sizes:dict,
+        contractions:list,
+        plates:list,
+        sampling_type:SamplingType):
+    """
+    Mirrors `_logPQ_plate`, but rather than computing tensors, just tracks their dimensions.
+    `scope` maps variable names to the K-dimension of the corresponding sample.
+    """
+    if name is not None:
+        active_platedims = [*active_platedims, all_platedims[name]]
+
+    #As in update_scope, all the samples in this plate are in scope.
+    scope = {**scope}
+    for childname, childQ in Q.prog.items():
+        if isinstance(childQ, Dist):
+            scope[childname] = groupvarname2Kdim[childname]
+        elif isinstance(childQ, Group):
+            for varname in childQ.prog:
+                scope[varname] = groupvarname2Kdim[childname]
+
+    factors = []
+    sample_numel = 0
+    total_numel = 0
+    flops = 0
+    #Largest tensor that only exists transiently while computing this plate (including child plates).
+    transient_numel = 0
+
+    for childname, childP in P.prog.items():
+        childQ = Q.prog[childname]
+
+        if isinstance(childQ, Timeseries):
+            raise Exception(f"Cost estimates aren't yet implemented for Timeseries (such as {childname})")
+
+        if isinstance(childP, Plate):
+            child = estimate_plate(
+                name=childname,
+                P=childP,
+                Q=childQ,
+                scope=scope,
+                active_platedims=active_platedims,
+                all_platedims=all_platedims,
+                groupvarname2Kdim=groupvarname2Kdim,
+                sizes=sizes,
+                full_sizes=full_sizes,
+                contractions=contractions,
+                plates=plates,
+                sampling_type=sampling_type,
+            )
+            factors.append(child['dims'])
+            sample_numel += child['sample_numel']
+            total_numel += child['total_numel']
+            flops += child['flops']
+            transient_numel = max(transient_numel, child['working_numel'])
+            continue
+
+        if isinstance(childQ, Data):
+            Kdims = []
+        else:
+            Kdims = [groupvarname2Kdim[childname]]
+            sample_dims = [*Kdims, *active_platedims]
+            sample_numel += numel(sample_dims, sizes) * (len(childQ.prog) if isinstance(childQ, Group) else 1)
+
+            #Log-prob for Q has Kdims for the parents, before they're averaged out by reduce_logQ,
+            #except for IndependentSampler, where the parent particles are aligned (see logQ_scope).
+            parent_Kdims = [] if issubclass(sampling_type, IndependentSampler) else arg_Kdims(childQ, scope)
+            lq_dims = ordered_unique([*Kdims, *parent_Kdims, *active_platedims])
+            transient_numel = max(transient_numel, numel(lq_dims, sizes))
+            total_numel += numel(lq_dims, sizes)
+            flops += numel(lq_dims, full_sizes)
+
+        factor_dims = ordered_unique([*Kdims, *arg_Kdims(childP, scope), *active_platedims])
+        factors.append(factor_dims)
+        total_numel += numel(factor_dims, sizes)
+        flops += numel(factor_dims, full_sizes)
+
+    all_Ks = [groupvarname2Kdim[childname] for (childname, childQ) in Q.prog.items() if isinstance(childQ, (Dist, Group))]
+    out_dims, steps = contraction_steps(factors, all_Ks, sizes)
+    plates.append({'plate': name if name is not None else 'root', 'factors': factors, 'steps': steps})
+
+    for step in steps:
+        contractions.append({
+            'plate': name if name is not None else 'root',
+            'Ks': tuple(str(K) for K in step['Ks']),
+            'numel': numel(step['dims'], sizes),
+            'flops': numel(step['dims'], full_sizes) * (step['num_factors'] + 3),
+        })
+        transient_numel = max(transient_numel, numel(step['dims'], sizes))
+        total_numel += numel(step['dims'], sizes)
+        flops += contractions[-1]['flops']
+
+    #Sum over plate dimension, if present.
+    if name is not None:
+        out_dims = [dim for dim in out_dims if dim is not active_platedims[-1]]
+
+    factors_numel = sum(numel(dims, sizes) for dims in factors)
+    return {
+        'dims': out_dims,
+        'sample_numel': sample_numel,
+        'total_numel': total_numel,
+        'working_numel': factors_numel + transient_numel,
+        'flops': flops,
+    }
+
+def arg_Kdims(dist, scope:dict):
+    """
+    K-dimensions of the samples that dist (a Dist or Group) depends on.
+    """
+    all_args = dist.all_args
+    return [scope[arg] for arg in all_args if arg in scope]
+
+def contraction_steps(factors:list, Ks_to_sum:list, sizes:dict):
+    """
+    Mirrors `collect_lps`, but with lists of dims rather than tensors.  Returns the
+    output dims, along with the dims of the intermediate at each step.
+    """
+    set_Ks_to_sum = set(Ks_to_sum)
+    all_dims = ordered_unique([dim for dims in factors for dim in dims])
+    dim_to_symbol = {dim: opt_einsum.get_symbol(i) for (i, dim) in enumerate(all_dims)}
+    in_subscripts = ','.join(''.join(dim_to_symbol[dim] for dim in dims) for dims in factors)
+    out_subscripts = ''.join(dim_to_symbol[dim] for dim in all_dims if dim not in set_Ks_to_sum)
+    shapes = [tuple(sizes[dim] for dim in dims) for dims in factors]
+    path = opt_einsum.contract_path(f'{in_subscripts}->{out_subscripts}', *shapes, shapes=True)[0]
+
+    factors = [*factors]
+    steps = []
+    for idxs in path:
+        to_reduce = [factors[i] for i in idxs]
+        factors = [factors[i] for i in range(len(factors)) if i not in idxs]
+
+        remaining_dims = set(dim for dims in factors for dim in dims)
+        dims = ordered_unique([dim for dims in to_reduce for dim in dims])
+        _Ks_to_sum = [dim for dim in dims if (dim in set_Ks_to_sum) and (dim not in remaining_dims)]
+
+        steps.append({'idxs': tuple(idxs), 'dims': dims, 'Ks': _Ks_to_sum, 'num_factors': len(to_reduce)})
+        factors.append([dim for dim in dims if dim not in set(_Ks_to_sum)])
+
+    assert 1 == len(factors)
+    return factors[0], steps
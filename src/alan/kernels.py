@@ -0,0 +1,108 @@
+import math
+
+import torch as t
+import torch.distributions as td
+import torch.nn.functional as F
+
+
+def normal_log_prob(x, loc, scale):
+    return -((x - loc)**2) / (2*scale**2) - scale.log() - 0.5*math.log(2*math.pi)
+
+def normal_rsample(sample_shape, batch_shape, loc, scale):
+    shape = [*sample_shape, *t.broadcast_shapes(batch_shape, loc.shape, scale.shape)]
+    return loc + scale * t.randn(shape, dtype=loc.dtype, device=loc.device)
+
+def bernoulli_logits_log_prob(x, logits):
+    logits, x = t.broadcast_tensors(logits, x)
+    return -F.binary_cross_entropy_with_logits(logits, x, reduction='none')
+
+def bernoulli_probs_log_prob(x, probs):
+    return bernoulli_logits_log_prob(x, td.utils.probs_to_logits(probs, is_binary=True))
+
+def binomial_logits_log_prob(x, total_count, logits):
+    total_count = total_count.type_as(logits)
+    log_factorial_n = t.lgamma(total_count + 1)
+    log_factorial_k = t.lgamma(x + 1)
+    log_factorial_nmk = t.lgamma(total_count - x + 1)
+    #Numerically stable total_count * log(1 + exp(logits)).
+    normalize_term = total_count * (logits.clamp(min=0) + t.log1p(t.exp(-logits.abs()))) - log_factorial_n
+    return x * logits - log_factorial_k - log_factorial_nmk - normalize_term
+
+def binomial_probs_log_prob(x, total_count, probs):
+    return binomial_logits_log_prob(x, total_count, td.utils.probs_to_logits(probs, is_binary=True))
+
+def gamma_log_prob(x, concentration, rate):
+    return t.xlogy(concentration, rate) + t.xlogy(concentration - 1, x) - rate * x - t.lgamma(concentration)
+
+def poisson_log_prob(x, rate):
+    return t.xlogy(x, rate) - rate - t.lgamma(x + 1)
+
+def mvn_scale_tril_log_prob(x, loc, scale_tril):
+    diff = x - loc
+    #Broadcasts the batch dims of scale_tril against those of diff.
+    batch_shape = t.broadcast_shapes(diff.shape[:-1], scale_tril.shape[:-2])
+    L = scale_tril.expand(*batch_shape, *scale_tril.shape[-2:])
+    diff = diff.expand(*batch_shape, diff.shape[-1])
+    M = t.linalg.solve_triangular(L, diff[..., None], upper=False).squeeze(-1).pow(2).sum(-1)
+    half_log_det = L.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+    return -0.5*(x.shape[-1]*math.log(2*math.pi) + M) - half_log_det
+
+def mvn_covariance_log_prob(x, loc, covariance_matrix):
+    return mvn_scale_tril_log_prob(x, loc, t.linalg.cholesky(covariance_matrix))
+
+def mvn_scale_tril_rsample(sample_shape, batch_shape, loc, scale_tril):
+    shape = [*sample_shape, *t.broadcast_shapes(batch_shape, loc.shape[:-1], scale_tril.shape[:-2]), loc.shape[-1]]
+    eps = t.randn(shape, dtype=loc.dtype, device=loc.device)
+    return loc + (scale_tril @ eps[..., None]).squeeze(-1)
+
+def mvn_covariance_rsample(sample_shape, batch_shape, loc, covariance_matrix):
+    return mvn_scale_tril_rsample(sample_shape, batch_shape, loc, t.linalg.cholesky(covariance_matrix))
+
+
+#Hand-written kernels for the most common distributions, used by TorchDimDist when argument validation is
+#off (`alan.set_default_validate_args(False)`).  They work directly on the (broadcastable) parameter
+#tensors, skipping the construction of a `torch.distributions` object (broadcasting the arguments and
+#checking constraints), and don't check anything.  Each dict maps from the PyTorch distribution to a
+#dict mapping the (sorted) parameter names to the kernel.  The rsample kernels also take a batch_shape,
+#which the batch shape of the sample must broadcast to (it's given by the torchdims in the sample, so
+#the parameters themselves never need to be expanded).  Without a kernel, TorchDimDist falls back to
+#`torch.distributions` (without validation).
+log_prob_kernels = {
+    td.Normal: {
+        ('loc', 'scale'): normal_log_prob,
+    },
+    td.Bernoulli: {
+        ('probs',): bernoulli_probs_log_prob,
+        ('logits',): bernoulli_logits_log_prob,
+    },
+    td.Binomial: {
+        ('probs', 'total_count'): binomial_probs_log_prob,
+        ('logits', 'total_count'): binomial_logits_log_prob,
+    },
+    td.Gamma: {
+        ('concentration', 'rate'): gamma_log_prob,
+    },
+    td.Poisson: {
+        ('rate',): poisson_log_prob,
+    },
+    td.MultivariateNormal: {
+        ('loc', 'scale_tril'): mvn_scale_tril_log_prob,
+        ('covariance_matrix', 'loc'): mvn_covariance_log_prob,
+    },
+}
+
+rsample_kernels = {
+    td.Normal: {
+        ('loc', 'scale'): normal_rsample,
+    },
+    td.MultivariateNormal: {
+        ('loc', 'scale_tril'): mvn_scale_tril_rsample,
+        ('covariance_matrix', 'loc'): mvn_covariance_rsample,
+    },
+}
+
+def get_kernel(kernels:dict, dist, paramnames):
+    """
+    Returns the kernel for dist with the given parameters, or None if there isn't one.
+    """
+    return kernels.get(dist, {}).get(tuple(sorted(paramnames)))
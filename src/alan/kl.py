@@ -0,0 +1,101 @@
+import math
+
+from .utils import *
+from .Plate import Plate
+from .dist import Dist, convert_device_dtype
+from .TorchDimDist import colons
+
+
+class AnalyticKL(Dist):
+    """
+    Wraps P for a latent where P and Q are from the same family, so that in `logPQ_dist`,
+    ```
+    log P(z_k) - log Q(z_k)
+    ```
+    becomes `-KL(Q||P)`, computed in closed form using `torch.distributions.kl_divergence`.
+    To do that, `log_prob` returns `log Q(z_k) - KL(Q||P)`.
+
+    Falls back to P if the parameters of P or Q depend on other latents (i.e. have K-dimensions
+    not on the sample), or PyTorch doesn't have the KL divergence for the family.
+
+    Only ever constructed by `analytic_kl_plate`.
+    """
+    def __init__(self, P:Dist, Q:Dist):
+        self.P = P
+        self.Q = Q
+        self.dist = P.dist
+        self.sample_shape = P.sample_shape
+        self.enumerate = False
+        self.all_args = P.all_args
+
+    def log_prob(self, sample:Tensor, scope:dict[str, Tensor]):
+        kl = analytic_kl(self.P, self.Q, scope, sample)
+        if kl is None:
+            return self.P.log_prob(sample, scope)
+        return self.Q.log_prob(sample, scope) - kl
+
+    def sample(self, *args, **kwargs):
+        raise Exception("AnalyticKL is only used to compute log-probs")
+
+
+def torch_dist(dist, kwargs:dict, dims:list[Dim]):
+    """
+    Constructs the PyTorch distribution, with the torchdims in dims as positional dimensions
+    (between the batch and event dimensions), so that the result broadcasts against another
+    distribution constructed with the same dims.
+    """
+    kwargs_tensor = {}
+    for paramname, arg in kwargs.items():
+        event_ndim = dist.arg_constraints[paramname].event_dim
+        batch_ndim = generic_ndim(arg) - event_ndim
+        kwargs_tensor[paramname] = ultimate_order(arg, [*colons(batch_ndim), *dims, *colons(event_ndim)])
+    return dist(**kwargs_tensor)
+
+def analytic_kl(P:Dist, Q:Dist, scope:dict[str, Tensor], sample:Tensor):
+    """
+    Returns KL(Q||P) (summed over any batch dimensions), with the same torchdims as the parameters,
+    or None if the parameters have K-dimensions, or there is no closed form.
+    """
+    device = sample.device
+    kwargs_P = {paramname: convert_device_dtype(P.dist, paramname, func(scope), device) for (paramname, func) in P.paramname2func.items()}
+    kwargs_Q = {paramname: convert_device_dtype(Q.dist, paramname, func(scope), device) for (paramname, func) in Q.paramname2func.items()}
+
+    #The parameters can only have plate dimensions, which are all on the sample.
+    dims = canonical_dims(unify_dims([*kwargs_P.values(), *kwargs_Q.values()]))
+    if not set(dims).issubset(generic_dims(sample)):
+        return None
+
+    try:
+        kl = td.kl_divergence(torch_dist(Q.dist, kwargs_Q, dims), torch_dist(P.dist, kwargs_P, dims))
+    except NotImplementedError:
+        return None
+
+    #Positional batch dimensions are summed, as in `log_prob`, and log_prob sums over sample_shape.
+    batch_ndim = kl.ndim - len(dims)
+    kl = generic_getitem(kl, [*colons(batch_ndim), *dims])
+    return math.prod(P.sample_shape) * sum_non_dim(kl)
+
+def analytic_kl_plate(P:Plate, Q:Plate):
+    """
+    Returns a new P, where for each latent where P and Q are from the same family (and have the same
+    sample_shape), P is wrapped in `AnalyticKL`.
+    """
+    prog = {}
+    for name, childP in P.prog.items():
+        childQ = Q.prog[name]
+        if isinstance(childP, Plate):
+            prog[name] = analytic_kl_plate(childP, childQ)
+        elif is_kl_pair(childP, childQ):
+            prog[name] = AnalyticKL(childP, childQ)
+        else:
+            prog[name] = childP
+    return Plate(**prog)
+
+def is_kl_pair(P, Q):
+    return (
+        isinstance(P, Dist) and
+        (type(P) is type(Q)) and
+        (type(P).log_prob is Dist.log_prob) and
+        (not Q.enumerate) and
+        (tuple(P.sample_shape) == tuple(Q.sample_shape))
+    )
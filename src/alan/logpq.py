@@ -1,14 +1,20 @@
 import math
 from typing import Optional, Union
+from concurrent.futures import Executor, Future
+from collections import ChainMap
 
 from .Plate import Plate, tree_values, update_scope
 from .Group import Group
+from .Timeseries import Timeseries, TimeseriesFactor, index_time
 from .utils import *
-from .reduce_Ks import reduce_Ks
+from .reduce_Ks import reduce_Ks, reduce_timeseries
 from .Split import Split, checkpoint, no_checkpoint
 from .SamplingType import SamplingType
 from .dist import Dist
 from .Data import Data
+from .Profiler import profiled
+from .Prune import Prune
+from .batching import logPQ_batches, logPQ_batch
 
 def logPQ_plate(
         name:Optional[str],
@@ -23,7 +29,13 @@ def logPQ_plate(
         all_platedims:dict[str: Dim],
         groupvarname2Kdim:dict[str, Tensor],
         sampling_type:SamplingType,
-        split:Optional[Split]):
+        split:Optional[Split],
+        executor:Optional[Executor],
+        reduce_dtype:Optional[t.dtype],
+        prune:Optional[Prune]):
+
+    if isinstance(split, Split) and (split.platename == name) and has_timeseries(Q):
+        raise Exception(f"Can't split plate {name}, as it's the time dimension for a Timeseries")
 
     #Returns a tuple of dicts, with split samples, inputs_params, extra_log_factors, data and all_platedims.
     siedas = split.split_args(
@@ -48,10 +60,13 @@ def logPQ_plate(
             groupvarname2Kdim=groupvarname2Kdim,
             sampling_type=sampling_type,
             split=split,
+            executor=executor,
+            reduce_dtype=reduce_dtype,
+            prune=prune,
             **sieda
         ))
 
-    return sum(lps)
+    return split.combine_lps(name, lps)
 
 def _logPQ_plate_checkpointed(*args, **kwargs):
     return t.utils.checkpoint.checkpoint(_logPQ_plate_args_kwargs, args, kwargs, use_reentrant=False)
@@ -59,6 +74,7 @@ def _logPQ_plate_checkpointed(*args, **kwargs):
 def _logPQ_plate_args_kwargs(args, kwargs):
     return _logPQ_plate(*args, **kwargs)
 
+@profiled('logPQ', 'Plate')
 def _logPQ_plate(
         name:Optional[str],
         P:Plate, 
@@ -72,7 +88,10 @@ def _logPQ_plate(
         all_platedims:dict[str: Dim],
         groupvarname2Kdim:dict[str, Tensor],
         sampling_type:SamplingType,
-        split:Optional[Split]):
+        split:Optional[Split],
+        executor:Optional[Executor],
+        reduce_dtype:Optional[t.dtype],
+        prune:Optional[Prune]):
 
     assert isinstance(P, Plate)
     assert isinstance(Q, Plate)
@@ -103,19 +122,27 @@ def _logPQ_plate(
         all_platedims=all_platedims,
         groupvarname2Kdim=groupvarname2Kdim,
         sampling_type=sampling_type,
-        split=split)
+        split=split,
+        executor=executor,
+        reduce_dtype=reduce_dtype,
+        prune=prune)
 
-    #Sum out Ks
-    lp = reduce_Ks(lps, all_Ks)
+    if any(isinstance(lp, TimeseriesFactor) for lp in lps):
+        #Sums out the K-dimension for the Timeseries sequentially, along with the time (plate) dimension.
+        lp = reduce_timeseries(lps, active_platedims[-1])
+    else:
+        #Sum out Ks
+        lp = reduce_Ks(lps, all_Ks, reduce_dtype, prune)
 
-    #Sum over plate dimension if present (remember, if this is a top-layer plate which
-    #is signalled by name=None, then there won't be a plate dimension.
-    if name is not None:
-        lp = lp.sum(active_platedims[-1])
+        #Sum over plate dimension if present (remember, if this is a top-layer plate which
+        #is signalled by name=None, then there won't be a plate dimension.
+        if name is not None:
+            lp = lp.sum(active_platedims[-1])
 
 
     return lp
 
+@profiled('logPQ', 'Dist')
 def logPQ_dist(
         name:str,
         P:Dist, 
@@ -129,7 +156,10 @@ def logPQ_dist(
         all_platedims:dict[str: Dim],
         groupvarname2Kdim:dict[str, Tensor],
         sampling_type:SamplingType,
-        split:Optional[Split]):
+        split:Optional[Split],
+        executor:Optional[Executor],
+        reduce_dtype:Optional[t.dtype],
+        prune:Optional[Prune]):
 
     assert isinstance(P, Dist)
 
@@ -153,14 +183,20 @@ def logPQ_dist(
 
     if sample is not None:
         Kdim = groupvarname2Kdim[name]
-        lq = Q.log_prob(sample=sample, scope=scope)
-        lq = sampling_type.reduce_logQ(lq, active_platedims, Kdim)
+        if Q.enumerate:
+            #Kdim is the whole support, and Q is uniform over the support.
+            lq = -math.log(Kdim.size)
+        else:
+            Q_scope = sampling_type.logQ_scope(Q.filter_scope(scope), active_platedims, Kdim)
+            lq = Q.log_prob(sample=sample, scope=Q_scope)
+            lq = sampling_type.reduce_logQ(lq, active_platedims, Kdim)
 
         lpq = lpq - lq - math.log(Kdim.size)
         
     return lpq
 
 
+@profiled('logPQ', 'Group')
 def logPQ_group(
         name:str,
         P:Group, 
@@ -174,7 +210,10 @@ def logPQ_group(
         all_platedims:dict[str: Dim],
         groupvarname2Kdim:dict[str, Tensor],
         sampling_type:SamplingType,
-        split:Optional[Split]):
+        split:Optional[Split],
+        executor:Optional[Executor],
+        reduce_dtype:Optional[t.dtype],
+        prune:Optional[Prune]):
 
     assert isinstance(P, Group)
     assert isinstance(Q, Group)
@@ -188,6 +227,9 @@ def logPQ_group(
     Kdim = groupvarname2Kdim[name]
     all_Kdims = set(groupvarname2Kdim.values())
 
+    #Scope for Q also includes the samples for earlier variables in the group.
+    Q_scope = ChainMap(sampling_type.logQ_scope(Q.filter_scope(scope), active_platedims, Kdim), scope)
+
     total_logP = 0.
     total_logQ = 0.
     for childname, childP in P.prog.items():
@@ -198,7 +240,7 @@ def logPQ_group(
         assert isinstance(childsample, Tensor)
 
         total_logP = total_logP + childP.log_prob(sample=childsample, scope=scope)
-        total_logQ = total_logQ + childQ.log_prob(sample=childsample, scope=scope)
+        total_logQ = total_logQ + childQ.log_prob(sample=childsample, scope=Q_scope)
 
     total_logQ = sampling_type.reduce_logQ(total_logQ, active_platedims, Kdim)
 
@@ -206,6 +248,62 @@ def logPQ_group(
     return logPQ
 
 
+@profiled('logPQ', 'Timeseries')
+def logPQ_timeseries(
+        name:str,
+        P:Timeseries, 
+        Q:Timeseries, 
+        sample: Tensor, 
+        inputs_params: dict,
+        data: None,
+        extra_log_factors: None, 
+        scope: dict[str, Tensor], 
+        active_platedims:list[Dim],
+        all_platedims:dict[str: Dim],
+        groupvarname2Kdim:dict[str, Tensor],
+        sampling_type:SamplingType,
+        split:Optional[Split],
+        executor:Optional[Executor],
+        reduce_dtype:Optional[t.dtype],
+        prune:Optional[Prune]):
+
+    assert isinstance(P, Timeseries)
+    assert isinstance(Q, Timeseries)
+
+    assert isinstance(sample, Tensor)
+    assert inputs_params is None
+    assert data is None
+    assert extra_log_factors is None
+
+    #The time dimension is the plate dimension for the enclosing plate.
+    Tdim = active_platedims[-1]
+    platedims = active_platedims[:-1]
+    Kdim = groupvarname2Kdim[name]
+    #K-dimension for the sample at the previous time step.
+    Kprev = Dim(f"{Kdim}_prev", Kdim.size)
+
+    #First time step, where the previous value is init.
+    sample0 = index_time(sample, Tdim, 0)
+    lp0 = P.transition.log_prob(sample=sample0, scope=P.initial_scope(name, scope, Tdim))
+    Q_scope0 = sampling_type.logQ_scope(Q.initial_scope(name, scope, Tdim), platedims, Kdim)
+    lq0 = Q.transition.log_prob(sample=sample0, scope=Q_scope0)
+    lq0 = sampling_type.reduce_logQ(lq0, platedims, Kdim)
+    f0 = lp0 - lq0 - math.log(Kdim.size)
+
+    #All the other time steps (computed for all time steps at once, though the first is ignored).
+    lp = P.transition.log_prob(sample=sample, scope=P.transition_scope(name, scope, sample, Tdim, Kdim, Kprev))
+    Q_scope = sampling_type.logQ_scope(Q.transition_scope(name, scope, sample, Tdim, Kdim, Kprev), active_platedims, Kdim)
+    lq = Q.transition.log_prob(sample=sample, scope=Q_scope)
+    lq = sampling_type.reduce_logQ(lq, active_platedims, Kdim)
+    frest = lp - lq - math.log(Kdim.size)
+
+    return TimeseriesFactor(f0, frest, Kdim, Kprev)
+
+
+def has_timeseries(plate:Plate):
+    return any(isinstance(dgpt, Timeseries) for dgpt in plate.prog.values())
+
+
 def lp_getter(
         name:Optional[str],
         P:Plate, 
@@ -219,7 +317,10 @@ def lp_getter(
         all_platedims:dict[str: Dim],
         groupvarname2Kdim:dict[str, Tensor],
         sampling_type:SamplingType,
-        split:Optional[Split]):
+        split:Optional[Split],
+        executor:Optional[Executor],
+        reduce_dtype:Optional[t.dtype],
+        prune:Optional[Prune]):
     """Traverses Q according to the structure of P collecting log probabilities
     
     """
@@ -235,9 +336,37 @@ def lp_getter(
 
     lps = list(tree_values(extra_log_factors).values())
 
+    #Sibling plates don't depend on each other, so if we're given an executor, and there
+    #are several child plates, we evaluate them concurrently.  Plates nested inside those
+    #child plates are evaluated serially, so we never block a worker waiting on the executor.
+    child_platenames = [childname for (childname, childP) in P.prog.items() if isinstance(childP, Plate)]
+    concurrent = (executor is not None) and (1 < len(child_platenames))
+
+    #Siblings of the same family are scored together, at the first variable in the batch.
+    batched_lps = {}
+    name2batch = {name: names for names in logPQ_batches(P.prog, Q.prog) for name in names}
+
     for childname, childP in P.prog.items():
         childQ = Q.prog.get(childname) 
 
+        if (childname in name2batch) and (childname not in batched_lps):
+            names = name2batch[childname]
+            result = logPQ_batch(
+                names=names,
+                P=[P.prog[name] for name in names],
+                Q=[Q.prog[name] for name in names],
+                samples=[sample[name] for name in names],
+                scope=scope,
+                active_platedims=active_platedims,
+                groupvarname2Kdim=groupvarname2Kdim,
+            )
+            #If the parameters aren't compatible, we score the variables one at a time.
+            batched_lps.update(result if result is not None else {name: None for name in names})
+
+        if batched_lps.get(childname) is not None:
+            lps.append(batched_lps[childname])
+            continue
+
         #childQ doesn't necessarily have a distribution if sample_data is data.
         #childQ defaults to None in that case.
 
@@ -247,12 +376,15 @@ def lp_getter(
         elif isinstance(childP, Plate):
             assert isinstance(childQ, Plate)
             method = logPQ_plate
+        elif isinstance(childP, Timeseries):
+            assert isinstance(childQ, Timeseries)
+            method = logPQ_timeseries
         else:
             isinstance(childP, Group)
             assert isinstance(childQ, Group)
             method = logPQ_group
 
-        lp = method(
+        kwargs = dict(
             name=childname,
             P=childP, 
             Q=childQ, 
@@ -265,15 +397,37 @@ def lp_getter(
             all_platedims=all_platedims,
             groupvarname2Kdim=groupvarname2Kdim,
             sampling_type=sampling_type,
-            split=split)
+            split=split,
+            reduce_dtype=reduce_dtype,
+            prune=prune)
+
+        if concurrent and isinstance(childP, Plate):
+            lp = submit(executor, method, {**kwargs, 'executor': None})
+        else:
+            lp = method(**kwargs, executor=executor)
         lps.append(lp)
 
+    #Wait for any concurrently evaluated plates, retaining the original order of the factors.
+    lps = [lp.result() if isinstance(lp, Future) else lp for lp in lps]
+
     #Collect all Ks in the plate
     all_Ks = []
     for varname, dist in Q.prog.items():
-        if isinstance(dist, (Dist, Group)):
+        if isinstance(dist, (Dist, Group, Timeseries)):
             all_Ks.append(groupvarname2Kdim[varname])
         else:
             assert isinstance(dist, (Plate, Data))
             
     return lps, all_Ks
+
+
+def submit(executor:Executor, f, kwargs:dict):
+    """
+    Submits f to the executor, making sure that the worker uses the same grad mode as
+    the caller (grad mode is thread-local, so e.g. `t.no_grad()` isn't otherwise inherited).
+    """
+    grad_enabled = t.is_grad_enabled()
+    def inner():
+        with t.set_grad_enabled(grad_enabled):
+            return f(**kwargs)
+    return executor.submit(inner)
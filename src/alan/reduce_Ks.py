@@ -1,6 +1,9 @@
+import math
 import opt_einsum
 from .utils import *
 from .unravel_index import unravel_index
+from .Profiler import profiled
+from .Timeseries import TimeseriesFactor, index_time, stack_time
 
 def einsum_args(lps, sum_dims):
     """
@@ -48,6 +51,10 @@ def sample_Ks(lps, Ks_to_sum, N_dim, num_samples):
     indices = {}
     
     for lps, kdims_to_sample in zip(lps_for_sampling[::-1], Ks_to_sample[::-1]): 
+        #Some steps (e.g. combining factors from sibling plates) don't sum over any Kdims.
+        if 0 == len(kdims_to_sample):
+            continue
+
         lp = sum(lps)
 
         for dim in list(set(generic_dims(lp)).intersection(set(indices.keys()))):
@@ -75,25 +82,57 @@ def sample_Ks(lps, Ks_to_sum, N_dim, num_samples):
     return indices
     
     
-def reduce_Ks(lps, Ks_to_sum):
+def reduce_Ks(lps, Ks_to_sum, reduce_dtype=None, prune=None):
     """
     Sum over Ks_to_sum, returning a single tensor.
+
+    If reduce_dtype is given (e.g. t.bfloat16 or t.float16), the large intermediate tensors
+    are stored in reduce_dtype (see logsumexp_sum).
+
+    If prune (an `alan.Prune.Prune`) is given, particles are pruned before each contraction step.
     """
     assert_unique_dim_iter(Ks_to_sum)
 
-    result, _, _ = collect_lps(lps, Ks_to_sum)
+    result, _, _ = collect_lps(lps, Ks_to_sum, reduce_dtype, prune)
 
     return result
 
 def checkpoint_reduce_Ks(lps, Ks_to_sum):
     return t.utils.checkpoint.checkpoint(reduce_Ks, lps, Ks_to_sum, use_reentrant=False)
 
-def logsumexp_sum(_Ks_to_sum, *lps_to_reduce):
-    #Needs a strange argument order, because checkpoint doesn't work with lists of lps.
-    return logsumexp_dims(sum(lps_to_reduce), _Ks_to_sum, ignore_extra_dims=True)
+def contraction_name(result, _Ks_to_sum, *lps_to_reduce, **kwargs):
+    return ','.join(str(K) for K in _Ks_to_sum) or '-'
 
+def contraction_flops(result, _Ks_to_sum, *lps_to_reduce, **kwargs):
+    #Size of the intermediate before summing out Ks, times adds for each factor, then max, subtract, exp and sum.
+    intermediate_numel = math.prod(dim.size for dim in unify_dims(lps_to_reduce))
+    return intermediate_numel * (len(lps_to_reduce) + 3)
 
-def collect_lps(lps, Ks_to_sum):
+@profiled('reduce_Ks', 'contraction', name=contraction_name, flops=contraction_flops)
+def logsumexp_sum(_Ks_to_sum, *lps_to_reduce, reduce_dtype=None):
+    #Needs a strange argument order, because checkpoint doesn't work with lists of lps.
+    if (reduce_dtype is None) or (0 == len(_Ks_to_sum)):
+        return logsumexp_dims(sum(lps_to_reduce), _Ks_to_sum, ignore_extra_dims=True)
+
+    #Low-precision path: the intermediate (which has all the Kdims in all lps_to_reduce, and
+    #is usually by far the largest tensor) is stored in reduce_dtype.  To keep the low-precision
+    #values accurate, each factor is shifted by its max over _Ks_to_sum (in the input dtype) so the
+    #low-precision values are all <= 0.  The shifts are detached, as the result doesn't depend on them.
+    shifts = [max_dims(lp, _Ks_to_sum, ignore_extra_dims=True).detach().nan_to_num(neginf=0.) for lp in lps_to_reduce]
+    residual = sum((lp - shift).to(dtype=reduce_dtype) for (lp, shift) in zip(lps_to_reduce, shifts))
+
+    #Shift again so the largest term in the sum is exp(0) = 1.  The sum is accumulated and returned
+    #in float32 (or the input dtype, if that's more precise), so the sum of exps isn't rounded to
+    #reduce_dtype before we take the log in the input dtype.  (On CUDA, PyTorch reads the half-precision
+    #input directly into the float32 reduction, so this doesn't make a float32 copy of the intermediate.)
+    max_residual = max_dims(residual, _Ks_to_sum, ignore_extra_dims=True).detach().nan_to_num(neginf=0.)
+    dtype = lps_to_reduce[0].dtype
+    sum_dtype = t.promote_types(t.float32, dtype)
+    sumexp = reduce_dims(lambda x, dim: t.sum(x, dim, dtype=sum_dtype))((residual - max_residual).exp(), _Ks_to_sum, ignore_extra_dims=True)
+    return sumexp.to(dtype=dtype).log() + max_residual.to(dtype=dtype) + sum(shifts)
+
+
+def collect_lps(lps, Ks_to_sum, reduce_dtype=None, prune=None):
     """
     Helper method that sums over Ks and returns a list of the reduced tensors along with a list of which Ks were reduced over for each reduced tensor.
     opt_einsum gives an "optimization path", i.e. the indicies of lps to reduce.
@@ -117,8 +156,15 @@ def collect_lps(lps, Ks_to_sum):
         _Ks_to_sum = tuple(set(Ks_to_sum).difference(unify_dims(lps)).intersection(unify_dims(lps_to_reduce)))
         Ks_to_sample.append(_Ks_to_sum)
 
+        #Drop particles with negligible weight before the (potentially very large) intermediate is formed.
+        if (prune is not None) and (0 < len(_Ks_to_sum)):
+            lps_to_reduce, _Ks_to_sum, step = prune.prune(lps_to_reduce, _Ks_to_sum)
+
         #Instantiates but doesn't save lp with _Ks_to_sample dims
-        lps.append(checkpoint(logsumexp_sum, _Ks_to_sum, *lps_to_reduce, use_reentrant=False))
+        lps.append(checkpoint(logsumexp_sum, _Ks_to_sum, *lps_to_reduce, reduce_dtype=reduce_dtype, use_reentrant=False))
+
+        if (prune is not None) and (0 < len(_Ks_to_sum)):
+            prune.record(step, lps[-1])
         all_reduced_lps.append([*lps])
 
     all_reduced_lps = all_reduced_lps[:-1]
@@ -127,3 +173,77 @@ def collect_lps(lps, Ks_to_sum):
     result = lps[0]
     
     return result, all_reduced_lps, Ks_to_sample
+
+
+#Timeseries.  The factor for a Timeseries (a `TimeseriesFactor`) has a single K-dimension, Kdim, shared
+#across time steps, so rather than summing over the Ks jointly, we sum over the particles at each time
+#step in turn.  We use backward messages, beta_t(k_{t-1}) = logsumexp_{k_t} [f_t(k_t, k_{t-1}) + g_t(k_t) + beta_{t+1}(k_t)],
+#where g_t is the sum of all the other factors in the plate (data and child plates), so the cost is
+#O(T K^2) rather than O(K^T).  To sample from the posterior over particles, we then sample forward in time
+#(k_0, then k_1 given k_0 etc.) using the messages, which is equivalent to forward filtering, backward sampling.
+
+def split_timeseries(lps):
+    """
+    Separates out the TimeseriesFactor from the other factors in the plate.
+    """
+    factors = [lp for lp in lps if isinstance(lp, TimeseriesFactor)]
+    assert 1 == len(factors)
+    others = [lp for lp in lps if not isinstance(lp, TimeseriesFactor)]
+    return factors[0], sum(others)
+
+def timeseries_messages(factor, G, Tdim):
+    """
+    Returns a list of the backward messages, betas, where betas[time] has Kdim for the particles at time-1.
+    """
+    betas = (Tdim.size+1)*[0.]
+    for time in range(Tdim.size-1, 0, -1):
+        lp = index_time(factor.frest, Tdim, time) + index_time(G, Tdim, time) + betas[time+1]
+        betas[time] = rename_dim(logsumexp_dims(lp, (factor.Kdim,)), factor.Kprev, factor.Kdim)
+    return betas
+
+def rename_dim(x, old_dim, new_dim):
+    return x.order(old_dim)[new_dim] if old_dim in set(generic_dims(x)) else x
+
+def timeseries_name(result, lps, Tdim):
+    return str(Tdim)
+
+@profiled('reduce_Ks', 'timeseries', name=timeseries_name)
+def reduce_timeseries(lps, Tdim):
+    """
+    Sums over the K-dimension for the Timeseries, and the time dimension.
+    """
+    factor, G = split_timeseries(lps)
+    betas = timeseries_messages(factor, G, Tdim)
+    return logsumexp_dims(factor.f0 + index_time(G, Tdim, 0) + betas[1], (factor.Kdim,))
+
+def sample_timeseries(lps, Tdim, N_dim, num_samples):
+    """
+    Samples num_samples particle indices for the Timeseries at each time step, returning a dict mapping
+    Kdim to the indices, which have a time dimension.
+    """
+    factor, G = split_timeseries(lps)
+    betas = timeseries_messages(factor, G, Tdim)
+
+    idx = sample_Kdim(factor.f0 + index_time(G, Tdim, 0) + betas[1], factor.Kdim, N_dim, num_samples)
+    idxs = [idx]
+    for time in range(1, Tdim.size):
+        lp = index_time(factor.frest, Tdim, time) + index_time(G, Tdim, time) + betas[time+1]
+        idx = sample_Kdim(rename_dim(lp, factor.Kprev, idx), factor.Kdim, N_dim, num_samples)
+        idxs.append(idx)
+
+    return {factor.Kdim: stack_time(idxs, Tdim)}
+
+def sample_Kdim(lp, Kdim, N_dim, num_samples):
+    """
+    Samples indices for Kdim from the distribution with log-probabilities lp.  Draws one sample for each
+    element of N_dim if lp already has N_dim, and otherwise num_samples independent samples.
+    """
+    dims = [dim for dim in generic_dims(lp) if dim is not Kdim]
+    if not any(dim is N_dim for dim in dims):
+        lp = lp + t.zeros(num_samples, device=lp.device)[N_dim]
+        dims = [*dims, N_dim]
+
+    lp = generic_order(lp, [*dims, Kdim])
+    probs = t.exp(lp - lp.amax(-1, keepdim=True))
+    idx = t.multinomial(probs.reshape(-1, Kdim.size), 1, replacement=True).reshape(probs.shape[:-1])
+    return generic_getitem(idx, dims)
@@ -4,8 +4,9 @@ from typing import Optional, Union
 from .Plate import Plate, tree_values, update_scope
 from .BoundPlate import BoundPlate
 from .Group import Group
+from .Timeseries import TimeseriesFactor
 from .utils import *
-from .reduce_Ks import reduce_Ks, sample_Ks
+from .reduce_Ks import reduce_Ks, sample_Ks, sample_timeseries
 from .Split import Split
 from .SamplingType import SamplingType
 from .dist import Dist
@@ -60,15 +61,22 @@ def logPQ_sample(
         all_platedims=all_platedims,
         groupvarname2Kdim=groupvarname2Kdim,
         sampling_type=sampling_type,
-        split=split)
+        split=split,
+        executor=None,
+        reduce_dtype=None,
+        prune=None)
 
     # Index into each lp with the indices we've collected so far
-    for i in range(len(lps)):
-        for dim in list(set(generic_dims(lps[i])).intersection(set(indices.keys()))):
-            lps[i] = lps[i].order(dim)[indices[dim]]
+    def index_lp(lp):
+        for dim in list(set(generic_dims(lp)).intersection(set(indices.keys()))):
+            lp = lp.order(dim)[indices[dim]]
+        return lp
+    lps = [lp.map(index_lp) if isinstance(lp, TimeseriesFactor) else index_lp(lp) for lp in lps]
 
-
-    if len(all_Ks) > 0:
+    if any(isinstance(lp, TimeseriesFactor) for lp in lps):
+        #Samples the particles for the Timeseries sequentially in time.
+        indices = {**indices, **sample_timeseries(lps, active_platedims[-1], N_dim, num_samples)}
+    elif len(all_Ks) > 0:
         indices = {**indices, **sample_Ks(lps, all_Ks,N_dim, num_samples)}
         
     for childname, childP in P.prog.items():
@@ -0,0 +1,165 @@
+import os
+import math
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch as t
+
+from .SamplingType import PermutationSampler
+
+
+def sweep(
+        problem_factory,
+        path:str,
+        Ks:list[int],
+        lrs:list[float],
+        num_runs:int=1,
+        num_iters:int=100,
+        reparam:bool=True,
+        sampling_type=PermutationSampler,
+        metrics=None,
+        max_workers=None,
+        threads_per_worker:int=1,
+    ):
+    """
+    Runs a sweep over K, learning rate and independent runs (seeds), training the
+    problem returned by `problem_factory()` with Adam for each configuration.
+
+    problem_factory: a module-level function with no arguments that returns a fresh Problem.
+      It must be picklable, as it is sent to the worker processes.
+    path: directory for results.  Each configuration is saved as a separate small
+      `.pt` file as soon as it finishes, and configurations that already have a file are
+      skipped, so an interrupted sweep can be resumed by calling `sweep` again with the
+      same arguments.  Configurations saved with different settings (`num_iters`, `reparam`
+      or `sampling_type`) are run again.  Load the results using `load_sweep(path)`.
+    reparam: if True, trains with `elbo_vi`, otherwise with `elbo_rws`.
+    metrics: optional module-level function `metrics(problem, sample) -> dict[str, float]`,
+      recorded at every iteration along with the ELBO (e.g. predictive log-likelihoods).
+    max_workers: number of worker processes (defaults to the number of cores divided by
+      threads_per_worker).  If `max_workers=0`, runs everything in the current process.
+    threads_per_worker: number of torch threads in each worker, so the workers don't
+      oversubscribe the cores.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    #Saved first so that load_sweep knows the full grid, even for a partial sweep.
+    settings = config_settings(num_iters, reparam, sampling_type)
+    grid = {'Ks': list(Ks), 'lrs': list(lrs), 'num_runs': num_runs, 'num_iters': num_iters, 'settings': settings}
+    atomic_save(grid, os.path.join(path, 'sweep.pt'))
+
+    configs = [
+        (K, lr, run) for (K, lr, run) in itertools.product(Ks, lrs, range(num_runs))
+        if not config_done(config_filename(path, K, lr, run), settings)
+    ]
+
+    kwargs = dict(
+        problem_factory=problem_factory,
+        path=path,
+        num_iters=num_iters,
+        reparam=reparam,
+        sampling_type=sampling_type,
+        metrics=metrics,
+    )
+
+    if max_workers == 0:
+        for (K, lr, run) in configs:
+            run_config(K=K, lr=lr, run=run, **kwargs)
+        return
+
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    #Spawn (rather than fork) to avoid inheriting the parent's torch thread pools.
+    with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(threads_per_worker,),
+        ) as executor:
+        futures = [executor.submit(run_config, K=K, lr=lr, run=run, **kwargs) for (K, lr, run) in configs]
+        #Raise any exceptions from the workers.
+        for future in futures:
+            future.result()
+
+
+def load_sweep(path:str):
+    """
+    Loads the results of a (possibly partial) sweep.
+
+    Returns a dict with the grid (`Ks`, `lrs`, `num_runs` and `num_iters`), along with
+    `elbos` and any metrics, as tensors with shape `(len(Ks), len(lrs), num_iters+1, num_runs)`.
+    Configurations that haven't been run yet (or were run with different settings) are
+    filled with NaN.
+    """
+    grid = t.load(os.path.join(path, 'sweep.pt'))
+    Ks, lrs, num_runs, num_iters = grid['Ks'], grid['lrs'], grid['num_runs'], grid['num_iters']
+
+    result = dict(grid)
+    for (K_idx, K), (lr_idx, lr), run in itertools.product(enumerate(Ks), enumerate(lrs), range(num_runs)):
+        filename = config_filename(path, K, lr, run)
+        if not config_done(filename, grid.get('settings')):
+            continue
+
+        for key, trace in t.load(filename)['traces'].items():
+            if key not in result:
+                result[key] = t.full((len(Ks), len(lrs), num_iters+1, num_runs), math.nan)
+            result[key][K_idx, lr_idx, :, run] = trace
+
+    return result
+
+
+def init_worker(threads_per_worker:int):
+    t.set_num_threads(threads_per_worker)
+
+def config_filename(path:str, K:int, lr:float, run:int):
+    return os.path.join(path, f'K{K}_lr{lr}_run{run}.pt')
+
+def config_settings(num_iters:int, reparam:bool, sampling_type):
+    """
+    Settings that change the results for a configuration, which are saved with each configuration.
+    """
+    return {'num_iters': num_iters, 'reparam': reparam, 'sampling_type': sampling_type.__name__}
+
+def config_done(filename:str, settings:dict):
+    """
+    Whether the configuration has already been run with these settings.
+    """
+    return os.path.exists(filename) and (t.load(filename).get('settings') == settings)
+
+def atomic_save(obj, filename:str):
+    """
+    Writes to a temporary file, then renames, so an interrupted sweep never leaves a
+    partially written file behind.
+    """
+    tmp_filename = filename + '.tmp'
+    t.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+def run_config(problem_factory, path:str, K:int, lr:float, run:int, num_iters:int, reparam:bool, sampling_type, metrics):
+    t.manual_seed(run)
+
+    problem = problem_factory()
+    opt = t.optim.Adam(problem.parameters(), lr=lr)
+
+    traces = {'elbos': t.zeros(num_iters+1)}
+    for i in range(num_iters+1):
+        opt.zero_grad()
+
+        sample = problem.sample(K, reparam, sampling_type)
+        elbo = sample.elbo_vi() if reparam else sample.elbo_rws()
+        traces['elbos'][i] = elbo.item()
+
+        if metrics is not None:
+            for key, value in metrics(problem, sample).items():
+                if key not in traces:
+                    traces[key] = t.full((num_iters+1,), math.nan)
+                traces[key][i] = float(value)
+
+        #The final iteration only evaluates the trained problem.
+        if i < num_iters:
+            (-elbo).backward()
+            opt.step()
+
+    settings = config_settings(num_iters, reparam, sampling_type)
+    atomic_save({'K': K, 'lr': lr, 'run': run, 'settings': settings, 'traces': traces}, config_filename(path, K, lr, run))
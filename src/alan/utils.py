@@ -1,4 +1,5 @@
 import inspect
+import itertools
 import math
 
 import torch as t
@@ -80,6 +81,7 @@ reserved_names = [
     "params", 
     "inputs_params_named",
     "N",
+    "replicate",
 ]
 reserved_prefixes = [
     "K_",
@@ -276,6 +278,28 @@ def ordered_unique(ls):
     d = {l:None for l in ls}
     return list(d.keys())
 
+#Canonical layout for torchdims.  Every dim gets a position when it is registered: the plate dims when
+#the Problem is constructed (in the order they're given), then the K-dims when they're created in
+#`Plate.groupvarname2Kdim`.  Any other dims (e.g. for splits) are registered the first
+#time they're seen.  Samples, arguments and log-probs are all laid out with their torchdims in this order,
+#so reordering a tensor that is already in the canonical layout is just a (contiguous) view.
+dim_positions = itertools.count()
+
+def register_dims(dims):
+    """
+    Gives each of the dims that doesn't yet have one a position in the canonical layout.
+    """
+    for dim in dims:
+        if not hasattr(dim, 'canonical_position'):
+            dim.canonical_position = next(dim_positions)
+
+def canonical_dims(dims):
+    """
+    Returns dims, sorted into the canonical layout.
+    """
+    register_dims(dims)
+    return sorted(dims, key=lambda dim: dim.canonical_position)
+
 def partition_tensors(lps, dim):
     """
     Partitions a list of tensors into two sets, one list with all tensors
@@ -296,7 +320,8 @@ def ultimate_order(x, dims):
     slice(None) (in which case, we will place a positional dimension)
     """
     #Check that the number of colons is equal to the number of positional dimensions.
-    assert generic_ndim(x) == sum(dim == slice(None) for dim in dims)
+    #(Not `dim == slice(None)`, as comparing a torchdim is expensive.)
+    assert generic_ndim(x) == sum(isinstance(dim, slice) for dim in dims)
 
     dims_in_x = set(generic_dims(x))
 
@@ -0,0 +1,66 @@
+"""
+Mixture of two Gaussians, with the discrete mixture component enumerated (rather than sampled) in Q.
+"""
+
+import itertools
+
+import torch as t
+from alan import Bernoulli, Plate, BoundPlate, Problem, Data, mean, mean2, Normal
+from TestProblem import TestProblem
+
+prior_p = 0.3
+shift = 2.
+
+N = 4
+data = t.randn(N) + shift*(t.rand(N) < prior_p)
+
+#Sum over all 2^N configurations of z, integrating out mu in closed form.
+ones = t.ones(N)
+cov = t.eye(N) + t.ones(N, N)
+log_joints = []
+post_means = []
+for z in itertools.product([0., 1.], repeat=N):
+    z = t.tensor(z)
+    log_prior_z = (z*t.log(t.tensor(prior_p)) + (1-z)*t.log(t.tensor(1-prior_p))).sum()
+    log_joints.append(log_prior_z + t.distributions.MultivariateNormal(shift*z, cov).log_prob(data))
+    #Posterior mean of mu given z, from the prior N(0, 1) and N unit-variance observations.
+    post_means.append((data - shift*z).sum() / (1+N))
+log_joints = t.stack(log_joints)
+post_means = t.stack(post_means)
+post_z = t.softmax(log_joints, 0)
+
+known_elbo = log_joints.logsumexp(0)
+post_mean = (post_z * post_means).sum()
+post_mean2 = (post_z * (post_means**2 + 1/(1+N))).sum()
+
+
+P = Plate(
+    mu = Normal(0, 1),
+    T = Plate(
+        z = Bernoulli(prior_p),
+        x = Normal(lambda mu, z: mu + shift*z, 1),
+    ),
+)
+
+Q = Plate(
+    mu = Normal(0.5, 1),
+    T = Plate(
+        z = Bernoulli(0.5, enumerate=True),
+        x = Data(),
+    ),
+)
+
+P = BoundPlate(P)
+Q = BoundPlate(Q)
+
+all_platesizes = {'T': N}
+data = {'x': data.refine_names('T')}
+problem = Problem(P, Q, all_platesizes, data)
+
+known_moments = {
+    ('mu', mean): post_mean,
+    ('mu', mean2): post_mean2,
+}
+moments = list(known_moments.keys())
+
+tp = TestProblem(problem, moments, known_moments=known_moments, known_elbo=known_elbo, moment_K=10000, elbo_K=10000)
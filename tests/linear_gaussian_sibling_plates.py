@@ -0,0 +1,61 @@
+"""
+Univariate Gaussian, with the data split across two sibling plates.
+"""
+
+import torch as t
+from alan import Plate, BoundPlate, Problem, Data, mean, mean2, Normal
+from TestProblem import TestProblem
+
+prior_mean = 2
+prior_scale = 2
+prior_prec = 1/prior_scale**2
+
+like_scale = 3
+like_prec = 1/like_scale**2
+
+N1 = 6
+N2 = 4
+N = N1 + N2
+data = 1.5+t.randn(N)
+post_prec = prior_prec + N*like_prec
+post_mean = (prior_prec*prior_mean + like_prec*data.sum()) / post_prec
+
+marginal_prior_mean = prior_mean*t.ones(N)
+marginal_prior_cov = (prior_scale**2)*t.ones(N, N) + (like_scale**2)*t.eye(N)
+known_elbo = t.distributions.MultivariateNormal(marginal_prior_mean, marginal_prior_cov).log_prob(data)
+
+
+P = Plate(
+    a = Normal(prior_mean, prior_scale),
+    T1 = Plate(
+        d1 = Normal('a', like_scale),
+    ),
+    T2 = Plate(
+        d2 = Normal('a', like_scale),
+    ),
+)
+
+Q = Plate(
+    a = Normal(1, 4),
+    T1 = Plate(
+        d1 = Data(),
+    ),
+    T2 = Plate(
+        d2 = Data(),
+    ),
+)
+
+P = BoundPlate(P)
+Q = BoundPlate(Q)
+
+all_platesizes = {'T1': N1, 'T2': N2}
+data = {'d1': data[:N1].refine_names('T1'), 'd2': data[N1:].refine_names('T2')}
+problem = Problem(P, Q, all_platesizes, data)
+
+known_moments = {
+    ('a', mean): post_mean,
+    ('a', mean2): post_mean**2 + 1/post_prec,
+}
+moments = list(known_moments.keys())
+
+tp = TestProblem(problem, moments, known_moments=known_moments, known_elbo=known_elbo, moment_K=1000, elbo_K=1000)
@@ -0,0 +1,139 @@
+import math
+
+import pytest
+import torch as t
+
+import alan
+from alan import Normal, Gamma, Plate, BoundPlate, Problem, Data, no_checkpoint, checkpoint
+from alan.batching import sample_batches, logPQ_batches
+from alan.utils import generic_dims, generic_order
+
+def make_problem():
+    P = Plate(
+        a = Normal(0, 1),
+        b = Normal(0, 1),
+        s = Gamma(2, 1),
+        xa = Normal('a', 1),
+        xb = Normal('b', 1),
+        xs = Gamma('s', 1),
+        T = Plate(
+            c = Normal(0, 1),
+            d = Normal(0, 2),
+            xc = Normal('c', 1),
+            xd = Normal('d', 1),
+        ),
+    )
+    Q = Plate(
+        a = Normal('a_mean', 1.5),
+        b = Normal('b_mean', 1.5),
+        s = Gamma(2, 1),
+        xa = Data(),
+        xb = Data(),
+        xs = Data(),
+        T = Plate(
+            c = Normal('c_mean', 1),
+            d = Normal('d_mean', 1),
+            xc = Data(),
+            xd = Data(),
+        ),
+    )
+    Q = BoundPlate(Q, params={
+        'a_mean': t.zeros(()),
+        'b_mean': t.ones(()),
+        'c_mean': t.zeros(4, names=('T',)),
+        'd_mean': t.ones(4, names=('T',)),
+    })
+    data = {
+        'xa': t.randn(()),
+        'xb': t.randn(()),
+        'xs': t.rand(())+1,
+        'xc': t.randn(4, names=('T',)),
+        'xd': t.randn(4, names=('T',)),
+    }
+    return Problem(BoundPlate(P), Q, {'T': 4}, data)
+
+def test_batches():
+    problem = make_problem()
+    P, Q = problem.P.plate, problem.Q.plate
+
+    #s is the only Gamma, and the data doesn't go in batches.
+    assert [['a', 'b']] == sample_batches(Q.prog)
+    assert [['a', 'b']] == logPQ_batches(P.prog, Q.prog)
+    assert [['c', 'd']] == sample_batches(Q.prog['T'].prog)
+    assert [['c', 'd']] == logPQ_batches(P.prog['T'].prog, Q.prog['T'].prog)
+
+    #Variables that depend on other variables in the plate aren't batched.
+    P = Plate(a = Normal(0, 1), b = Normal('a', 1), c = Normal(0, 1))
+    assert [['a', 'c']] == sample_batches(P.prog)
+
+def logpq(logP, logQ):
+    """
+    log mean_k P(x_k)/Q(x_k), for a latent with only data as children.
+    """
+    return t.logsumexp(logP - logQ, 0) - math.log(logP.shape[0])
+
+def expected_elbo(problem, sample):
+    """
+    Recomputes the ELBO by hand: each latent only has data as children, so the ELBO is a sum of
+    independent terms.
+    """
+    samples = sample.sample
+    data = problem.data
+    Kdims = sample.groupvarname2Kdim
+    Tdim = problem.all_platedims['T']
+    a = generic_order(samples['a'], [Kdims['a']])
+    b = generic_order(samples['b'], [Kdims['b']])
+    s = generic_order(samples['s'], [Kdims['s']])
+    c = generic_order(samples['T']['c'], [Kdims['c'], Tdim])
+    d = generic_order(samples['T']['d'], [Kdims['d'], Tdim])
+    xc = generic_order(data['T']['xc'], [Tdim])
+    xd = generic_order(data['T']['xd'], [Tdim])
+
+    N = t.distributions.Normal
+    G = t.distributions.Gamma
+    return (
+        logpq(N(0, 1).log_prob(a) + N(a, 1).log_prob(data['xa']), N(0, 1.5).log_prob(a)) +
+        logpq(N(0, 1).log_prob(b) + N(b, 1).log_prob(data['xb']), N(1, 1.5).log_prob(b)) +
+        logpq(G(2, 1).log_prob(s) + G(s, 1).log_prob(data['xs']), G(2, 1).log_prob(s)) +
+        logpq(N(0, 1).log_prob(c) + N(c, 1).log_prob(xc), N(0, 1).log_prob(c)).sum() +
+        logpq(N(0, 2).log_prob(d) + N(d, 1).log_prob(xd), N(1, 1).log_prob(d)).sum()
+    )
+
+@pytest.mark.parametrize("split", [no_checkpoint, checkpoint])
+def test_batched_elbo(split):
+    K = 3
+    problem = make_problem()
+    with alan.profile() as prof:
+        sample = problem.sample(K=K, reparam=True)
+        elbo = sample.elbo_vi(split=split)
+
+    names = {(event.phase, event.kind, event.name) for event in prof.events}
+    assert ('sample', 'Batch', 'a,b') in names
+    assert ('sample', 'Batch', 'c,d') in names
+    assert ('logPQ', 'Batch', 'a,b') in names
+    assert ('logPQ', 'Batch', 'c,d') in names
+
+    #Each sample has its own K-dimension.
+    samples = sample.sample
+    for name in ['a', 'b']:
+        assert set(generic_dims(samples[name])) == {sample.groupvarname2Kdim[name]}
+    for name in ['c', 'd']:
+        assert set(generic_dims(samples['T'][name])) == {sample.groupvarname2Kdim[name], problem.all_platedims['T']}
+
+    assert t.isclose(elbo, expected_elbo(problem, sample), rtol=1E-5)
+
+def test_batched_elbo_heterogeneous_K():
+    #a and b have different K, so fall back to sampling/computing log-probs one at a time, but c and d are still batched.
+    problem = make_problem()
+    with alan.profile() as prof:
+        sample = problem.sample(K={'a': 3, 'b': 5, 's': 2, 'c': 4, 'd': 4}, reparam=True)
+        elbo = sample.elbo_vi()
+
+    names = {(event.phase, event.kind, event.name) for event in prof.events}
+    for phase in ['sample', 'logPQ']:
+        assert (phase, 'Dist', 'a') in names
+        assert (phase, 'Dist', 'b') in names
+        assert (phase, 'Dist', 'c') not in names
+        assert (phase, 'Dist', 'd') not in names
+
+    assert t.isclose(elbo, expected_elbo(problem, sample), rtol=1E-5)
@@ -0,0 +1,86 @@
+import pytest
+import torch as t
+
+from alan import Normal, Plate, BoundPlate, Problem, Data, Timeseries, checkpoint, no_checkpoint
+from alan.conjugate import conjugate_pairs, rao_blackwellise_plate, MarginalNormal
+
+import model1
+import linear_gaussian
+import linear_gaussian_latents
+import linear_gaussian_latents_batch
+
+def test_conjugate_pairs():
+    problem = linear_gaussian_latents.tp.problem
+    P, Q = problem.P.plate, problem.Q.plate
+
+    #a is shared across the plate, so it isn't integrated out.
+    assert {} == conjugate_pairs(P, Q)
+    assert {'z': 'd'} == conjugate_pairs(P.prog['T'], Q.prog['T'])
+
+    P_rb, Q_rb = rao_blackwellise_plate(P, Q)
+    assert 'z' not in P_rb.prog['T'].prog
+    assert 'z' not in Q_rb.prog['T'].prog
+    assert isinstance(P_rb.prog['T'].prog['d'], MarginalNormal)
+
+    #The mean for d isn't just 'a', so nothing is integrated out.
+    problem = linear_gaussian.tp.problem
+    assert {} == conjugate_pairs(problem.P.plate.prog['T'], problem.Q.plate.prog['T'])
+
+@pytest.mark.parametrize("split", [checkpoint, no_checkpoint])
+def test_rao_blackwellise_unchanged(split):
+    #Nothing to integrate out in model1.
+    sample = model1.tp.problem.sample(K=3, reparam=False)
+    assert t.isclose(sample.elbo_nograd(split=split), sample.elbo_nograd(split=split, rao_blackwellise=True))
+
+@pytest.mark.parametrize("tp", [linear_gaussian_latents.tp, linear_gaussian_latents_batch.tp])
+def test_rao_blackwellise_elbo(tp):
+    t.manual_seed(0)
+    problem = tp.problem
+
+    elbos = []
+    elbos_rb = []
+    for _ in range(30):
+        sample = problem.sample(K=30, reparam=False)
+        elbos.append(sample.elbo_nograd())
+        elbos_rb.append(sample.elbo_nograd(rao_blackwellise=True))
+    elbos = t.stack(elbos)
+    elbos_rb = t.stack(elbos_rb)
+
+    #Integrating out z gives a tighter bound, with less variance.
+    assert elbos.mean() < elbos_rb.mean()
+    assert elbos_rb.var() < elbos.var()
+
+    if tp.known_elbo is not None:
+        assert elbos_rb.mean() <= tp.known_elbo + 0.1
+
+    #VI still works, it's just that Q for z gets no gradients.
+    sample = problem.sample(K=3, reparam=True)
+    elbo = sample.elbo_vi(rao_blackwellise=True)
+    assert t.isfinite(elbo)
+
+def test_rao_blackwellise_timeseries():
+    #z is used by the Timeseries (as init and in the transition), so it can't be integrated out, even
+    #though its only other dependent, w, is data.
+    t.manual_seed(0)
+    P = Plate(
+        z = Normal(0, 1),
+        w = Normal('z', 1),
+        T = Plate(
+            x = Timeseries('z', Normal(lambda x, z: 0.9*x + z, 0.3)),
+            y = Normal('x', 1),
+        ),
+    )
+    Q = Plate(
+        z = Normal(0, 1),
+        w = Data(),
+        T = Plate(
+            x = Timeseries('z', Normal(lambda x, z: 0.9*x + z, 0.3)),
+            y = Data(),
+        ),
+    )
+    data = {'w': t.randn(()), 'y': t.randn(4, names=('T',))}
+    problem = Problem(BoundPlate(P), BoundPlate(Q), {'T': 4}, data)
+    assert {} == conjugate_pairs(problem.P.plate, problem.Q.plate)
+
+    sample = problem.sample(K=3, reparam=True)
+    assert t.isclose(sample.elbo_vi(), sample.elbo_vi(rao_blackwellise=True))
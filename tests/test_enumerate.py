@@ -0,0 +1,65 @@
+import pytest
+import torch as t
+
+from alan import Bernoulli, Categorical, Normal, Plate, BoundPlate, Group, Problem, Data, mean, sampling_types
+
+def mixture_problem(N=6):
+    """
+    Only the (enumerated) mixture components are latent, so the ELBO is exact for any K.
+    """
+    P = Plate(
+        T = Plate(
+            z = Categorical(t.tensor([0.2, 0.3, 0.5])),
+            x = Normal(lambda z: 2.*z, 1),
+        ),
+    )
+    Q = Plate(
+        T = Plate(
+            z = Categorical(t.ones(3)/3, enumerate=True),
+            x = Data(),
+        ),
+    )
+    x = t.randn(N)
+    problem = Problem(BoundPlate(P), BoundPlate(Q), {'T': N}, {'x': x.refine_names('T')})
+
+    log_joint = t.tensor([0.2, 0.3, 0.5]).log() + t.distributions.Normal(2.*t.arange(3.), 1).log_prob(x[:, None])
+    return problem, log_joint
+
+@pytest.mark.parametrize("sampling_type", sampling_types)
+def test_enumerate_exact(sampling_type):
+    problem, log_joint = mixture_problem()
+
+    for K in [1, 5]:
+        sample = problem.sample(K=K, sampling_type=sampling_type)
+        #The K-dimension for z is the support, regardless of K.
+        assert sample.sample['T']['z'].order(sample.groupvarname2Kdim['z']).shape[0] == 3
+        assert t.isclose(sample.elbo_vi(), log_joint.logsumexp(1).sum(), rtol=1E-5)
+
+        post_z = t.softmax(log_joint, 1)
+        z_mean = sample.moments('z', mean).rename(None)
+        assert t.allclose(z_mean, (post_z * t.arange(3.)).sum(1), rtol=1E-4)
+
+def test_enumerate_errors():
+    #No finite support.
+    with pytest.raises(Exception, match="finite support"):
+        Normal(0, 1, enumerate=True)
+
+    #Parameters depend on other variables.
+    with pytest.raises(Exception, match="fixed values"):
+        Bernoulli('p', enumerate=True)
+
+    #Enumeration in P.
+    P = Plate(z = Bernoulli(0.5, enumerate=True), x = Normal('z', 1))
+    Q = Plate(z = Bernoulli(0.5), x = Data())
+    with pytest.raises(Exception, match="only makes sense in Q"):
+        Problem(BoundPlate(P), BoundPlate(Q), {}, {'x': t.randn(())})
+
+    #Variables in Q depending on an enumerated variable.
+    P = Plate(z = Bernoulli(0.5), a = Normal('z', 1), x = Normal('a', 1))
+    Q = Plate(z = Bernoulli(0.5, enumerate=True), a = Normal('z', 1), x = Data())
+    with pytest.raises(Exception, match="depends on"):
+        Problem(BoundPlate(P), BoundPlate(Q), {}, {'x': t.randn(())})
+
+    #Enumeration inside a Group.
+    with pytest.raises(Exception, match="Group"):
+        Group(z = Bernoulli(0.5, enumerate=True), a = Normal(0, 1))
@@ -0,0 +1,77 @@
+import math
+
+import pytest
+import torch as t
+
+from alan import Normal, Bernoulli, Plate, BoundPlate, Problem, Data, Group, mean, sampling_types, IndependentSampler
+
+def make_problem():
+    P = Plate(
+        a = Normal(0, 1),
+        p1 = Plate(
+            g = Group(b = Normal('a', 1), c = Normal('b', 1)),
+            y = Normal('c', 1),
+        ),
+    )
+    #Q is the prior, so the importance weights are well-behaved.
+    Q = Plate(
+        a = Normal(0, 1),
+        p1 = Plate(
+            g = Group(b = Normal('a', 1), c = Normal('b', 1)),
+            y = Data(),
+        ),
+    )
+    y = t.randn(3)
+    problem = Problem(BoundPlate(P), BoundPlate(Q), {'p1': 3}, {'y': y.refine_names('p1')})
+
+    #y is Gaussian, with variance 4 and covariance 1 (from the shared a).
+    log_evidence = t.distributions.MultivariateNormal(t.zeros(3), 3*t.eye(3) + t.ones(3, 3)).log_prob(y)
+    return problem, log_evidence
+
+def test_K_dict_and_function():
+    problem, _ = make_problem()
+
+    sample = problem.sample(K={'a': 7, 'g': 3}, reparam=False)
+    assert {'a': 7, 'g': 3} == {name: Kdim.size for (name, Kdim) in sample.groupvarname2Kdim.items()}
+
+    #Function of the groupvarname and the names of the active plates.
+    sample = problem.sample(K=lambda name, platenames: 2 if platenames else 9, reparam=False)
+    assert {'a': 9, 'g': 2} == {name: Kdim.size for (name, Kdim) in sample.groupvarname2Kdim.items()}
+
+    #The size of the K-dimension for enumerated variables is the size of the support, so they don't need a K.
+    P = Plate(z = Bernoulli(0.3), x = Normal('z', 1))
+    Q = Plate(z = Bernoulli(0.3, enumerate=True), x = Normal(0, 1))
+    enum_problem = Problem(BoundPlate(P), BoundPlate(Q), {}, {})
+    sample = enum_problem.sample(K={'x': 5}, reparam=False)
+    assert {'z': 2, 'x': 5} == {name: Kdim.size for (name, Kdim) in sample.groupvarname2Kdim.items()}
+
+def test_K_errors():
+    problem, _ = make_problem()
+    with pytest.raises(Exception, match="doesn't give a K for g"):
+        problem.sample(K={'a': 3}, reparam=False)
+    with pytest.raises(Exception, match="aren't latent variables or groups"):
+        problem.sample(K={'a': 3, 'g': 3, 'b': 3}, reparam=False)
+    with pytest.raises(Exception, match="positive int"):
+        problem.sample(K={'a': 3, 'g': 0}, reparam=False)
+
+@pytest.mark.parametrize("sampling_type", sampling_types)
+def test_heterogeneous_K_unbiased(sampling_type):
+    t.manual_seed(0)
+    problem, log_evidence = make_problem()
+
+    #Fewer particles for the parent than the children, and vice versa.
+    for K in [{'a': 6, 'g': 4}, {'a': 3, 'g': 5}]:
+        N = 500
+        elbos = t.stack([problem.sample(K=K, reparam=False, sampling_type=sampling_type).elbo_nograd() for _ in range(N)])
+        ratio = (elbos - log_evidence).exp()
+        assert abs(ratio.mean() - 1) < 4*ratio.std()/math.sqrt(N)
+
+@pytest.mark.parametrize("sampling_type", [*sampling_types, IndependentSampler])
+def test_heterogeneous_K_runs(sampling_type):
+    t.manual_seed(0)
+    problem, _ = make_problem()
+    sample = problem.sample(K={'a': 5, 'g': 2}, reparam=True, sampling_type=sampling_type)
+
+    assert t.isfinite(sample.elbo_vi())
+    assert t.isfinite(sample.moments('b', mean)).all()
+    assert sample.importance_sample(num_samples=4).dump()['b'].shape == (3, 4)
@@ -0,0 +1,84 @@
+import math
+
+import pytest
+import torch as t
+
+from alan import Normal, Plate, BoundPlate, Problem, Data
+from alan.kl import analytic_kl_plate, AnalyticKL
+
+import model1
+import linear_gaussian_latents
+import linear_multivariate_gaussian
+
+def make_problem():
+    P = Plate(
+        a = Normal(0, 1),
+        T = Plate(
+            z = Normal(0, 1),
+            d = Normal(lambda a, z: a + z, 1),
+        ),
+    )
+    Q = Plate(
+        a = Normal('a_mean', lambda a_log_scale: a_log_scale.exp()),
+        T = Plate(
+            z = Normal('z_mean', 1),
+            d = Data(),
+        ),
+    )
+    Q = BoundPlate(Q, params={
+        'a_mean': t.tensor(0.3),
+        'a_log_scale': t.tensor(-0.5),
+        'z_mean': 0.5*t.ones(5, names=('T',)),
+    })
+    data = {'d': t.randn(5, names=('T',))}
+    return Problem(BoundPlate(P), Q, {'T': 5}, data)
+
+def test_analytic_kl_plate():
+    problem = make_problem()
+    P = analytic_kl_plate(problem.P.plate, problem.Q.plate)
+    assert isinstance(P.prog['a'], AnalyticKL)
+    assert isinstance(P.prog['T'].prog['z'], AnalyticKL)
+    #Data isn't touched.
+    assert P.prog['T'].prog['d'] is problem.P.plate.prog['T'].prog['d']
+
+def test_analytic_kl_K1():
+    """
+    At K=1, the ELBO is log P(d|a, z) - KL(Q(a)||P(a)) - KL(Q(z)||P(z)).
+    """
+    problem = make_problem()
+    sample = problem.sample(K=1, reparam=True)
+    elbo = sample.elbo_vi(analytic_kl=True)
+
+    a = sample.sample['a'].order(sample.groupvarname2Kdim['a'])[0]
+    z = sample.sample['T']['z'].order(sample.groupvarname2Kdim['z'], problem.all_platedims['T'])[0]
+    d = problem.data['T']['d'].order(problem.all_platedims['T'])
+
+    N = t.distributions.Normal
+    kl_a = t.distributions.kl_divergence(N(0.3, math.exp(-0.5)), N(0., 1.))
+    kl_z = t.distributions.kl_divergence(N(0.5, 1.), N(0., 1.)) * 5
+    expected = N(a + z, 1).log_prob(d).sum() - kl_a - kl_z
+    assert t.isclose(elbo, expected, rtol=1E-5)
+
+def grads(problem, K, analytic_kl, N=200):
+    result = []
+    params = list(problem.Q.parameters())
+    for _ in range(N):
+        sample = problem.sample(K=K, reparam=True)
+        result.append(t.stack([g.sum() for g in t.autograd.grad(sample.elbo_vi(analytic_kl=analytic_kl), params)]))
+    return t.stack(result)
+
+def test_analytic_kl_variance():
+    t.manual_seed(0)
+    problem = make_problem()
+    var_mc = grads(problem, 3, False).var(0)
+    var_kl = grads(problem, 3, True).var(0)
+    assert (var_kl < var_mc).all()
+
+@pytest.mark.parametrize("tp", [model1.tp, linear_gaussian_latents.tp, linear_multivariate_gaussian.tp])
+def test_analytic_kl_fallback(tp):
+    """
+    Runs on problems where Q depends on other latents (so we fall back to sampling), and for
+    MultivariateNormal.
+    """
+    sample = tp.problem.sample(K=3, reparam=True)
+    assert t.isfinite(sample.elbo_vi(analytic_kl=True))
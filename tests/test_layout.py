@@ -0,0 +1,41 @@
+import torch as t
+
+from alan.TorchDimDist import TorchDimDist
+from alan.utils import *
+
+import model1
+
+
+def same(dims1, dims2):
+    return (len(dims1) == len(dims2)) and all(dim1 is dim2 for (dim1, dim2) in zip(dims1, dims2))
+
+def test_canonical_dims_stable():
+    a, b, c = Dim('a', 2), Dim('b', 3), Dim('c', 4)
+    register_dims([b, a])
+    assert same(canonical_dims([a, c, b]), [b, a, c])
+    assert same(canonical_dims([c, b, a]), [b, a, c])
+
+def test_problem_layout():
+    """
+    Plate dims come before the K-dims in the canonical layout.
+    """
+    groupvarname2Kdim = model1.prob.Q.plate.groupvarname2Kdim(3)
+    platedims = list(model1.prob.all_platedims.values())
+    Kdims = list(groupvarname2Kdim.values())
+    assert same(canonical_dims([*Kdims, *platedims])[:len(platedims)], platedims)
+
+def test_sample_log_prob_no_copy():
+    p, K = Dim('p', 3), Dim('K', 4)
+    register_dims([p, K])
+    loc = t.randn(3)[p]
+
+    #Samples are in the canonical layout, whatever the order of sample_dims.
+    sample = TorchDimDist(td.Normal, loc=loc, scale=1.).sample(False, sample_dims=[K, p], sample_shape=[])
+    x = ultimate_order(sample, [p, None, K])
+    assert x.is_contiguous()
+    assert x.data_ptr() == ultimate_order(sample, [p, K]).data_ptr()
+
+    #Log-probs are unchanged.
+    lp = TorchDimDist(td.Normal, loc=loc, scale=2.).log_prob(sample)
+    expected = td.Normal(loc.order(p)[:, None], 2.).log_prob(sample.order(p, K))
+    assert t.allclose(lp.order(p, K), expected)
@@ -0,0 +1,20 @@
+import sys
+import subprocess
+
+import alan
+
+def run(code:str):
+    return subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout.strip()
+
+def test_import_is_lazy():
+    assert 'False' == run("import sys, alan; print('torch' in sys.modules)")
+    assert 'True'  == run("import sys, alan; alan.Normal; print('torch' in sys.modules)")
+
+def test_attributes():
+    #Submodules with the same name as the class don't shadow the class.
+    import alan.Problem
+    assert isinstance(alan.Plate, type)
+    assert isinstance(alan.Problem, type)
+    assert alan.Normal.dist is alan.dist.td.Normal
+    assert alan.PermutationSampler in alan.sampling_types
+    assert 'Normal' in alan.__all__
@@ -1,12 +1,19 @@
 import importlib
 import pytest
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import torch as t
+from functorch.dim import Dim
 
-from alan import sampling_types, Sample, PermutationSampler, CategoricalSampler, checkpoint, no_checkpoint
+import alan
+
+from alan import Normal, Plate, BoundPlate, Data, sampling_types, Problem, PermutationSampler, CategoricalSampler, CyclicSampler, StratifiedSampler, SystematicSampler, IndependentSampler, checkpoint, no_checkpoint
 from alan.Marginals import Marginals
-from alan.utils import generic_dims, generic_order, generic_getitem, generic_all, multi_order
+from alan.reduce_Ks import logsumexp_sum
+from alan.utils import logsumexp_dims, generic_dims, generic_order, generic_getitem, generic_all, multi_order, dim2named_dict
+from alan.Plate import flatten_tree
+from alan.Sample import Sample
 from alan.moments import var_from_raw_moment, RawMoment
 
 tp_names = [
@@ -17,12 +24,14 @@ tp_names = [
     "linear_gaussian_two_params_corr_Q",
     "linear_gaussian_two_params_corr_Q_reversed",
     "linear_gaussian_two_params_dangling",
+    "linear_gaussian_sibling_plates",
     "linear_gaussian_latents",
     "linear_gaussian_latents_dangling",
     "linear_gaussian_latents_batch",
     "linear_multivariate_gaussian",
     "linear_multivariate_gaussian_batch",
     "linear_multivariate_gaussian_param",
+    "bernoulli_enumerate",
 ]
 
 #dict[str, TestProblem]
@@ -136,13 +145,28 @@ def test_elbo_ground_truth(tp_name, sampling_type):
     """
     tests `sample.elbo` against ground truth
     """
-    tp = tps[tp_name]
+    check_elbo_ground_truth(tps[tp_name], sampling_type)
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_qmc_elbo_ground_truth(tp_name):
+    """
+    tests `sample.elbo` with QMC base noise against ground truth
+    """
+    check_elbo_ground_truth(tps[tp_name], PermutationSampler, qmc=True)
 
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_antithetic_elbo_ground_truth(tp_name):
+    """
+    tests `sample.elbo` with antithetic pairs of particles against ground truth
+    """
+    check_elbo_ground_truth(tps[tp_name], PermutationSampler, antithetic=True)
+
+def check_elbo_ground_truth(tp, sampling_type, qmc=False, antithetic=False):
     if tp.known_elbo is not None:
         N_elbos = tp.elbo_iters
         elbos = []
         for _ in range(N_elbos):
-            elbos.append(tp.problem.sample(K=tp.elbo_K, reparam=False, sampling_type=sampling_type).elbo_nograd())
+            elbos.append(tp.problem.sample(K=tp.elbo_K, reparam=False, sampling_type=sampling_type, qmc=qmc, antithetic=antithetic).elbo_nograd())
         elbo_tensor = t.stack(elbos)
 
         sample_mean = elbo_tensor.mean()
@@ -256,3 +280,329 @@ def test_split_moments(tp_name, split):
 
         base_moments, test_moments = multi_order(base_moments, test_moments)
         assert t.allclose(base_moments, test_moments, rtol=1E-4, atol=1E-5)
+
+@pytest.mark.parametrize("tp_name,split", tp_splits)
+def test_executor_elbo(tp_name, split):
+    """
+    tests `sample.elbo_vi` with sibling plates evaluated concurrently against serial evaluation
+    """
+    tp = tps[tp_name]
+
+    if split is None:
+        split = tp.split
+
+    sample = tp.problem.sample(K=3, reparam=True, sampling_type=PermutationSampler)
+
+    base_elbo = sample.elbo_vi(split=split)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        test_elbo = sample.elbo_vi(split=split, executor=executor)
+
+    assert t.isclose(base_elbo, test_elbo)
+
+def index_replicate(tree, rep_problem, problem, r):
+    """
+    Picks out replicate r from a tree of tensors for rep_problem, with the plate dims for rep_problem
+    replaced by the corresponding plate dims for problem.
+    """
+    if isinstance(tree, dict):
+        return {k: index_replicate(v, rep_problem, problem, r) for (k, v) in tree.items()}
+    rep_dim, = rep_problem.replicate_dims
+    dim_map = {rep_problem.all_platedims[name]: dim for (name, dim) in problem.all_platedims.items()}
+    x = tree.order(rep_dim)[r]
+    dims = generic_dims(x)
+    return generic_getitem(generic_order(x, dims), [dim_map.get(dim, dim) for dim in dims])
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_replicates_elbo(tp_name):
+    """
+    tests `sample.elbo_vi` for a problem with replicates against separately computing the ELBO
+    for each replicate's sample.
+    """
+    tp = tps[tp_name]
+    problem = tp.problem
+    replicates = 3
+
+    all_platesizes = {name: dim.size for (name, dim) in problem.all_platedims.items()}
+    data = dim2named_dict(flatten_tree(problem.data))
+    rep_problem = Problem(problem.P, problem.Q, all_platesizes, data, replicates=replicates)
+    rep_sample = rep_problem.sample(K=3, reparam=True, sampling_type=PermutationSampler)
+    rep_elbos = rep_sample.elbo_vi(split=no_checkpoint)
+    assert rep_elbos.shape == (replicates,)
+
+    for r in range(replicates):
+        sample = Sample(
+            problem=problem,
+            sample=index_replicate(rep_sample.sample, rep_problem, problem, r),
+            groupvarname2Kdim=rep_sample.groupvarname2Kdim,
+            sampling_type=PermutationSampler,
+            reparam=True,
+        )
+        assert t.isclose(rep_elbos[r], sample.elbo_vi(split=no_checkpoint))
+
+def test_replicates_params():
+    """
+    tests replicates with their own Q parameters (with a `replicate` dimension) against a separate
+    problem for each replicate, with that replicate's slice of the parameters.
+    """
+    t.manual_seed(0)
+    replicates = 3
+    P = Plate(
+        a = Normal(0, 1),
+        p = Plate(
+            z = Normal('a', 1),
+            d = Normal('z', 1),
+        ),
+    )
+    #Q for z doesn't depend on a, so we can reparameterise the samples for each replicate by hand below.
+    Q = Plate(
+        a = Normal('a_mean', 1),
+        p = Plate(
+            z = Normal('z_mean', 1),
+            d = Data(),
+        ),
+    )
+    params = {
+        'a_mean': t.randn(replicates, names=('replicate',)),
+        'z_mean': t.randn(replicates, 4, names=('replicate', 'p')),
+    }
+    data = {'d': t.randn(4, names=('p',))}
+
+    rep_Q = BoundPlate(Q, params=params)
+    rep_problem = Problem(BoundPlate(P), rep_Q, {'p': 4}, data, replicates=replicates)
+    rep_sample = rep_problem.sample(K=3, reparam=True, sampling_type=PermutationSampler)
+    rep_elbos = rep_sample.elbo_vi(split=no_checkpoint)
+    assert rep_elbos.shape == (replicates,)
+
+    for r in range(replicates):
+        Q_r = BoundPlate(Q, params={name: param.rename(None)[r].refine_names(*param.names[1:]) for (name, param) in params.items()})
+        problem = Problem(BoundPlate(P), Q_r, {'p': 4}, data)
+
+        #Replicate r's sample, reparameterised in terms of Q_r's parameters, so the gradients match.
+        sample_r = index_replicate(rep_sample.sample, rep_problem, problem, r)
+        pdim = problem.all_platedims['p']
+        a_mean = params['a_mean'].rename(None)
+        z_mean = params['z_mean'].rename(None)
+        sample_r['a'] = sample_r['a'].detach() - a_mean[r] + Q_r.a_mean
+        sample_r['p']['z'] = sample_r['p']['z'].detach() - z_mean[r][pdim] + Q_r.z_mean.rename(None)[pdim]
+
+        sample = Sample(
+            problem=problem,
+            sample=sample_r,
+            groupvarname2Kdim=rep_sample.groupvarname2Kdim,
+            sampling_type=PermutationSampler,
+            reparam=True,
+        )
+        elbo = sample.elbo_vi(split=no_checkpoint)
+        assert t.isclose(rep_elbos[r], elbo)
+
+        #The gradient of replicate r's ELBO only goes to replicate r's slice of the parameters.
+        rep_Q.zero_grad()
+        rep_elbos[r].backward(retain_graph=True)
+        elbo.backward()
+        for name in params:
+            rep_grad = getattr(rep_Q, name).grad.rename(None)
+            assert t.allclose(rep_grad[r], getattr(Q_r, name).grad.rename(None), atol=1E-5)
+            other = [i for i in range(replicates) if i != r]
+            assert (rep_grad[other] == 0).all()
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_estimate_vs_profile(tp_name):
+    """
+    tests the contractions in the dry-run `problem.estimate` against those recorded by `alan.profile`.
+    """
+    tp = tps[tp_name]
+    K = 3
+
+    estimate = tp.problem.estimate(K=K, split=no_checkpoint)
+
+    with alan.profile() as prof:
+        sample = tp.problem.sample(K=K, reparam=True, sampling_type=PermutationSampler)
+        sample.elbo_vi(split=no_checkpoint)
+
+    #The profiler's FLOP estimates are computed from the sizes of the actual tensors.
+    profiled_contractions = [event for event in prof.events if event.phase == 'reduce_Ks']
+    assert len(profiled_contractions) == len(estimate['contractions'])
+    for event, contraction in zip(profiled_contractions, estimate['contractions']):
+        assert event.name == (','.join(contraction['Ks']) or '-')
+        assert event.flops == contraction['flops']
+
+    assert 0 < estimate['peak_memory']
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_estimate_independent_sampler(tp_name):
+    """
+    tests that, with `IndependentSampler`, the log-prob for Q has no parent K-dimensions, so the
+    estimate has the same contractions, but is no larger than for the mixture samplers.
+    """
+    tp = tps[tp_name]
+    mixture = tp.problem.estimate(K=3, split=no_checkpoint, sampling_type=PermutationSampler)
+    independent = tp.problem.estimate(K=3, split=no_checkpoint, sampling_type=IndependentSampler)
+
+    assert mixture['contractions'] == independent['contractions']
+    assert independent['flops'] <= mixture['flops']
+    assert independent['peak_memory'] <= mixture['peak_memory']
+
+def test_estimate_independent_sampler_smaller():
+    #Q for z depends on a, so with the mixture samplers the log-prob for Q has K_a as well as K_z.
+    P = Plate(a = Normal(0, 1), z = Normal('a', 1), d = Normal('z', 1))
+    Q = Plate(a = Normal(0, 1), z = Normal('a', 1), d = Data())
+    problem = Problem(BoundPlate(P), BoundPlate(Q), {}, {'d': t.randn(())})
+
+    mixture = problem.estimate(K=10, split=no_checkpoint, sampling_type=PermutationSampler)
+    independent = problem.estimate(K=10, split=no_checkpoint, sampling_type=IndependentSampler)
+
+    #The log-prob for Q for z has 10*10 elements, rather than 10.
+    assert mixture['flops'] - independent['flops'] == 10*10 - 10
+    assert mixture['peak_memory'] - independent['peak_memory'] == (10*10 - 10) * t.empty(()).element_size()
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_explain_reduction(tp_name, capsys):
+    """
+    tests that `sample.explain_reduction` flags steps against the contractions in `problem.estimate`.
+    """
+    tp = tps[tp_name]
+    sample = tp.problem.sample(K=3, reparam=False, sampling_type=PermutationSampler)
+    contractions = tp.problem.estimate(K=3)['contractions']
+
+    assert [] == sample.explain_reduction(threshold=max(c['numel'] for c in contractions))
+
+    flagged = sample.explain_reduction(threshold=0)
+    assert [(f['plate'], f['Ks'], f['numel']) for f in flagged] == [(c['plate'], c['Ks'], c['numel']) for c in contractions]
+    assert 'exceeds threshold' in capsys.readouterr().out
+
+@pytest.mark.parametrize("reduce_dtype", [t.bfloat16, t.float16])
+def test_low_precision_sum(reduce_dtype):
+    """
+    tests that the sum of exps in the low-precision path is accumulated and returned in float32, rather than
+    being rounded to reduce_dtype.  All the terms are exp(0) = 1, so the exps are exact, and the sum, 2049,
+    is exact in float32, but rounds to 2048 in bfloat16 and float16.
+    """
+    Kdim = Dim('K', 2049)
+    lp = t.zeros(2049)[Kdim]
+
+    result = logsumexp_sum((Kdim,), lp, reduce_dtype=reduce_dtype)
+    assert result.dtype == t.float32
+    assert t.isclose(result, t.tensor(2049.).log(), rtol=0, atol=1E-6)
+
+@pytest.mark.parametrize("tp_name,reduce_dtype", list(itertools.product(tp_names, [t.bfloat16, t.float16])))
+def test_low_precision_elbo(tp_name, reduce_dtype):
+    """
+    tests `sample.elbo_vi` with low-precision intermediates against the full-precision path.
+    """
+    tp = tps[tp_name]
+    sample = tp.problem.sample(K=10, reparam=True, sampling_type=PermutationSampler)
+
+    base_elbo = sample.elbo_vi(split=no_checkpoint)
+    for split in [no_checkpoint, checkpoint]:
+        test_elbo = sample.elbo_vi(split=split, reduce_dtype=reduce_dtype)
+
+        assert test_elbo.dtype == base_elbo.dtype
+        assert (test_elbo - base_elbo).abs() < 0.5 * t.finfo(reduce_dtype).eps * base_elbo.abs()
+
+        if test_elbo.requires_grad:
+            test_elbo.backward(retain_graph=True)
+
+@pytest.mark.parametrize("tp_name,split", list(itertools.product(tp_names, [checkpoint, no_checkpoint])))
+def test_pruned_elbo(tp_name, split):
+    """
+    tests that `sample.elbo_pruned` brackets the full ELBO, and is exact if nothing is pruned.
+    """
+    tp = tps[tp_name]
+    sample = tp.problem.sample(K=10, reparam=True, sampling_type=PermutationSampler)
+    full_elbo = sample.elbo_vi(split=no_checkpoint)
+
+    elbo, report = sample.elbo_pruned(top_k=10, split=split)
+    assert t.isclose(elbo, full_elbo)
+    assert report['bias_bound'] == 0.
+
+    for kwargs in [{'top_k': 3}, {'threshold': 1e-3}, {'top_k': 5, 'threshold': 1e-2}]:
+        elbo, report = sample.elbo_pruned(split=split, **kwargs)
+        assert elbo <= full_elbo + 1e-4
+        assert full_elbo <= report['elbo_upper'] + 1e-4
+        assert all(num_kept <= kwargs.get('top_k', 10) for step in report['steps'] for num_kept in step['kept'].values())
+
+        if elbo.requires_grad:
+            elbo.backward(retain_graph=True)
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_independent_sampler(tp_name):
+    """
+    tests `IndependentSampler`: with K=1, there's only one parent particle, so the ELBO must match
+    the mixture samplers for the same sample.
+    """
+    tp = tps[tp_name]
+    sample = tp.problem.sample(K=1, reparam=True, sampling_type=IndependentSampler)
+    perm_sample = Sample(
+        problem=tp.problem,
+        sample=sample.sample,
+        groupvarname2Kdim=sample.groupvarname2Kdim,
+        sampling_type=PermutationSampler,
+        reparam=True,
+    )
+    assert t.isclose(sample.elbo_vi(split=no_checkpoint), perm_sample.elbo_vi(split=no_checkpoint))
+
+    sample = tp.problem.sample(K=10, reparam=False, sampling_type=IndependentSampler)
+    assert sample.elbo_nograd().isfinite()
+    for moment in sample.moments(tp.moments):
+        assert generic_all(moment.isfinite())
+    sample.importance_sample(num_samples=10)
+
+def test_stratified_sampler_variance():
+    """
+    tests that `StratifiedSampler` gives a lower-variance ELBO than `CategoricalSampler` at the same K,
+    and that `SystematicSampler` (with equal parent weights) is just `CyclicSampler`.
+    """
+    t.manual_seed(0)
+    P = Plate(
+        a = Normal(0, 1),
+        p = Plate(
+            z = Normal('a', 1),
+            d = Normal('z', 1),
+        ),
+    )
+    Q = Plate(
+        a = Normal(0, 1.5),
+        p = Plate(
+            z = Normal('a', 1),
+            d = Data(),
+        ),
+    )
+    problem = Problem(BoundPlate(P), BoundPlate(Q), {'p': 20}, {'d': t.randn(20, names=('p',))})
+
+    def elbo_var(sampling_type):
+        return t.stack([problem.sample(K=10, reparam=False, sampling_type=sampling_type).elbo_nograd() for _ in range(500)]).var()
+
+    #Typically around half the variance.
+    assert elbo_var(StratifiedSampler) < 0.75 * elbo_var(CategoricalSampler)
+
+    assert issubclass(SystematicSampler, CyclicSampler)
+
+@pytest.mark.parametrize("tp_name", tp_names)
+def test_qmc_elbo_vi(tp_name):
+    """
+    tests that QMC samples are reproducible and have gradients.
+    """
+    tp = tps[tp_name]
+
+    elbos = []
+    for _ in range(2):
+        with t.random.fork_rng():
+            t.manual_seed(0)
+            elbos.append(tp.problem.sample(K=8, reparam=True, qmc=True).elbo_vi())
+    elbo = elbos[0]
+    assert t.isclose(elbos[0], elbos[1])
+
+    assert elbo.isfinite()
+    if elbo.requires_grad:
+        elbo.backward()
+
+def test_antithetic_pairs():
+    """
+    tests that the second half of the particles mirror the first half.
+    """
+    problem = tps['linear_gaussian'].problem
+    sample = problem.sample(K=7, reparam=True, antithetic=True)
+    a = sample.sample['a'].order(sample.groupvarname2Kdim['a'])
+
+    #Q for a is Normal(1, 4), and the last particle is unpaired.
+    assert t.allclose(a[:3] - 1, -(a[3:6] - 1))
@@ -0,0 +1,62 @@
+import os
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import torch as t
+
+import alan
+from alan import no_checkpoint
+from alan.Profiler import active_profilers
+
+import model1
+import linear_gaussian_sibling_plates
+
+def test_profile_nodes():
+    problem = model1.tp.problem
+
+    with alan.profile() as prof:
+        sample = problem.sample(K=3, reparam=True)
+        elbo = sample.elbo_vi(split=no_checkpoint)
+    assert 0 == len(active_profilers)
+
+    #Profiling doesn't change the results.
+    assert t.isclose(elbo, sample.elbo_vi(split=no_checkpoint))
+
+    names = {(event.phase, event.kind, event.name) for event in prof.events}
+    for (kind, name) in [('Plate', 'root'), ('Group', 'ab'), ('Dist', 'c'), ('Plate', 'p1'), ('Dist', 'd'), ('Plate', 'p2')]:
+        assert ('sample', kind, name) in names
+        assert ('logPQ', kind, name) in names
+    #Data is only in the log-probs.
+    assert ('logPQ', 'Dist', 'e') in names
+    assert any(event.phase == 'reduce_Ks' for event in prof.events)
+
+    for event in prof.events:
+        assert 0 <= event.self_duration <= event.duration
+        assert 0 <= event.flops
+        assert 0 <= event.bytes
+
+    #A sample's bytes are the sum of the bytes for its children.
+    sample_events = {(event.kind, event.name): event for event in prof.events if event.phase == 'sample'}
+    children = ['ab', 'c', 'p1']
+    assert sample_events['Plate', 'root'].bytes == sum(event.bytes for ((kind, name), event) in sample_events.items() if name in children)
+
+    assert 'contraction' in prof.table()
+
+    with tempfile.TemporaryDirectory() as path:
+        filename = os.path.join(path, 'trace.json')
+        prof.export_chrome_trace(filename)
+        with open(filename) as f:
+            trace = json.load(f)
+    assert len(trace['traceEvents']) == len(prof.events)
+
+def test_profile_executor():
+    problem = linear_gaussian_sibling_plates.tp.problem
+    sample = problem.sample(K=3, reparam=True)
+
+    with alan.profile() as prof:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            sample.elbo_vi(split=no_checkpoint, executor=executor)
+
+    names = [event.name for event in prof.events if event.phase == 'logPQ' and event.kind == 'Plate']
+    assert sorted(names) == ['T1', 'T2', 'root']
@@ -0,0 +1,34 @@
+import torch as t
+
+from alan import *
+from alan.Plate import push_scope, update_scope_inputs_params, update_scope_sample
+
+def test_scope_levels():
+    """
+    Updating a child level of the scope doesn't change the parent's scope.
+    """
+    a = t.zeros(())
+    scope = update_scope_inputs_params({}, {'a': a})
+    child = update_scope_inputs_params(scope, {'b': t.ones(())})
+    child = update_scope_sample(child, 'c', Normal(0, 1), t.ones(()))
+
+    assert set(child.keys()) == {'a', 'b', 'c'}
+    assert set(scope.keys()) == {'a'}
+    assert child['a'] is a
+
+    #Pushing a level onto a plain dict doesn't copy it.
+    d = {'a': a}
+    assert push_scope(d).maps[1] is d
+
+def test_wide_program():
+    """
+    A chain of lots of latents in one plate.
+    """
+    N = 200
+    P = Plate(z0=Normal(0., 1.), **{f'z{i}': Normal(f'z{i-1}', 1.) for i in range(1, N)}, obs=Normal(f'z{N-1}', 1.))
+    Q = Plate(**{f'z{i}': Normal(0., 1.) for i in range(N)}, obs=Data())
+
+    problem = Problem(BoundPlate(P), BoundPlate(Q), {}, {'obs': t.zeros(())})
+    sample = problem.sample(K=3)
+    assert set(sample.sample.keys()) == set(f'z{i}' for i in range(N))
+    assert t.isfinite(sample.elbo_vi())
@@ -0,0 +1,67 @@
+import os
+import tempfile
+
+import torch as t
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from alan import Normal, Plate, BoundPlate, Problem, Data, Shard, sync_seed, all_reduce_grads, checkpoint, no_checkpoint
+
+def make_problem():
+    t.manual_seed(0)
+
+    P = Plate(
+        a = Normal(0, 1),
+        p = Plate(
+            z = Normal('a', 1),
+            d = Normal('z', 1),
+        ),
+    )
+
+    Q = Plate(
+        a = Normal('a_mean', 1),
+        p = Plate(
+            z = Normal(lambda a, z_mean: a + z_mean, 1),
+            d = Data(),
+        ),
+    )
+
+    P = BoundPlate(P)
+    Q = BoundPlate(Q, params={'a_mean': t.zeros(()), 'z_mean': t.randn(5, names=('p',))})
+
+    data = {'d': t.randn(5, names=('p',))}
+    return Problem(P, Q, {'p': 5}, data)
+
+def shard_worker(rank, world_size, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+
+    problem = make_problem()
+    params = list(problem.parameters())
+    sync_seed()
+
+    for split in [checkpoint, no_checkpoint]:
+        sample = problem.sample(K=3, reparam=True)
+
+        #Every rank has the same sample, so can compute the full ELBO + gradients locally.
+        full_elbo = sample.elbo_vi(split=split)
+        full_grads = t.autograd.grad(full_elbo, params, retain_graph=True)
+
+        problem.zero_grad()
+        sharded_elbo = sample.elbo_vi(split=Shard('p'))
+        sharded_elbo.backward()
+        all_reduce_grads(problem)
+
+        assert t.isclose(full_elbo, sharded_elbo)
+        for full_grad, param in zip(full_grads, params):
+            assert t.allclose(full_grad, param.grad, atol=1E-5)
+
+    dist.destroy_process_group()
+
+def test_shard_elbo_vi():
+    """
+    tests that the sharded ELBO and averaged gradients match the ELBO and gradients from a single process.
+    """
+    world_size = 2
+    with tempfile.TemporaryDirectory() as tmpdir:
+        init_file = os.path.join(tmpdir, "init")
+        mp.spawn(shard_worker, args=(world_size, init_file), nprocs=world_size)
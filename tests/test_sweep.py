@@ -0,0 +1,83 @@
+import os
+import math
+import tempfile
+
+import torch as t
+
+from alan import Normal, Plate, BoundPlate, Problem, Data, PermutationSampler, mean
+from alan.sweep import sweep, load_sweep, atomic_save, config_settings
+
+def make_problem():
+    P = Plate(
+        a = Normal(0, 1),
+        p = Plate(
+            d = Normal('a', 1),
+        ),
+    )
+
+    Q = Plate(
+        a = Normal('a_mean', 1),
+        p = Plate(
+            d = Data(),
+        ),
+    )
+
+    P = BoundPlate(P)
+    Q = BoundPlate(Q, params={'a_mean': t.zeros(())})
+
+    data = {'d': t.linspace(-1, 3, 5).refine_names('p')}
+    return Problem(P, Q, {'p': 5}, data)
+
+def a_mean(problem, sample):
+    return {'a_mean': problem.Q.a_mean}
+
+def test_sweep():
+    Ks = [1, 3]
+    lrs = [0.01, 0.1]
+
+    with tempfile.TemporaryDirectory() as path:
+        kwargs = dict(Ks=Ks, lrs=lrs, num_runs=2, num_iters=5, metrics=a_mean)
+        sweep(make_problem, path, max_workers=2, **kwargs)
+
+        result = load_sweep(path)
+        assert result['elbos'].shape == (2, 2, 6, 2)
+        assert result['a_mean'].shape == (2, 2, 6, 2)
+        assert not result['elbos'].isnan().any()
+
+        #All configurations start from the same parameters.
+        assert (result['a_mean'][:, :, 0] == 0).all()
+
+        #Configurations are seeded by run, so running in-process gives the same results.
+        filename = os.path.join(path, 'K3_lr0.1_run1.pt')
+        os.remove(filename)
+        assert load_sweep(path)['elbos'][1, 1, :, 1].isnan().all()
+
+        #Resuming only reruns the missing configuration.
+        mtime = os.path.getmtime(os.path.join(path, 'K1_lr0.01_run0.pt'))
+        sweep(make_problem, path, max_workers=0, **kwargs)
+        assert mtime == os.path.getmtime(os.path.join(path, 'K1_lr0.01_run0.pt'))
+
+        resumed = load_sweep(path)
+        assert t.allclose(result['elbos'], resumed['elbos'])
+
+def test_sweep_changed_settings():
+    with tempfile.TemporaryDirectory() as path:
+        sweep(make_problem, path, Ks=[1], lrs=[0.1], num_iters=5, max_workers=0)
+        filename = os.path.join(path, 'K1_lr0.1_run0.pt')
+        mtime = os.path.getmtime(filename)
+
+        #Resuming with the same settings skips the configuration.
+        sweep(make_problem, path, Ks=[1], lrs=[0.1], num_iters=5, max_workers=0)
+        assert mtime == os.path.getmtime(filename)
+
+        #Configurations saved with different settings are run again, rather than mixed into the results.
+        for kwargs in [dict(num_iters=3), dict(num_iters=3, reparam=False)]:
+            sweep(make_problem, path, Ks=[1], lrs=[0.1], max_workers=0, **kwargs)
+            assert t.load(filename)['settings'] == {'num_iters': 3, 'reparam': kwargs.get('reparam', True), 'sampling_type': 'PermutationSampler'}
+            assert load_sweep(path)['elbos'].shape == (1, 1, 4, 1)
+
+        #Results with settings that don't match sweep.pt (e.g. if a sweep with new settings is interrupted
+        #before rerunning them) aren't loaded.
+        atomic_save({**t.load(os.path.join(path, 'sweep.pt')), 'settings': config_settings(5, True, PermutationSampler)}, os.path.join(path, 'sweep.pt'))
+        result = load_sweep(path)
+        assert 'elbos' not in result
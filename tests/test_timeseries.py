@@ -0,0 +1,126 @@
+import pytest
+import torch as t
+from functorch.dim import Dim
+
+from alan import Normal, Plate, BoundPlate, Problem, Data, Split, Timeseries, mean, sampling_types, IndependentSampler
+from alan.Sample import Sample
+
+T = 4
+
+def timeseries_problem():
+    P = Plate(
+        x_init = Normal(0, 1),
+        T = Plate(
+            x = Timeseries('x_init', Normal('x', 0.5)),
+            y = Normal('x', 1.),
+        ),
+    )
+    Q = Plate(
+        x_init = Normal(0, 1),
+        T = Plate(
+            x = Timeseries('x_init', Normal('x', 0.7)),
+            y = Data(),
+        ),
+    )
+    data = {'y': t.randn(T).refine_names('T')}
+    return Problem(BoundPlate(P), BoundPlate(Q), {'T': T}, data), data
+
+def unrolled_problem(data):
+    """
+    The same model, with a separate latent variable (and K-dimension) for each time step.
+    """
+    P = {'x_init': Normal(0, 1)}
+    Q = {'x_init': Normal(0, 1)}
+    prev = 'x_init'
+    for time in range(T):
+        P[f'x{time}'] = Normal(prev, 0.5)
+        P[f'y{time}'] = Normal(f'x{time}', 1.)
+        Q[f'x{time}'] = Normal(prev, 0.7)
+        Q[f'y{time}'] = Data()
+        prev = f'x{time}'
+    unrolled_data = {f'y{time}': data['y'].rename(None)[time] for time in range(T)}
+    return Problem(BoundPlate(Plate(**P)), BoundPlate(Plate(**Q)), {}, unrolled_data)
+
+def unrolled_sample(sample, unrolled):
+    """
+    Splits the sample for the Timeseries into one sample for each time step.
+    """
+    Tdim = sample.all_platedims['T']
+    Kdim = sample.groupvarname2Kdim['x']
+    x = sample.sample['T']['x']
+
+    groupvarname2Kdim = {'x_init': sample.groupvarname2Kdim['x_init']}
+    unrolled_sample = {'x_init': sample.sample['x_init']}
+    for time in range(T):
+        groupvarname2Kdim[f'x{time}'] = Dim(f'K_x{time}', Kdim.size)
+        unrolled_sample[f'x{time}'] = x.order(Tdim)[time].order(Kdim)[groupvarname2Kdim[f'x{time}']]
+
+    return Sample(unrolled, unrolled_sample, groupvarname2Kdim, sample.sampling_type, sample.reparam)
+
+@pytest.mark.parametrize("sampling_type", [*sampling_types, IndependentSampler])
+def test_timeseries_vs_unrolled(sampling_type):
+    t.manual_seed(0)
+    problem, data = timeseries_problem()
+    unrolled = unrolled_problem(data)
+
+    sample = problem.sample(K=5, reparam=False, sampling_type=sampling_type)
+    unrolled_samp = unrolled_sample(sample, unrolled)
+
+    #Same particles, so the sequential reduction should match summing over the K-dimension for each time step.
+    assert t.isclose(sample.elbo_nograd(), unrolled_samp.elbo_nograd(), rtol=1E-5)
+
+    x_mean = sample.moments('x', mean).rename(None)
+    unrolled_mean = t.stack([unrolled_samp.moments(f'x{time}', mean) for time in range(T)])
+    assert t.allclose(x_mean, unrolled_mean, rtol=1E-4, atol=1E-5)
+
+def test_timeseries_importance_sample():
+    t.manual_seed(0)
+    problem, _ = timeseries_problem()
+    sample = problem.sample(K=5, reparam=False)
+
+    importance_sample = sample.importance_sample(num_samples=7)
+    dump = importance_sample.dump()
+    assert dump['x'].shape == (T, 7)
+
+    #Importance samples are samples from the Timeseries.
+    x = sample.sample['T']['x'].order(problem.all_platedims['T'], sample.groupvarname2Kdim['x'])
+    for time in range(T):
+        assert t.isin(dump['x'].rename(None)[time], x[time]).all()
+
+def test_timeseries_vi():
+    t.manual_seed(0)
+    P = Plate(
+        x_init = Normal(0, 1),
+        T = Plate(
+            x = Timeseries('x_init', Normal('x', 0.5)),
+            y = Normal('x', 1.),
+        ),
+    )
+    Q = Plate(
+        x_init = Normal('m', 1),
+        T = Plate(
+            x = Timeseries('x_init', Normal(lambda x, loc: x + loc, 0.7)),
+            y = Data(),
+        ),
+    )
+    Q = BoundPlate(Q, params={'m': t.zeros(()), 'loc': t.zeros(T, names=('T',))})
+    problem = Problem(BoundPlate(P), Q, {'T': T}, {'y': t.randn(T).refine_names('T')})
+
+    problem.sample(K=5, reparam=True).elbo_vi().backward()
+    assert (Q.m.grad != 0).all()
+    assert (Q.loc.grad != 0).all()
+
+def test_timeseries_errors():
+    problem, _ = timeseries_problem()
+    with pytest.raises(Exception, match="time dimension"):
+        problem.sample(K=3, reparam=False).elbo_nograd(split=Split('T', 2))
+
+    #Timeseries at the top-level.
+    P = Plate(x_init = Normal(0, 1), x = Timeseries('x_init', Normal('x', 1)))
+    with pytest.raises(Exception, match="top-level"):
+        Problem(BoundPlate(P), BoundPlate(P), {}, {})
+
+    #Other latent variables in the same plate as a Timeseries.
+    P = Plate(x_init = Normal(0, 1), T = Plate(x = Timeseries('x_init', Normal('x', 1)), z = Normal(0, 1)))
+    with pytest.raises(Exception, match="other latent variables"):
+        Problem(BoundPlate(P), BoundPlate(P), {'T': 3}, {})
@@ -0,0 +1,89 @@
+import pytest
+import torch as t
+
+import alan
+from alan.TorchDimDist import TorchDimDist
+from alan.utils import *
+
+import model1
+import linear_gaussian_latents
+import linear_multivariate_gaussian
+import bernoulli_no_plate
+
+@pytest.fixture
+def no_validation():
+    alan.set_default_validate_args(False)
+    try:
+        yield
+    finally:
+        alan.set_default_validate_args(True)
+
+K = Dim('K', 4)
+cov = t.randn(3, 3)
+cov = cov @ cov.mT + t.eye(3)
+
+dist_kwargs_samples = [
+    (td.Normal, {'loc': t.randn(4, 2)[K], 'scale': t.rand(2)+0.5}, t.randn(2)),
+    (td.Bernoulli, {'probs': t.rand(4, 2)[K]}, t.tensor([0., 1.])),
+    (td.Bernoulli, {'logits': t.randn(4, 2)[K]}, t.tensor([0., 1.])),
+    (td.Binomial, {'total_count': t.tensor(5), 'probs': t.rand(4, 2)[K]}, t.tensor([2., 5.])),
+    (td.Binomial, {'total_count': t.tensor(5), 'logits': t.randn(4, 2)[K]}, t.tensor([0., 3.])),
+    (td.Gamma, {'concentration': t.rand(4, 2)[K]+0.5, 'rate': t.rand(2)+0.5}, t.rand(2)+0.1),
+    (td.Poisson, {'rate': t.rand(4, 2)[K]+0.5}, t.tensor([0., 4.])),
+    (td.MultivariateNormal, {'loc': t.randn(4, 3)[K], 'covariance_matrix': cov}, t.randn(3)),
+    (td.MultivariateNormal, {'loc': t.randn(3), 'scale_tril': t.linalg.cholesky(cov)}, t.randn(2, 3)),
+]
+
+@pytest.mark.parametrize("dist, kwargs, x", dist_kwargs_samples)
+def test_kernel_log_prob(dist, kwargs, x, no_validation):
+    fast = TorchDimDist(dist, **kwargs)
+    assert fast.log_prob_kernel is not None
+
+    alan.set_default_validate_args(True)
+    slow = TorchDimDist(dist, **kwargs)
+    assert slow.log_prob_kernel is None
+
+    lp_fast = generic_order(fast.log_prob(x), generic_dims(fast.log_prob(x)))
+    lp_slow = generic_order(slow.log_prob(x), generic_dims(slow.log_prob(x)))
+    assert t.allclose(lp_fast, lp_slow, rtol=1E-5, atol=1E-5)
+
+@pytest.mark.parametrize("dist, kwargs, x", [dks for dks in dist_kwargs_samples if dks[0] in [td.Normal, td.MultivariateNormal]])
+def test_kernel_rsample(dist, kwargs, x, no_validation):
+    t.manual_seed(0)
+    N = Dim('N', 20000)
+    fast = TorchDimDist(dist, **kwargs)
+    assert fast.rsample_kernel is not None
+    sample = fast.sample(True, sample_dims=[K, N], sample_shape=[])
+
+    #Moments match samples from the PyTorch distribution.
+    alan.set_default_validate_args(True)
+    slow_sample = TorchDimDist(dist, **kwargs).sample(True, sample_dims=[K, N], sample_shape=[])
+
+    sample = generic_order(sample, [N, K])
+    slow_sample = generic_order(slow_sample, [N, K])
+    assert t.allclose(sample.mean(0), slow_sample.mean(0), atol=0.1)
+    assert t.allclose(sample.var(0), slow_sample.var(0), atol=0.1, rtol=0.1)
+
+@pytest.mark.parametrize("tp", [model1.tp, linear_gaussian_latents.tp, linear_multivariate_gaussian.tp, bernoulli_no_plate.tp])
+def test_no_validation_elbo(tp, no_validation):
+    """
+    The ELBO (and gradients) are the same for a given sample, with or without validation.
+    """
+    sample = tp.problem.sample(K=5, reparam=True)
+    elbo_fast = sample.elbo_vi()
+
+    alan.set_default_validate_args(True)
+    elbo_slow = sample.elbo_vi()
+    assert t.isclose(elbo_fast, elbo_slow, rtol=1E-5)
+
+def test_validation():
+    with pytest.raises(ValueError):
+        TorchDimDist(td.Normal, loc=t.zeros(()), scale=-t.ones(())).log_prob(t.zeros(()))
+
+    alan.set_default_validate_args(False)
+    try:
+        #No error, just NaNs.
+        lp = TorchDimDist(td.Normal, loc=t.zeros(()), scale=-t.ones(())).log_prob(t.zeros(()))
+        assert t.isnan(lp)
+    finally:
+        alan.set_default_validate_args(True)